@@ -0,0 +1,183 @@
+# Micro-benchmarks of the generated CPU code.
+# The integral and update functions are compiled through jit with the local compiler at the requested flags
+# and timed over large batches of random arguments. For every shell class the report gives the time per call,
+# the arithmetic rate (from the operations in the generated code, see metacode.arithmetic_operations) and
+# the number of instructions the compiler emitted (from objdump), so emission strategies can be compared on
+# real hardware. Results are saved as JSON.
+
+import os
+import re
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+import gaussians as gauss
+from gaussians import L, ABC # types
+import integrals
+import printing
+import jit
+from metacode import arithmetic_operations, Statements
+from validate import random_arguments
+
+default_samples = 1 << 18
+default_repeats = 5
+
+######### Measurements ###########
+
+# Best wall time over repeats of func(), which should do the same work every time
+def best_time(func, repeats : int=default_repeats) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+# Number of instructions of every function in a shared library, keyed by the demangled name without
+# the parameter list (e.g. "S_Px_Dxy"). Empty if objdump isn't available.
+def instruction_counts(so_filename : str) -> Dict[str, int]:
+    if shutil.which("objdump") is None:
+        return {}
+    disassembly = subprocess.run(["objdump", "-d", "-C", "--no-show-raw-insn", so_filename],
+                                 capture_output=True, text=True, check=True).stdout
+    counts = {}
+    name = None
+    for line in disassembly.split("\n"):
+        header = re.match(r"^[0-9a-f]+ <(.*)>:$", line)
+        if header:
+            name = header.group(1).split("(")[0]
+            counts[name] = 0
+        elif not line.strip():
+            name = None
+        elif name is not None and re.match(r"^\s+[0-9a-f]+:\s+\S", line):
+            counts[name] += 1
+    return counts
+
+# Floating point operations of one call of each integral function
+def integral_operations(abc : ABC) -> int:
+    return arithmetic_operations(integrals.registry[abc])
+
+# Floating point operations of one call of the update function for the shell pair (II, JJ): the block itself
+# plus the bodies of the integrals it calls
+def update_operations(lc : L, II : L, JJ : L, dest : str, engine : str=None) -> int:
+    block = Statements(printing.generate_updates(lc, II, JJ, dest, engine=engine))
+    called = printing.referenced_integrals(str(block))
+    return arithmetic_operations(block) + sum([integral_operations(abc) for abc in called])
+
+def shell_class(abc : ABC) -> Tuple[L, L, L]:
+    return tuple([sum(n) for n in abc])
+
+def class_name(ls : Sequence[L]) -> str:
+    return "".join([gauss.orbital_names[l] for l in ls])
+
+######### Benchmarks ###########
+
+# Times every integral up to max_l, summed per shell class (la, lb, lc). ns/call is the time to evaluate all
+# the integrals of the class at one point.
+def bench_integrals(compiled : jit.JITIntegrals, max_l : L, samples : int=default_samples,
+                    repeats : int=default_repeats, instructions : Dict[str, int]=None) -> List[dict]:
+    if instructions is None:
+        instructions = {}
+    GA, GB, GC, Z = random_arguments(samples)
+    classes = {}
+    for abc in gauss.generate_triples(max_l):
+        classes.setdefault(shell_class(abc), []).append(abc)
+    # aliases (see printing.integral_aliases) are inlined forwards to the integral they copy
+    aliases = printing.integral_aliases([abc for abcs in classes.values() for abc in abcs])
+    def function_instructions(abc):
+        return instructions.get(gauss.abc_to_funcname(aliases[abc][0] if abc in aliases else abc), 0)
+    results = []
+    for ls, abcs in sorted(classes.items()):
+        seconds = sum([best_time(lambda: compiled.eval_integrals([abc], GA, GB, GC, Z), repeats) for abc in abcs])
+        operations = sum([integral_operations(abc) for abc in abcs])
+        results.append({"class" : class_name(ls), "functions" : len(abcs),
+                        "ns_per_call" : seconds / samples * 1e9,
+                        "flops_per_call" : operations,
+                        "gflops" : operations * samples / seconds / 1e9,
+                        "instructions" : sum([function_instructions(abc) for abc in abcs]) if instructions else None})
+    return results
+
+# Times the update function of multipole order lc on every shell pair up to max_l. Every call adds one
+# primitive pair into the same block of the outputs, so the outputs stay in cache. The instructions are
+# those of the whole update function, which holds every shell pair, so they are reported once in benchmark.
+def bench_updates(compiled : jit.JITIntegrals, funcname : str, max_l : L, samples : int=default_samples,
+                  repeats : int=default_repeats, engine : str=None) -> List[dict]:
+    lc, dest = compiled.updates[funcname]
+    GA, GB, GC, Z = random_arguments(samples)
+    factor = np.ones(samples)
+    zeros = np.zeros(samples, dtype=np.intc)
+    out = np.zeros((printing.NFS[lc], printing.NFS[max_l], printing.NFS[max_l]))
+    results = []
+    for II, JJ in printing.shell_pairs(max_l):
+        seconds = best_time(lambda: compiled.update(funcname, II, JJ, zeros, zeros, GA, GB, GC, Z, factor, out), repeats)
+        operations = update_operations(lc, II, JJ, dest, engine)
+        results.append({"class" : class_name([II, JJ, lc]), "functions" : 1,
+                        "ns_per_call" : seconds / samples * 1e9,
+                        "flops_per_call" : operations,
+                        "gflops" : operations * samples / seconds / 1e9,
+                        "instructions" : None})
+    return results
+
+# Compiles the integrals up to max_l (derived with engine) and the update function of order lc (with kernel_engine)
+# and benchmarks both. Derived integrals are kept in the same cache as main.py.
+def benchmark(max_l : L, lc : L=1, compiler : str=None, flags : List[str]=None, samples : int=default_samples,
+              repeats : int=default_repeats, engine : str="os", kernel_engine : str=None, cache_dir : str=None) -> dict:
+    if cache_dir is None:
+        cache_dir = jit.default_cache_dir
+    integrals.registry.use_engine(engine)
+    cache = integrals.cache_filename(cache_dir, engine)
+    integrals.registry.load(cache)
+    max_l = max(max_l, lc) # the jit only compiles integrals with every orbital up to max_l
+    funcname = "Bench"
+    compiled = jit.JITIntegrals(max_l, [(lc, "M", funcname)], compiler, flags, cache_dir, kernel_engine)
+    integrals.registry.save(cache)
+    instructions = instruction_counts(compiled.lib._name)
+    config = {"compiler" : compiler or jit.default_compiler, "flags" : flags or jit.default_flags,
+              "max_l" : max_l, "lc" : lc, "engine" : engine, "kernel_engine" : kernel_engine,
+              "samples" : samples, "repeats" : repeats, "machine" : platform.machine(), "processor" : platform.processor()}
+    return {"config" : config,
+            "integrals" : bench_integrals(compiled, max_l, samples, repeats, instructions),
+            "updates" : bench_updates(compiled, funcname, max_l, samples, repeats, kernel_engine),
+            "update_instructions" : instructions.get(f"update{funcname}") if instructions else None}
+
+def format_results(results : dict) -> str:
+    config = results["config"]
+    lines = ["{} {} (engine {}, kernel engine {})".format(config["compiler"], " ".join(config["flags"]),
+                                                           config["engine"], config["kernel_engine"])]
+    for kind in ["integrals", "updates"]:
+        lines.append("{:<10} {:>9} {:>12} {:>9} {:>9} {:>13}".format(kind, "functions", "ns/call", "flops", "GFLOP/s", "instructions"))
+        for r in results[kind]:
+            lines.append("{:<10} {:>9} {:>12.2f} {:>9} {:>9.2f} {:>13}".format(r["class"], r["functions"], r["ns_per_call"],
+                                                                             r["flops_per_call"], r["gflops"],
+                                                                             "-" if r["instructions"] is None else r["instructions"]))
+    lines.append("update function instructions: {}".format(results["update_instructions"]))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the generated CPU integral and update functions')
+    parser.add_argument('L', type=int, help='Maximum angular momentum to benchmark')
+    parser.add_argument('--lc', type=int, default=1, help='Multipole order of the benchmarked update function')
+    parser.add_argument('--compiler', default=None, help='C++ compiler (default: $CXX or g++)')
+    parser.add_argument('--flags', default=None, help='Compiler flags, e.g. "-O3 -march=native" (default: -O2)')
+    parser.add_argument('--samples', type=int, default=default_samples, help='Calls per timed batch')
+    parser.add_argument('--repeats', type=int, default=default_repeats, help='Timed batches, the best one is reported')
+    parser.add_argument('--engine', choices=integrals.engine_names, default="os",
+                        help='Derivation of the integral functions')
+    parser.add_argument('--kernel-engine', choices=integrals.engine_names, default=None,
+                        help='Engine of the update function, instead of calling the integral functions')
+    parser.add_argument('-o', '--output', default=None, help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    flags = None if args.flags is None else args.flags.split()
+    results = benchmark(args.L, args.lc, args.compiler, flags, args.samples, args.repeats, args.engine, args.kernel_engine)
+    print(format_results(results))
+    if args.output is not None:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
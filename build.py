@@ -0,0 +1,258 @@
+# Build graph for generation runs.
+# A run is a list of targets (integral shards, headers, update kernels), each producing one or more files.
+# The integrals the targets need are pooled, so every integral is derived once no matter how many targets use it,
+# and derived on a pool of worker processes. Targets are generated on the same workers as soon as their integrals
+# and dependencies are ready, and files are written from a thread pool so that I/O overlaps with generation.
+# The report gives the time of every step and the critical path, which bounds the time of the whole run.
+
+import os
+import time
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import gaussians as gauss
+from gaussians import L, ABC # types
+from metacode import Value, Precision, double_precision
+import printing
+import integrals
+from integrals import registry_for
+
+# generate(*args) runs in a worker process, so generate has to be a module level function and args have to
+# pickle (no closures or lambdas).
+@dataclass
+class Target:
+    name : str
+    generate : Callable[..., Dict[str, str]] # {filename : contents}, run once the integrals are in the registry
+    integrals : Sequence[ABC] = () # integrals that have to be derived before generate runs
+    deps : Sequence[str] = () # names of targets that have to finish first
+    engine : str = None # engine the integrals are derived with (see integrals.registry_for), None is the default
+    args : tuple = () # arguments of generate
+    write : bool = True # False for targets whose result is data for the caller (BuildReport.results), not files
+
+@dataclass
+class Step:
+    name : str
+    start : float
+    end : float
+    deps : List[str] = field(default_factory=list)
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+@dataclass
+class BuildReport:
+    steps : Dict[str, Step]
+    files : List[str]
+    results : Dict[str, object] = field(default_factory=dict) # of the targets that don't write files
+    @property
+    def total(self) -> float:
+        return max([step.end for step in self.steps.values()], default=0.)
+
+    # Chain of steps that ends last, where every step waited on the dependency that finished last
+    def critical_path(self) -> List[Step]:
+        if not self.steps:
+            return []
+        step = max(self.steps.values(), key=lambda s: s.end)
+        path = [step]
+        while step.deps:
+            step = max([self.steps[d] for d in step.deps], key=lambda s: s.end)
+            path.append(step)
+        return path[::-1]
+
+    def __str__(self):
+        lines = ["{:<40} {:>9} {:>9}".format("step", "start", "time")]
+        for step in sorted(self.steps.values(), key=lambda s: s.start):
+            lines.append("{:<40} {:>8.2f}s {:>8.2f}s".format(step.name, step.start, step.duration))
+        path = self.critical_path()
+        lines.append("critical path: {} ({:.2f}s of {:.2f}s)".format(" -> ".join([s.name for s in path]),
+                                                                     sum([s.duration for s in path]), self.total))
+        return "\n".join(lines)
+
+
+######### Integral work ###########
+
+# Runs in a worker process. The engine is passed by name, since the worker doesn't share the registries
+# of the main process. The derived integrals (with their canonical forms, for deduplication) are sent back
+# to seed the registry of the main process.
+def derive_integrals(abcs : Sequence[ABC], engine : str) -> List[Tuple[ABC, str, Value, Tuple]]:
+    registry = registry_for(engine)
+    return [(abc, registry.code(abc), registry[abc], registry.canonical(abc)) for abc in abcs]
+
+# Runs a target in a worker process. The worker has registries of its own, so the integrals of the target
+# are seeded from the main process first, along with the engine of the default registry.
+def generate_target(generate : Callable[..., Dict[str, str]], args : tuple, default_engine : str, engine : str,
+                    seed : List[Tuple[ABC, str, Value, Tuple]]):
+    integrals.registry.use_engine(default_engine)
+    registry = registry_for(engine)
+    for abc, code, value, canonical in seed:
+        registry.codes[abc] = code
+        if value is not None:
+            registry.values[abc] = value
+        if canonical is not None:
+            registry.canonicals[abc] = canonical
+    return generate(*args)
+
+# The integrals of a target in the registry of the main process, as generate_target seeds them
+def target_seed(target : Target) -> List[Tuple[ABC, str, Value, Tuple]]:
+    registry = registry_for(target.engine)
+    return [(abc, registry.codes[abc], registry.values.get(abc), registry.canonicals.get(abc))
+            for abc in target.integrals if abc in registry.codes]
+
+# Splits the integrals that still have to be derived into at most jobs chunks per engine, as (engine, chunk).
+# Integrals are dealt out in order of angular momentum so every chunk gets a similar mix of cheap and
+# expensive ones. The memoized recursion lives in each worker, so lower integrals are only derived
+# once per worker.
+def integral_chunks(targets : Sequence[Target], jobs : int) -> List[Tuple[str, List[ABC]]]:
+    needed = {}
+    for target in targets:
+        registry = registry_for(target.engine)
+        abcs = needed.setdefault(registry.engine, [])
+        abcs += [abc for abc in target.integrals if abc not in registry.canonicals and abc not in abcs]
+    chunks = []
+    for engine, abcs in needed.items():
+        abcs.sort(key=lambda abc: (sum([sum(n) for n in abc]), abc))
+        chunks += [(engine, abcs[i::jobs]) for i in range(jobs) if abcs[i::jobs]]
+    return chunks
+
+
+######### Scheduling ###########
+
+def write_files(output_dir : str, files : Dict[str, str]) -> List[str]:
+    filenames = []
+    for filename, contents in files.items():
+        filename = os.path.join(output_dir, filename)
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with open(filename, 'w') as file:
+            file.write(contents)
+        filenames.append(filename)
+    return filenames
+
+async def build_async(targets : Sequence[Target], output_dir : str=".", jobs : int=None,
+                      executor : Executor=None) -> BuildReport:
+    names = [target.name for target in targets]
+    if len(set(names)) != len(names):
+        raise ValueError("Target names have to be unique: {}".format(names))
+    for target in targets:
+        for dep in target.deps:
+            if dep not in names:
+                raise ValueError("Target {} depends on unknown target {}".format(target.name, dep))
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    loop = asyncio.get_running_loop()
+    t0 = time.perf_counter()
+    steps : Dict[str, Step] = {}
+    files : List[str] = []
+    results : Dict[str, object] = {}
+    tasks : Dict[str, asyncio.Task] = {}
+
+    # Runs func in pool once the tasks in wait are done. pool None is the default thread pool, for file
+    # writes and for generation without workers. deps are the steps the step waited on, for the critical path.
+    async def run_step(name : str, deps : List[str], wait : List[str], pool : Executor, func, *args):
+        await asyncio.gather(*[tasks[d] for d in wait])
+        start = time.perf_counter() - t0
+        result = await loop.run_in_executor(pool, func, *args)
+        steps[name] = Step(name, start, time.perf_counter() - t0, deps)
+        return result
+
+    async def derive(name : str, engine : str, chunk : List[ABC]):
+        registry = registry_for(engine)
+        for abc, code, value, canonical in await run_step(name, [], [], executor, derive_integrals, chunk, engine):
+            registry.codes[abc] = code
+            registry.values[abc] = value
+            registry.canonicals[abc] = canonical
+
+    chunk_of = {}
+    for i, (engine, chunk) in enumerate(integral_chunks(targets, jobs)):
+        name = f"integrals[{i}]"
+        tasks[name] = asyncio.ensure_future(derive(name, engine, chunk))
+        chunk_of.update({(engine, abc) : name for abc in chunk})
+
+    async def build_target(target : Target):
+        # dependent targets wait for the whole task, so they can rely on the files being written
+        engine = registry_for(target.engine).engine
+        wait = sorted(set([chunk_of[(engine, abc)] for abc in target.integrals if (engine, abc) in chunk_of]))
+        deps = list(target.deps) + wait
+        if executor is None: # threads share the registries
+            contents = await run_step(target.name, deps, deps, None, target.generate, *target.args)
+        else:
+            await asyncio.gather(*[tasks[d] for d in deps])
+            contents = await run_step(target.name, deps, [], executor, generate_target, target.generate, target.args,
+                                      integrals.registry.engine, engine, target_seed(target))
+        if not target.write:
+            results[target.name] = contents
+            return
+        write = run_step(f"write {target.name}", [target.name], [], None, write_files, output_dir, contents)
+        files.extend(await write)
+
+    # targets are started in dependency order, so every dependency has a task by the time it is awaited
+    pending = list(targets)
+    while pending:
+        ready = [t for t in pending if all([d in tasks for d in t.deps])]
+        if not ready:
+            raise ValueError("Dependency cycle between targets {}".format([t.name for t in pending]))
+        for target in ready:
+            tasks[target.name] = asyncio.ensure_future(build_target(target))
+            pending.remove(target)
+    await asyncio.gather(*tasks.values())
+    return BuildReport(steps, files, results)
+
+# Builds the targets into output_dir with up to jobs worker processes deriving integrals and generating
+def build(targets : Sequence[Target], output_dir : str=".", jobs : int=None) -> BuildReport:
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs == 1:
+        return asyncio.run(build_async(targets, output_dir, jobs))
+    with ProcessPoolExecutor(jobs) as executor:
+        return asyncio.run(build_async(targets, output_dir, jobs, executor))
+
+
+######### Targets ###########
+
+# The integral header and the integrals up to max_l split over shards source files,
+# named base_filename.h and base_filename.cpp (or base_filename_0.cpp, base_filename_1.cpp, ...).
+# Without dedup the header only needs the function names, so it doesn't wait for any integral.
+# With dedup, which integrals are aliases depends on all of them, so every file waits for all the integrals
+# and the shards split the integrals that keep a body.
+# engine is the derivation of the integrals, None for the default one.
+def integral_targets(base_filename : str, disclaimer_text : str, max_l : L, shards : int=1,
+                     precision : Precision=double_precision, abcs : Sequence[ABC]=None,
+                     dedup : bool=True, engine : str=None) -> List[Target]:
+    if abcs is None:
+        abcs = list(gauss.generate_triples(max_l))
+    abcs = list(abcs)
+    h_filename = f"{base_filename}.h"
+    targets = [Target(h_filename, integral_header, abcs if dedup else (), engine=engine,
+                      args=(h_filename, disclaimer_text, abcs, precision, dedup, engine))]
+    for i in range(shards):
+        c_filename = f"{base_filename}.cpp" if shards == 1 else f"{base_filename}_{i}.cpp"
+        targets.append(Target(c_filename, integral_source, abcs if dedup else abcs[i::shards], engine=engine,
+                              args=(c_filename, h_filename, disclaimer_text, max_l, i, shards, precision, abcs, dedup, engine)))
+    return targets
+
+def integral_aliases(abcs : Sequence[ABC], dedup : bool, engine : str) -> Dict[ABC, ABC]:
+    return printing.integral_aliases(abcs, engine) if dedup else {}
+
+def integral_header(h_filename : str, disclaimer_text : str, abcs : Sequence[ABC], precision : Precision,
+                    dedup : bool, engine : str) -> Dict[str, str]:
+    aliases = integral_aliases(abcs, dedup, engine)
+    return {h_filename : printing.generate_integral_header(h_filename, disclaimer_text, abcs, precision, aliases)}
+
+# Shard i of the integrals that keep a body
+def integral_source(c_filename : str, h_filename : str, disclaimer_text : str, max_l : L, i : int, shards : int,
+                    precision : Precision, abcs : Sequence[ABC], dedup : bool, engine : str) -> Dict[str, str]:
+    aliased = set(integral_aliases(abcs, dedup, engine))
+    shard = [abc for abc in abcs if abc not in aliased][i::shards]
+    _, c_string = printing.generate_integral_files(h_filename, disclaimer_text, max_l, precision, shard,
+                                                   dedup=False, engine=engine)
+    return {c_filename : c_string}
+
+# A single generated function (e.g. printing.generate_update_func_gpu(...)) written to filename
+def function_target(filename : str, generate : Callable[..., str], args : tuple=(), integrals : Sequence[ABC]=(),
+                    deps : Sequence[str]=()) -> Target:
+    return Target(filename, function_file, integrals, deps, args=(filename, generate, args))
+
+def function_file(filename : str, generate : Callable[..., str], args : tuple) -> Dict[str, str]:
+    return {filename : str(generate(*args))}
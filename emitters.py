@@ -0,0 +1,508 @@
+# Printers of the generated metacode in other languages.
+# The integral functions (printing.generate_integral_functions) and update functions (printing.update_function)
+# are built once as metacode and printed by an emitter per language: C++, CUDA, OpenCL C and Fortran.
+# Code written out as C strings inside the metacode (like the dscale definition) is translated by the
+# emitter, so it has to stick to identifiers, numbers, arithmetic and calls.
+# The GPU languages also print the kernel entry point of the update functions (printing.update_kernel).
+# Every language can be checked by compiling it for the CPU with the local compilers (see check): CUDA and
+# OpenCL C through a prelude that stands in for their qualifiers and vector types, Fortran with gfortran.
+
+import os
+import re
+import abc
+import shutil
+import argparse
+import tempfile
+import textwrap
+import subprocess
+from typing import Dict, List, Sequence
+
+from gaussians import L # types
+import integrals
+import printing
+from metacode import *
+
+######### Emitters ###########
+
+# Prints values of any language from hooks for the parts that differ
+class Emitter(abc.ABC):
+    language = None
+    extension = None
+    compiler = None # local compiler that check uses
+    prelude = None # header check includes in front of the source
+    kernel_qualifiers = None # in front of kernel entry points, None in languages without kernels
+
+    def __init__(self, precision : Precision=double_precision):
+        self.precision = precision
+
+    def value(self, val) -> str:
+        if isinstance(val, str):
+            return self.snippet(val)
+        elif isinstance(val, Element):
+            return self.element(val.array.name, [self.value(i) for i in val.indices])
+        elif isinstance(val, Constant):
+            return self.constant(str(val.name))
+        elif isinstance(val, Variable):
+            return self.variable(str(val.name))
+        elif isinstance(val, Parens):
+            return "({})".format(self.value(val.val))
+        elif isinstance(val, Cast):
+            return self.cast(val.typename, self.value(val.val))
+        elif isinstance(val, Call):
+            return self.call(val.name, [self.value(a) for a in val.args])
+        elif isinstance(val, OpTree):
+            if val.right is None:
+                return self.unary(self.operator(val.op), self.value(val.left))
+            return "{} {} {}".format(self.value(val.left), self.operator(val.op), self.value(val.right))
+        elif isinstance(val, Condition):
+            if val.op is None:
+                return self.value(val.var)
+            elif val.var2 is None:
+                return "{}({})".format(self.operator(val.op), self.value(val.var))
+            return "{} {} {}".format(self.value(val.var), self.operator(val.op), self.value(val.var2))
+        raise ValueError("Can't emit {} of type {} in {}".format(val, type(val).__name__, self.language))
+
+    # code written out as a C string
+    def snippet(self, s : str) -> str:
+        return s
+    def constant(self, name : str) -> str:
+        return name
+    def variable(self, name : str) -> str:
+        return name
+    def operator(self, op : Operator) -> str:
+        return op.symbol
+    def unary(self, op : str, val : str) -> str:
+        return op + val
+    def cast(self, typename : str, val : str) -> str:
+        return f"({typename})({val})"
+    def call(self, name : str, args : List[str]) -> str:
+        return "{}({})".format(name, ", ".join(args))
+    def element(self, name : str, indices : List[str]) -> str:
+        return name + "".join(["[{}]".format(i) for i in indices])
+
+    @abc.abstractmethod
+    def function(self, function : Function) -> str:
+        pass
+    # One source file with the functions, definitions before uses, and then the kernel entry points.
+    # name names the unit (the Fortran module).
+    @abc.abstractmethod
+    def source(self, functions : Sequence[Function], name : str, disclaimer_text : str=None,
+               kernels : Sequence[Function]=()) -> str:
+        pass
+
+
+######### C family ###########
+
+# C++, like the rest of the generated code, so printing a function gives the same as str(function)
+class CppEmitter(Emitter):
+    language = "C++"
+    extension = "cpp"
+    compiler = "g++"
+    qualifiers = "" # in front of every function
+
+    def type(self, typename : str) -> str:
+        return typename
+    def params(self, function : Function) -> List[str]:
+        return ["{} {}".format(self.type(p.typename), p.name) for p in function.params]
+
+    def statement(self, statement) -> List[str]:
+        if isinstance(statement, str):
+            return [statement]
+        elif isinstance(statement, Empty):
+            return []
+        elif isinstance(statement, If):
+            head = "{}if ({}) {{".format("else " if statement.has_else else "", self.value(statement.condition))
+            return [head] + self.indent(self.statements(statement.body)) + ["}"]
+        elif isinstance(statement, Container) and statement.args is None: # else
+            return ["{} {{".format(statement.name.strip())] + self.indent(self.statements(statement.body)) + ["}"]
+        elif isinstance(statement, For):
+            control = [self.statement(statement.initial_statement)[0].rstrip(";"), self.value(statement.condition),
+                       self.statement(statement.update_statement)[0].rstrip(";")]
+            head = "for ({}) {{".format("; ".join(control))
+            return [head] + self.indent(self.statements(statement.body)) + ["}"]
+        elif isinstance(statement, Assignment):
+            lhs = self.value(statement.var)
+            if statement.declare:
+                lhs = "{} {}".format(self.type(statement.var.typename), lhs)
+            return ["{} = {};".format(lhs, self.value(statement.rhs))]
+        elif isinstance(statement, Update):
+            if statement.val is None:
+                return ["{}{};".format(self.value(statement.var), statement.op)]
+            return ["{} {} {};".format(self.value(statement.var), statement.op, self.value(statement.val))]
+        elif isinstance(statement, Return):
+            if statement.returned is None:
+                return ["return;"]
+            return ["return {};".format(self.value(statement.returned))]
+        elif isinstance(statement, Call):
+            return [self.value(statement) + ";"]
+        raise ValueError("Can't emit {} in {}".format(type(statement).__name__, self.language))
+
+    def statements(self, statements : Statements) -> List[str]:
+        lines = []
+        for statement in Statements(statements).statements:
+            lines += self.statement(statement)
+        return lines
+    def indent(self, lines : List[str]) -> List[str]:
+        return [tab + line for line in lines]
+
+    def function(self, function : Function, qualifiers : str=None) -> str:
+        if qualifiers is None:
+            qualifiers = self.qualifiers
+        head = "{}{} {}({}) {{".format(qualifiers, self.type(function.typename), function.funcname,
+                                       ", ".join(self.params(function)))
+        return "\n".join([head] + self.indent(self.statements(function.body)) + ["}"])
+    def kernel(self, function : Function) -> str:
+        if self.kernel_qualifiers is None:
+            raise ValueError("{} has no kernels".format(self.language))
+        return self.function(function, self.kernel_qualifiers)
+
+    def includes(self) -> List[Macro]:
+        return [Include("cmath", False), Include("vector_types.h", False)]
+    def source(self, functions : Sequence[Function], name : str, disclaimer_text : str=None,
+               kernels : Sequence[Function]=()) -> str:
+        disclaimer = None if disclaimer_text is None else printing.generate_disclaimer(disclaimer_text)
+        body = ["\n\n".join([self.function(f) for f in functions] + [self.kernel(f) for f in kernels])]
+        return str(generate_c_file(body, disclaimer=disclaimer, includes=self.includes())) + "\n"
+
+# CUDA: the functions can be called from kernels and from the host
+class CudaEmitter(CppEmitter):
+    language = "CUDA"
+    extension = "cu"
+    qualifiers = "__host__ __device__ "
+    kernel_qualifiers = "__global__ "
+    prelude = """
+#define __host__
+#define __device__
+#define __global__
+static const struct { unsigned int x, y, z; } blockIdx = {0, 0, 0}, blockDim = {1, 1, 1}, threadIdx = {0, 0, 0};
+"""
+
+    def call(self, name : str, args : List[str]) -> str:
+        if name == "global_id":
+            return "blockIdx.x*blockDim.x + threadIdx.x"
+        return super(CudaEmitter, self).call(name, args)
+
+# OpenCL C: the vector types are built in and the math functions are overloaded, so float code calls sqrt
+# instead of sqrtf. The output matrices are flat nbf x nbf arrays in global memory, since OpenCL doesn't
+# allow pointers to pointers into global memory, and the functions that take them also take nbf.
+# Pointers point to global memory, and the host passes the vectors of the kernel as cl_double3 or cl_float3.
+class OpenCLEmitter(CppEmitter):
+    language = "OpenCL C"
+    extension = "cl"
+    compiler = "gcc"
+    kernel_qualifiers = "__kernel "
+    prelude = """
+#include <math.h>
+#include <stddef.h>
+#define __kernel
+#define __global
+typedef struct { double x, y, z; } double3;
+typedef struct { float x, y, z; } float3;
+static size_t get_global_id(unsigned int dim) { return 0; }
+"""
+
+    def value(self, val) -> str:
+        if isinstance(val, Call) and any([isinstance(a, Variable) and str(a.typename).endswith("**") for a in val.args]):
+            return self.call(val.name, [self.value(a) for a in val.args] + ["nbf"])
+        return super(OpenCLEmitter, self).value(val)
+    def snippet(self, s : str) -> str:
+        return re.sub(r"\b({})f\(".format("|".join(math_functions)), r"\1(", s)
+    def call(self, name : str, args : List[str]) -> str:
+        if name == "global_id":
+            return "(int)get_global_id(0)"
+        if name.endswith("f") and name[:-1] in math_functions:
+            name = name[:-1]
+        return super(OpenCLEmitter, self).call(name, args)
+    def element(self, name : str, indices : List[str]) -> str:
+        if len(indices) == 2:
+            return "{}[({})*nbf + {}]".format(name, *indices)
+        return super(OpenCLEmitter, self).element(name, indices)
+
+    def params(self, function : Function) -> List[str]:
+        params = []
+        for p in function.params:
+            if p.typename.endswith("**"):
+                params.append("__global {} *{}".format(p.typename.rstrip(" *"), p.name))
+            elif p.typename.endswith("*"):
+                params.append("__global {} {}".format(p.typename, p.name))
+            else:
+                params.append("{} {}".format(p.typename, p.name))
+        if any([p.typename.endswith("**") for p in function.params]):
+            params.append("int nbf")
+        return params
+
+    def includes(self) -> List[Macro]:
+        if "double" in [self.precision.real, self.precision.accumulate]:
+            return [Macro("pragma", ["OPENCL EXTENSION cl_khr_fp64 : enable"])]
+        return []
+
+
+######### Fortran ###########
+
+fortran_line_width = 100 # the standard allows 132
+
+# C types as interoperable Fortran types
+fortran_types = {"double" : "real(c_double)", "float" : "real(c_float)", "int" : "integer(c_int)",
+                 "double3" : "type(double3)", "float3" : "type(float3)"}
+fortran_kinds = {"double" : "c_double", "float" : "c_float", "int" : "c_int"}
+fortran_operators = {"&&" : ".and.", "||" : ".or.", "!" : ".not.", "!=" : "/="}
+
+# Free form Fortran 2008 in a module. Every function has a C binding, so the module can also be linked from
+# C and C++. The integrals are pure functions and the update functions pure subroutines, with the output
+# matrices as nbf x nbf arrays indexed from 0. Elements are indexed in reverse, Dx(J+mj, I+mi), so that
+# column major storage puts them where the other languages do, at Dx[I+mi][J+mj] of a C caller.
+class FortranEmitter(Emitter):
+    language = "Fortran"
+    extension = "f90"
+    compiler = "gfortran"
+
+    def type(self, typename : str) -> str:
+        if typename not in fortran_types:
+            raise ValueError("No Fortran type for {}".format(typename))
+        return fortran_types[typename]
+
+    # C literals get a kind, 1.5f -> 1.5_c_float and 1.5 -> 1.5_c_double
+    def literals(self, s : str) -> str:
+        def kind(match):
+            return "{}_{}".format(match.group(1), "c_float" if match.group(2) else "c_double")
+        return re.sub(r"(?<![\w.])(\d+\.\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?|\d+[eE][-+]?\d+)(f?)(?![\w.])", kind, s)
+    def snippet(self, s : str) -> str:
+        s = re.sub(r"\b({})f\(".format("|".join(math_functions)), r"\1(", s)
+        s = re.sub(r"\bfabs\(", "abs(", s)
+        return self.variable(self.literals(s))
+    # Fortran doesn't allow a sign right after another operator, a * -2 has to be a * (-2)
+    def constant(self, name : str) -> str:
+        name = self.literals(name)
+        return "({})".format(name) if name.startswith("-") else name
+    def unary(self, op : str, val : str) -> str:
+        return "({} {})".format(op, val) if op.startswith(".") else "({}{})".format(op, val)
+    # GA.x -> GA%x
+    def variable(self, name : str) -> str:
+        return re.sub(r"\b([A-Za-z_]\w*)\.(?=[A-Za-z_])", r"\1%", name)
+    def operator(self, op : Operator) -> str:
+        return fortran_operators.get(op.symbol, op.symbol)
+    def cast(self, typename : str, val : str) -> str:
+        return "{}({}, {})".format("int" if typename == "int" else "real", val, fortran_kinds[typename])
+    def call(self, name : str, args : List[str]) -> str:
+        if name.endswith("f") and name[:-1] in math_functions:
+            name = name[:-1]
+        if name == "pow":
+            return "({})**({})".format(*args)
+        if name == "fabs":
+            name = "abs"
+        if name == "fmax":
+            name = "max"
+        return super(FortranEmitter, self).call(name, args)
+    # C indices, Fortran is column major
+    def element(self, name : str, indices : List[str]) -> str:
+        return "{}({})".format(name, ", ".join(indices[::-1]))
+
+    def statement(self, statement, result : str=None) -> List[str]:
+        if isinstance(statement, str):
+            return ["! " + line.strip() for line in statement.split("\n") if line.strip()]
+        elif isinstance(statement, Empty):
+            return []
+        elif isinstance(statement, If):
+            head = "{}if ({}) then".format("else " if statement.has_else else "", self.value(statement.condition))
+            return [head] + self.indent(self.statements(statement.body, result))
+        elif isinstance(statement, Container) and statement.args is None: # else
+            return ["else"] + self.indent(self.statements(statement.body, result))
+        elif isinstance(statement, Assignment):
+            return ["{} = {}".format(self.value(statement.var), self.value(statement.rhs))]
+        elif isinstance(statement, Update):
+            var = self.value(statement.var)
+            if statement.val is None: # ++ and --
+                return ["{0} = {0} {1} 1".format(var, statement.op.symbol[0])]
+            val = self.value(statement.val)
+            if statement.op != Op.PLUSEQ:
+                val = "({})".format(val)
+            return ["{0} = {0} {1} {2}".format(var, statement.op.symbol[0], val)]
+        elif isinstance(statement, Return):
+            if statement.returned is None:
+                return ["return"]
+            return ["{} = {}".format(result, self.value(statement.returned)), "return"]
+        elif isinstance(statement, Call):
+            return ["call " + self.value(statement)]
+        raise ValueError("Can't emit {} in {}".format(type(statement).__name__, self.language))
+
+    # Chains of if and else if are closed after their last branch
+    def statements(self, statements : Statements, result : str=None) -> List[str]:
+        statements = Statements(statements).statements
+        lines = []
+        for i, statement in enumerate(statements):
+            lines += self.statement(statement, result)
+            if isinstance(statement, If) or (isinstance(statement, Container) and statement.args is None):
+                following = statements[i+1] if i+1 < len(statements) else None
+                continued = isinstance(following, If) and following.has_else
+                continued |= isinstance(following, Container) and following.args is None
+                if not continued:
+                    lines.append("end if")
+        return lines
+    def indent(self, lines : List[str]) -> List[str]:
+        return [tab + line for line in lines]
+
+    # Fortran declares every local at the start, so the declarations of the whole body are gathered
+    def locals(self, statements : Statements) -> List[Variable]:
+        found = []
+        for statement in Statements(statements).statements:
+            if isinstance(statement, Assignment) and statement.declare:
+                found.append(statement.var)
+            elif isinstance(statement, Container):
+                found += self.locals(statement.body)
+        declared = {}
+        for var in found:
+            if declared.setdefault(var.name, var.typename) != var.typename:
+                raise ValueError("{} is declared as both {} and {}".format(var.name, declared[var.name], var.typename))
+        return [Variable(name, typename) for name, typename in declared.items()]
+
+    def declarations(self, function : Function, result : str) -> List[str]:
+        matrices = [p for p in function.params if p.typename.endswith("**")]
+        lines = ["integer(c_int), value :: nbf"] if matrices else []
+        for p in function.params:
+            if p in matrices:
+                lines.append("{}, intent(inout) :: {}(0:nbf-1, 0:nbf-1)".format(self.type(p.typename.rstrip(" *")), p.name))
+            else:
+                lines.append("{}, value :: {}".format(self.type(p.typename), p.name))
+        if result is not None:
+            lines.append("{} :: {}".format(self.type(function.typename), result))
+        locals_by_type = {}
+        for var in self.locals(function.body):
+            locals_by_type.setdefault(var.typename, []).append(var.name)
+        for typename, names in locals_by_type.items():
+            for i in range(0, len(names), 8):
+                lines.append("{} :: {}".format(self.type(typename), ", ".join(names[i:i+8])))
+        return lines
+
+    def function(self, function : Function) -> str:
+        names = [p.name for p in function.params]
+        if any([p.typename.endswith("**") for p in function.params]):
+            names.append("nbf")
+        args = ", ".join(names)
+        binding = 'bind(C, name="{}")'.format(function.funcname)
+        if function.typename == "void":
+            kind, result = "subroutine", None
+            head = "pure subroutine {}({}) {}".format(function.funcname, args, binding)
+        else:
+            kind, result = "function", "r"
+            head = "pure function {}({}) result({}) {}".format(function.funcname, args, result, binding)
+        body = list(function.body.statements)
+        if isinstance(body[-1], Return) and body[-1].returned is not None: # no return needed at the end
+            body[-1] = Assignment(Variable(result), body[-1].returned, declare=False)
+        lines = self.indent(self.declarations(function, result) + self.statements(Statements(body), result))
+        lines = [head] + lines + ["end {} {}".format(kind, function.funcname)]
+        return "\n".join([wrapped for line in lines for wrapped in self.wrap(line)])
+
+    # Splits lines longer than fortran_line_width at spaces into continuation lines
+    def wrap(self, line : str) -> List[str]:
+        if line.lstrip().startswith("!"):
+            return [line]
+        lead = line[:len(line) - len(line.lstrip())] + 2*tab
+        lines = []
+        while len(line) > fortran_line_width:
+            cut = line.rfind(" ", len(lead) + 2, fortran_line_width - 1)
+            if cut < 0:
+                break
+            lines.append(line[:cut] + " &")
+            line = lead + "& " + line[cut+1:]
+        return lines + [line]
+
+    def source(self, functions : Sequence[Function], name : str, disclaimer_text : str=None,
+               kernels : Sequence[Function]=()) -> str:
+        if kernels:
+            raise ValueError("{} has no kernels".format(self.language))
+        lines = []
+        if disclaimer_text is not None:
+            text = " ".join(disclaimer_text.split())
+            lines += ["! " + line for line in textwrap.wrap(text, fortran_line_width - 2)] + [""]
+        vector = self.precision.vector
+        lines += ["module {}".format(name),
+                  "use, intrinsic :: iso_c_binding",
+                  "implicit none",
+                  "",
+                  "type, bind(C) :: {}".format(vector),
+                  "{}{} :: x, y, z".format(tab, self.type(self.precision.real)),
+                  "end type {}".format(vector),
+                  "",
+                  "contains",
+                  ""]
+        lines += [self.function(f) + "\n" for f in functions]
+        lines.append("end module {}".format(name))
+        return "\n".join(lines) + "\n"
+
+emitters = {"cpp" : CppEmitter, "cuda" : CudaEmitter, "opencl" : OpenCLEmitter, "fortran" : FortranEmitter}
+
+# Update function update{funcname} of order lc and the integral functions it calls, printed by emitter,
+# with its kernel entry point in the GPU languages.
+# The integrals have to be in the registry (see build.Target.integrals and printing.referenced_integrals).
+def generate_source(emitter : Emitter, lc : L, dest : str, funcname : str, max_l : L, disclaimer_text : str=None,
+                    **options) -> str:
+    function = printing.update_function(lc, dest, funcname, max_l, precision=emitter.precision, **options)
+    integral_functions = printing.generate_integral_functions(max_l, precision=emitter.precision,
+                                                              abcs=printing.referenced_integrals(function))
+    kernels = []
+    if emitter.kernel_qualifiers is not None:
+        kernels.append(printing.update_kernel(lc, dest, funcname, options.get("screen", False), emitter.precision))
+    return emitter.source(integral_functions + [function], f"{funcname.lower()}_integrals", disclaimer_text, kernels)
+
+
+######### Checking ###########
+
+# Compiles an emitted source for the CPU with the local compiler of its language, to an object file in a
+# temporary directory. Raises subprocess.CalledProcessError with the compiler output if it doesn't compile.
+def check(emitter : Emitter, source : str, compiler : str=None, flags : List[str]=None) -> None:
+    import jit # for the vector_types.h stand-in
+    if compiler is None:
+        compiler = emitter.compiler
+    if flags is None:
+        flags = ["-O0"]
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "source.{}".format(emitter.extension))
+        with open(filename, 'w') as file:
+            file.write(source)
+        with open(os.path.join(directory, "vector_types.h"), 'w') as file:
+            file.write(jit.vector_types_shim)
+        command = [compiler, "-c"] + flags + [f"-I{directory}"]
+        if emitter.prelude is not None:
+            prelude = os.path.join(directory, "prelude.h")
+            with open(prelude, 'w') as file:
+                file.write(emitter.prelude)
+            command += ["-x", "c" if compiler.endswith("gcc") or compiler.endswith("cc") else "c++", "-include", prelude]
+        command += [filename, "-o", os.path.join(directory, "source.o")]
+        subprocess.run(command, check=True, capture_output=True, text=True, cwd=directory)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write an update function and the integrals it calls in other languages')
+    parser.add_argument('L', type=int, help='Maximum angular momentum of the shell pairs')
+    parser.add_argument('--lc', type=int, default=1, help='Multipole order of the update function')
+    parser.add_argument('--languages', nargs='+', choices=list(emitters), default=list(emitters),
+                        help='Languages to emit')
+    parser.add_argument('--precision', choices=list(precisions), default="double",
+                        help='Floating point precision of the emitted code')
+    parser.add_argument('--kernel-engine', choices=integrals.engine_names, default=None,
+                        help='Build the integrals inside the update function with this engine instead of calling them')
+    parser.add_argument('--check', action='store_true',
+                        help='Compile every emitted file for the CPU with the local compilers')
+    parser.add_argument('-o', '--output-dir', default=".", help='Directory to write the emitted files to')
+    args = parser.parse_args()
+
+    import jit
+    cache = integrals.cache_filename(jit.default_cache_dir)
+    integrals.registry.load(cache)
+    os.makedirs(args.output_dir, exist_ok=True)
+    for language in args.languages:
+        emitter = emitters[language](precisions[args.precision])
+        source = generate_source(emitter, args.lc, "M", "Multipole", args.L, engine=args.kernel_engine)
+        filename = os.path.join(args.output_dir, "MultipoleMatrix.{}".format(emitter.extension))
+        with open(filename, 'w') as file:
+            file.write(source)
+        print(filename)
+        if args.check:
+            if shutil.which(emitter.compiler) is None:
+                print("  not checked, {} isn't available".format(emitter.compiler))
+                continue
+            try:
+                check(emitter, source)
+                print("  compiles with {}".format(emitter.compiler))
+            except subprocess.CalledProcessError as error:
+                print("  doesn't compile with {}:\n{}".format(emitter.compiler, error.stderr))
+    integrals.registry.save(cache)
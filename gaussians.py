@@ -34,13 +34,20 @@ def n_to_str(n : N) -> str:
 # str -> N
 def str_to_n(s : str) -> N:
     s = s.lower()
-    prefix = s[0]
+    prefix = s[:1]
     suffix = s[1:]
-    assert prefix in L
-    assert len(suffix) == L.index(prefix)
+    if prefix not in orbital_names or len(suffix) != orbital_names.index(prefix):
+        raise ValueError("'{}' is not an orbital name".format(s))
     counts = [suffix.count(i) for i in "xyz"]
+    if sum(counts) != len(suffix):
+        raise ValueError("'{}' is not an orbital name".format(s))
     return tuple(counts)
 
+# Cartesian components of angular momentum l above d, in the conventional order xxx, xxy, xxz, xyy, ...
+# (d and below keep the TeraChem order in n_to_index/index_to_n)
+def cartesian_components(l : L) -> List[N]:
+    return [(x, y, l-x-y) for x in range(l, -1, -1) for y in range(l-x, -1, -1)]
+
 # N -> I
 def n_to_index(n : N) -> L:
     l = sum(n)
@@ -53,11 +60,13 @@ def n_to_index(n : N) -> L:
             return 2 - n.index(min(n))
         else: # max(n) == 2
             return n.index(max(n)) + 3
+    elif l < len(orbital_names):
+        return cartesian_components(l).index(tuple(n))
     else:
         raise ValueError("L value '{}' is not supported".format(l))
 
 # total angular momentum doesn't have enough information to uniquely specify an orbital,
-# so also need a magnetic quantum number (as long as d is the highest orbital, haha)
+# so also need a magnetic quantum number
 def index_to_n(l : L, m : L) -> N:
     temp = [0,0,0]
     if l == 0:
@@ -71,6 +80,8 @@ def index_to_n(l : L, m : L) -> N:
             temp[hole] = 0
         else:
             temp[m-3] = 2
+    elif l < len(orbital_names):
+        return cartesian_components(l)[m]
     else:
         raise ValueError("L value '{}' is not supported".format(l))
     return tuple(temp)
@@ -85,9 +96,31 @@ def abc_to_funcname(abc : ABC) -> str:
 def funcname_to_abc(name : str) -> ABC:
     abc = [str_to_n(a) for a in name.split('_')]
     abc = tuple(abc)
-    assert len(abc) == 3
+    if len(abc) != 3:
+        raise ValueError("'{}' is not a three body integral name".format(name))
     return abc
 
+def is_funcname(name : str) -> bool:
+    try:
+        funcname_to_abc(name)
+        return True
+    except ValueError:
+        return False
+
+
+# Lowers the angular momentum of orbital ja of abc in direction i (e.g. (a|b|c) -> (a|b|c-1_i))
+def succession(ja : int, i : int, abc : ABC) -> ABC:
+    # convert to a list because tuples are immutable
+    abc2 = [list(a) for a in abc]
+    abc2[ja][i] -= 1
+    return tuple(tuple(a) for a in abc2)
+
+# Raises the angular momentum of orbital ja of abc in direction i (e.g. (a|b|c) -> (a+1_i|b|c))
+def promotion(ja : int, i : int, abc : ABC) -> ABC:
+    abc2 = [list(a) for a in abc]
+    abc2[ja][i] += 1
+    return tuple(tuple(a) for a in abc2)
+
 
 ############## Aggregate Functions ################
 
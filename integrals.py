@@ -1,10 +1,13 @@
 # NOTE: Should only need to import:  print_integral, generate_integrals
 # Implementation of recursive scheme in 
 # S. Obara, A. Saika. J. Chem. Phys. 84, 3963 (1986); https://doi.org/10.1063/1.450106
+# The recursion itself is in symbolic, which is only imported once an integral has to be derived,
+# so importing this module (and printing) doesn't pay for SymPy.
 
-import sympy as sym
-from sympy.printing.c import C99CodePrinter # sympy.printing.c in some versions of sympy
-from typing import Sequence, Tuple
+import os
+import pickle
+import hashlib
+from typing import Dict, Sequence, Tuple, Union
 
 # This module uses the naming convention and data types in gaussians
 import gaussians # for utility functions
@@ -12,70 +15,18 @@ from gaussians import L, N, ABC # for clear types everywhere
 from metacode import Value # for type signature
 from parser import generate_value
 
-# Symbols
-Z = sym.symbols('Z', integer=False) # not sure if integer=False is necessary anymore
-# These are shorthand in the paper and in terachem
-# GA is just G - A, where A is the center of one of the Gaussians and G is a
-#   weighted average of the three Gaussian centers.
-GA = sym.symbols('GAx GAy GAz') # a list of three symbols for three_body_integral() to be clean.
-GB = sym.symbols('GBx GBy GBz')
-GC = sym.symbols('GCx GCy GCz')
-GX = (GA, GB, GC) # Convenient list of all the symbols
-
-# Helper function for three_body_integral() that lowers the angular momentum of an orbital
-def succession(ja : int, i : int, abc : ABC) -> ABC:
-    # convert to a list because tuples are immutable
-    abc2 = [list(a) for a in abc]
-    abc2[ja][i] -= 1
-    return tuple(tuple(a) for a in abc2)
-
-# This is just an implementation of the recursion relation in Equation 20 in the Obara, Saika paper.
-# We use the variable Z = (2(zeta_A + zeta_B + zeta_C))^-1 for brevity.
-# We also use (s|s|s)=1, so that integral needs to be calculated separately.
-zero : N = (0,0,0) # might not need this
-def three_body_integral(abc : ABC):
-    assert all([len(a)==3 for a in abc]) # make sure input is formatted correctly
-    # integral of 3 s orbitals
-    if all([a == zero for a in abc]):
-        return 1
-    # only gets to this in some recursion successions. Returning 0 as a second base case is more elegant than filtering out in the recursive step.
-    if any([any([ax < 0 for ax in a]) for a in abc]):
-        return 0
-    
-#     result = sym.sympify(0) # starts with 0, so that we can add to it and then simplify at the very end.
-    l_values = [sum(n) for n in abc] # list of total angular momenta of the three Gaussians
-    jn = l_values.index(max(l_values)) # the index of the gaussian with the highest total n
-    n = abc[jn] # the gaussian with the highest total n
-    i = n.index(max(n)) # the index of n with the highest value (guaranteed to be nonzero) (e.g. x,y,z)
-    abc2 = succession(jn, i, abc) # returns the gaussian with lowered indices
-    result = GX[jn][i] * three_body_integral(abc2)
-    for jm in range(3):
-        result += Z * abc2[jm][i] * three_body_integral(succession(jm, i, abc2))
-    return sym.simplify(result)
-
-# This class simply prints
-class IntegralPrinter(C99CodePrinter):
-    def _print_Pow(self, expr):
-        exp = expr.exp
-        base = expr.base
-        if exp.is_integer and int(exp) < 10:
-            return "*".join([self._print(base)]*exp)
-        else:
-            return super(C99CodePrinter, self)._print_Pow(expr)
-    def _print_Symbol(self, expr):
-        s = super()._print_Symbol(expr)
-        for x in "xyz":
-            for A in "ABC":
-                GA = f"G{A}"
-                s = s.replace(f"{GA}{x}",f"{GA}.{x}")
-        return s
-
-
-# Abstract away the method by which the code is printed.
-# No one should be calling printer.doprint() directly
-printer = IntegralPrinter() # Singleton class
-def to_code(expr) -> str:
-    return printer.doprint(expr)
+# names of symbolic.engines, without importing it
+engine_names = ["os", "hrr", "md"]
+
+# The symbolic names (three_body_integral, Z, GA, ..., to_code) are still reachable as integrals.<name>,
+# importing SymPy on first access
+symbolic_names = ["three_body_integral", "transfer_integral", "hrr_integral", "hermite_coefficient", "hermite_integral",
+                  "IntegralPrinter", "printer", "to_code", "generate_integral_gradients", "Z", "GA", "GB", "GC", "GX", "zero"]
+def __getattr__(name : str):
+    if name in symbolic_names:
+        import symbolic
+        return getattr(symbolic, name)
+    raise AttributeError("module 'integrals' has no attribute '{}'".format(name))
 
 
 ############### Only the following should need to be exposed ####################
@@ -83,14 +34,109 @@ def to_code(expr) -> str:
 
 # Calculates the algebraic expression for the desired TBI and converts to valid C code
 # Really a helper function for the generate_integral*() functions and/or external callers
-def print_integral(abc : ABC) -> str:
-    integral = three_body_integral(abc)
-    return to_code(integral)
+# engine is the derivation in symbolic.engines: "os" for the Obara-Saika recursion, "hrr" for the vertical
+# recursion on A with the horizontal transfer to B and C, "md" for the McMurchie-Davidson Hermite expansion.
+def print_integral(abc : ABC, engine : str="os") -> str:
+    import symbolic
+    integral = symbolic.engines[engine](abc)
+    return symbolic.to_code(integral)
+
+# Lazily generated integrals, keyed by ABC or by function name (e.g. "S_Px_Dxy").
+# An integral is derived, printed and parsed the first time it is asked for and cached after that,
+# so a single kernel only pays for the integrals it uses instead of a full sweep over max_l.
+# Every integral comes from the same derivation engine (see print_integral).
+class IntegralRegistry:
+    def __init__(self, engine : str="os"):
+        self.engine = engine
+        self.codes : Dict[ABC, str] = {}
+        self.values : Dict[ABC, Value] = {}
+        self.canonicals : Dict[ABC, Tuple[str, Tuple[int, int, int], int]] = {}
+
+    # Switches to another derivation engine, dropping the integrals of the old one
+    def use_engine(self, engine : str) -> None:
+        if engine not in engine_names:
+            raise ValueError("Unknown integral engine '{}', expected one of {}".format(engine, engine_names))
+        if engine != self.engine:
+            self.__init__(engine)
+
+    @staticmethod
+    def key(abc : Union[ABC, str]) -> ABC:
+        if isinstance(abc, str):
+            return gaussians.funcname_to_abc(abc)
+        return tuple(tuple(n) for n in abc)
+
+    # C code of the integral
+    def code(self, abc : Union[ABC, str]) -> str:
+        abc = self.key(abc)
+        if abc not in self.codes:
+            self.codes[abc] = print_integral(abc, self.engine)
+        return self.codes[abc]
+
+    # metacode AST of the integral
+    def __getitem__(self, abc : Union[ABC, str]) -> Value:
+        abc = self.key(abc)
+        if abc not in self.values:
+            self.values[abc] = generate_value(self.code(abc))
+        return self.values[abc]
+
+    # Canonical form of the integral up to a permutation of the centers and a sign (see symbolic.canonical_form)
+    def canonical(self, abc : Union[ABC, str]) -> Tuple[str, Tuple[int, int, int], int]:
+        abc = self.key(abc)
+        if abc not in self.canonicals:
+            import symbolic
+            self.canonicals[abc] = symbolic.canonical_form(self.code(abc))
+        return self.canonicals[abc]
+
+    # only true for integrals that were already generated
+    def __contains__(self, abc : Union[ABC, str]) -> bool:
+        return self.key(abc) in self.values
+    def __len__(self) -> int:
+        return len(self.values)
+
+    # The registry can be kept on disk between runs, so that an integral is only ever derived once
+    def load(self, filename : str) -> None:
+        if os.path.exists(filename):
+            with open(filename, 'rb') as file:
+                codes, values, canonicals = pickle.load(file)
+            self.codes.update(codes)
+            self.values.update(values)
+            self.canonicals.update(canonicals)
+    def save(self, filename : str) -> None:
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        temp_filename = "{}.{}.tmp".format(filename, os.getpid())
+        with open(temp_filename, 'wb') as file:
+            pickle.dump((self.codes, self.values, self.canonicals), file)
+        os.replace(temp_filename, filename) # atomic, so concurrent runs never read half a cache
+
+registry = IntegralRegistry() # Singleton class
+registries : Dict[str, IntegralRegistry] = {}
+
+# Registry of the integrals of an engine, for targets that don't use the engine of registry.
+# None is registry itself.
+def registry_for(engine : str=None) -> IntegralRegistry:
+    if engine is None or engine == registry.engine:
+        return registry
+    if engine not in engine_names:
+        raise ValueError("Unknown integral engine '{}', expected one of {}".format(engine, engine_names))
+    if engine not in registries:
+        registries[engine] = IntegralRegistry(engine)
+    return registries[engine]
+
+# Registry cache file in cache_dir for a derivation engine, named after a hash of the modules the integrals
+# come from, so a change to any of them starts a new cache.
+def cache_filename(cache_dir : str, engine : str="os") -> str:
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for module in ["integrals.py", "symbolic.py", "parser.py", "lexer.py", "metacode.py"]:
+        with open(os.path.join(directory, module), 'rb') as file:
+            digest.update(file.read())
+    return os.path.join(cache_dir, "integrals-{}-{}.pickle".format(engine, digest.hexdigest()[:16]))
 
 # returns a list of all C formatted three body integrals with total angular momentum at most max_l
 # This will take a while for L > 2, so progress is printed.
 # @return list((str, str)) a list of integral function name and actual integral pairs
-def generate_integrals(max_l : L) -> Sequence[Tuple[ABC, Value]]:
+def generate_integrals(max_l : L, engine : str=None) -> Sequence[Tuple[ABC, Value]]:
+    registry = registry_for(engine)
     orbitals = gaussians.generate_orbitals(max_l)
     n = len(orbitals)
     n2 = n*n
@@ -100,26 +146,8 @@ def generate_integrals(max_l : L) -> Sequence[Tuple[ABC, Value]]:
     for abc in gaussians.generate_triples(max_l):
         if i % n2 == 0:
             print("{}%".format(100. * i/n3))
-        integral = print_integral(abc)
-        print(integral)
-        integral = generate_value(integral)
-        yield (abc, integral)
+        print(registry.code(abc))
+        yield (abc, registry[abc])
         i += 1
 
 
-# Gets the gradients of all three body integrals (a|c|b) wrt GC
-# GC is used because C is by convention the coordinate that the integral is evaluated at.
-# In cases where we want the gradient of a 1e integral, C is likely a nuclear coordinate.
-# TODO: Make sure we should be taking the derivative wrt C and not the others.
-def generate_integral_gradients(max_l : L):
-    for abc in gaussians.generate_triples(max_l):
-        integral = three_body_integral(abc)
-        derivs = []
-        # Hardcoded to take the integral wrt C
-        for GCx in GC:
-            # d/dCx = -d/d(Gx-Cx)
-            d = -sym.diff(integral, GCx)
-            d = sym.simplify(d)
-            derivs.append(to_code(d))
-        yield tuple(derivs)
-        
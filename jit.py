@@ -0,0 +1,172 @@
+# Runtime JIT mode: the generated C++ is compiled in-process with the local compiler into a shared
+# library and exposed as batched NumPy functions.
+# Libraries are cached by a hash of their sources and the compiler command, so regenerating
+# identical code never recompiles it.
+
+import os
+import ctypes
+import hashlib
+import subprocess
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+import gaussians as gauss
+from gaussians import L, ABC # types
+import printing
+from metacode import *
+
+# Stand-in for CUDA's vector_types.h so that the emitted .cpp compiles for the CPU.
+# Same layout as CUDA's double3, so an (n, 3) array of doubles can be passed directly.
+vector_types_shim = """
+#ifndef __VECTOR_TYPES_H__
+#define __VECTOR_TYPES_H__
+struct double3 { double x, y, z; };
+struct float3 { float x, y, z; };
+#endif
+"""
+
+batch_prefix = "batch_"
+default_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "py1e")
+default_compiler = os.environ.get("CXX", "g++")
+default_flags = ["-O2"]
+
+h_filename = "three_body_integrals.h"
+c_filename = "three_body_integrals.cpp"
+
+######### Compilation ###########
+
+# Compiles a set of C++ sources ({filename: contents}) into a shared library and loads it.
+# The library lives in cache_dir under the hash of everything that went into it.
+def compile_sources(sources : Dict[str, str], compiler : str=None, flags : List[str]=None,
+                    cache_dir : str=None) -> ctypes.CDLL:
+    if compiler is None:
+        compiler = default_compiler
+    if flags is None:
+        flags = default_flags
+    if cache_dir is None:
+        cache_dir = default_cache_dir
+    sources = dict(sources)
+    sources.setdefault("vector_types.h", vector_types_shim)
+
+    digest = hashlib.sha256()
+    digest.update(" ".join([compiler] + flags).encode())
+    for filename in sorted(sources):
+        digest.update(filename.encode())
+        digest.update(sources[filename].encode())
+    key = digest.hexdigest()[:32]
+
+    directory = os.path.join(cache_dir, key)
+    so_filename = os.path.join(directory, "lib{}.so".format(key))
+    if not os.path.exists(so_filename):
+        os.makedirs(directory, exist_ok=True)
+        for filename, contents in sources.items():
+            with open(os.path.join(directory, filename), 'w') as file:
+                file.write(contents)
+        cpp_files = [os.path.join(directory, f) for f in sorted(sources) if f.endswith(".cpp")]
+        temp_filename = "{}.{}.tmp".format(so_filename, os.getpid())
+        command = [compiler, "-shared", "-fPIC"] + flags + [f"-I{directory}"]
+        command += cpp_files + ["-o", temp_filename]
+        subprocess.run(command, check=True)
+        os.replace(temp_filename, so_filename) # atomic, so concurrent builds never load half a library
+    return ctypes.CDLL(so_filename)
+
+def as_pointer(array : np.ndarray):
+    return array.ctypes.data_as(ctypes.c_void_p)
+
+# Array of row pointers into a C-contiguous 2D array, for the double ** outputs
+def row_pointers(matrix : np.ndarray) -> np.ndarray:
+    return matrix.ctypes.data + matrix.strides[0] * np.arange(matrix.shape[0], dtype=np.uintp)
+
+
+######### Batch entry points ###########
+
+# One extern "C" wrapper per integral that loops over a batch of arguments,
+# so that a single ctypes call evaluates millions of points.
+def generate_batch_wrapper(abc : ABC) -> Function:
+    funcname = gauss.abc_to_funcname(abc)
+    k = Int("k")
+    args = [Var(f"{G}[k]") for G in printing.GX] + [Var("Z[k]")]
+    body = Statements(Assignment(Var("out[k]"), Call(funcname, args), declare=False))
+    body = Statements(default_for(k, zero, Var("n"), body))
+    params = [Int("n")] + [Var(G, "const double3 *") for G in printing.GX]
+    params += [Var("Z", "const double *"), Var("out", "double *")]
+    return Function('extern "C" void', f"{batch_prefix}{funcname}", params, body)
+
+# Batched wrapper around an update{funcname} function from printing.generate_update_func.
+# Each element k of the batch is one primitive (GA, GB, GC, Z, factor) of the shell pair (I[k], J[k]).
+def generate_batch_update_wrapper(lc : L, dest : str, funcname : str) -> Function:
+    k = Int("k")
+    args = [Var(f"{G}[k]") for G in printing.GX] + [Var("Z[k]"), Var("factor[k]")]
+    args += [Var("II"), Var("JJ"), Var("I[k]"), Var("J[k]")]
+    args += [Var(f"{dest}{x}") for x in printing.component_names(lc)]
+    body = Statements(Call(f"update{funcname}", args))
+    body = Statements(default_for(k, zero, Var("n"), body))
+    params = [Int("n")] + [Var(G, "const double3 *") for G in printing.GX]
+    params += [Var("Z", "const double *"), Var("factor", "const double *"), Int("II"), Int("JJ")]
+    params += [Var("I", "const int *"), Var("J", "const int *")]
+    params += [Var(f"{dest}{x}", "double **") for x in printing.component_names(lc)]
+    return Function('extern "C" void', f"{batch_prefix}update{funcname}", params, body)
+
+def generate_batch_file(abcs : Sequence[ABC], updates : Sequence[Tuple[L, str, str]]=(), max_l : L=0,
+                        kernel_engine : str=None) -> str:
+    body = [generate_batch_wrapper(abc) for abc in abcs]
+    for lc, dest, funcname in updates:
+        body.append(printing.generate_update_func(lc, dest, funcname, "", max_l, engine=kernel_engine))
+        body.append(generate_batch_update_wrapper(lc, dest, funcname))
+    includes = [Include("cmath", False), Include("vector_types.h", False), Include(h_filename)]
+    return str(generate_c_file(body, includes=includes))
+
+
+######### Python-side API ###########
+
+def as_vectors(G, n : int) -> np.ndarray:
+    return np.ascontiguousarray(np.broadcast_to(np.asarray(G, dtype=np.float64), (n, 3)))
+
+def as_scalars(x, n : int, dtype=np.float64) -> np.ndarray:
+    return np.ascontiguousarray(np.broadcast_to(np.asarray(x, dtype=dtype), (n,)))
+
+# Compiles every three body integral with total angular momentum at most max_l, plus the requested
+# update functions (list of (lc, dest, funcname) as passed to printing.generate_update_func, with
+# kernel_engine as the engine).
+class JITIntegrals:
+    def __init__(self, max_l : L, updates : Sequence[Tuple[L, str, str]]=(), compiler : str=None,
+                 flags : List[str]=None, cache_dir : str=None, kernel_engine : str=None):
+        self.max_l = max_l
+        self.updates = {funcname : (lc, dest) for lc, dest, funcname in updates}
+        h_string, c_string = printing.generate_integral_files(h_filename, "JIT build", max_l)
+        sources = {h_filename : h_string, c_filename : c_string}
+        sources["batch.cpp"] = generate_batch_file(list(gauss.generate_triples(max_l)), updates, max_l, kernel_engine)
+        self.lib = compile_sources(sources, compiler, flags, cache_dir)
+
+    def function(self, name : str):
+        func = getattr(self.lib, batch_prefix + name)
+        func.restype = None
+        return func
+
+    # Evaluates the integrals in abc_list (ABCs or function names like "S_Px_Dxy") over a batch.
+    # GA, GB, GC are (n, 3) arrays (or a single 3-vector), Z is an (n,) array or scalar.
+    # @return (len(abc_list), n) array
+    def eval_integrals(self, abc_list, GA, GB, GC, Z) -> np.ndarray:
+        n = max([np.shape(G)[0] if np.ndim(G) == 2 else 1 for G in (GA, GB, GC)] + [np.size(Z)])
+        args = [as_vectors(G, n) for G in (GA, GB, GC)] + [as_scalars(Z, n)]
+        pointers = [as_pointer(x) for x in args]
+        out = np.empty((len(abc_list), n))
+        for i, abc in enumerate(abc_list):
+            name = abc if isinstance(abc, str) else gauss.abc_to_funcname(abc)
+            self.function(name)(ctypes.c_int(n), *pointers, as_pointer(out[i]))
+        return out
+
+    # Accumulates into out (array of shape (NFS[lc], nbf, nbf), updated in place) for a batch of
+    # primitives of shell pairs with angular momenta (II, JJ) starting at basis functions I[k], J[k].
+    def update(self, funcname : str, II : L, JJ : L, I, J, GA, GB, GC, Z, factor, out : np.ndarray) -> None:
+        lc, dest = self.updates[funcname]
+        if out.shape[0] != printing.NFS[lc] or not out.flags.c_contiguous or out.dtype != np.float64:
+            raise ValueError("update{} needs a C-contiguous double array with {} components".format(funcname, printing.NFS[lc]))
+        n = max([np.shape(G)[0] if np.ndim(G) == 2 else 1 for G in (GA, GB, GC)] + [np.size(Z)])
+        args = [as_vectors(G, n) for G in (GA, GB, GC)] + [as_scalars(Z, n), as_scalars(factor, n)]
+        indices = [as_scalars(I, n, np.intc), as_scalars(J, n, np.intc)]
+        rows = [row_pointers(out[mc]) for mc in range(out.shape[0])]
+        func = self.function(f"update{funcname}")
+        func(ctypes.c_int(n), *[as_pointer(x) for x in args], ctypes.c_int(II), ctypes.c_int(JJ),
+             *[as_pointer(x) for x in indices], *[as_pointer(x) for x in rows])
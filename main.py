@@ -1,8 +1,16 @@
 # All local modules
 import printing
 import integrals
+import build
+import tuning
+import emitters
+import gaussians as gauss
+from gaussians import L, ABC # types
+from metacode import Include, generate_c_file, precisions
 
+import os
 import argparse
+from typing import List, Tuple
 
 
 disclaimer_text = """
@@ -14,7 +22,7 @@ S. Obara, A. Saika. J. Chem. Phys. 84, 3963 (1986); https://doi.org/10.1063/1.45
 """
 
 function_disclaimer_text = """
-This function is generated by python code in codegen/multipoles. 
+This function is generated by python code in codegen/multipoles.
 Contact Michael Miller (millerms@stanford.edu) if you have any questions.
 """
 
@@ -23,22 +31,236 @@ base_filename="three_body_integrals"
 h_filename = "{}.h".format(base_filename)
 c_filename = "{}.cpp".format(base_filename) # C++ because of double3
 
-def main(MAX_L):
-    # Write TBIs
-    # printing.write_integral_files(h_filename, c_filename, disclaimer_text, MAX_L)
-    
-    # Generate and print function for dipoles
+default_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "py1e")
+
+properties = {prop.name.lower() : prop for prop in [printing.overlap, printing.dipole, printing.quadrupole, printing.octupole]}
+backends = ["cpu", "gpu", "simd", "opencl", "fortran"]
+# Backends printed by an emitter, to self-contained files with the integrals they call
+backend_emitters = {"gpu" : "cuda", "opencl" : "opencl", "fortran" : "fortran"}
+extensions = {"cpu" : "cpp", "simd" : "cpp"}
+extensions.update({backend : emitters.emitters[name].extension for backend, name in backend_emitters.items()})
+
+# The templated and contracted gpu kernels are written for CUDA only, with the integral files
+def emitted_backend(backend : str, args) -> bool:
+    return backend in backend_emitters and not (backend == "gpu" and (args.templated or args.contracted))
+
+# "s,p,d" or "0,1,2" -> [0, 1, 2]
+def parse_shells(s : str) -> List[L]:
+    shells = []
+    for shell in s.split(","):
+        shell = shell.strip().lower()
+        if shell.isdigit():
+            shells.append(int(shell))
+        elif shell in gauss.orbital_names:
+            shells.append(gauss.orbital_names.index(shell))
+        else:
+            raise argparse.ArgumentTypeError("'{}' is not a shell".format(shell))
+    return shells
+
+# The update function of a property for a backend, as a complete source file
+def kernel_file(prop : printing.Property, backend : str, args, base_filename : str) -> str:
+    funcname = f"{prop.name}Matrix"
     function_disclaimer = printing.generate_disclaimer(function_disclaimer_text)
-    # print(printing.generate_update_func(1, "D", "DipoleMatrix", function_disclaimer, MAX_L))
-    print(printing.generate_update_func_gpu(1, "D", "DipoleMatrix", function_disclaimer, MAX_L))
-    # print(printing.generate_update_func(2, "Q", "QuadrupoleMatrix", function_disclaimer, MAX_L))
+    precision = precisions[args.precision]
+    options = dict(precision=precision, shells=args.shells, schedule=args.schedule)
+    if args.strategies:
+        options["block_engines"] = tuning.block_engines(args.strategies, prop.lc)
+    if args.contracted and backend == "cpu":
+        body = printing.generate_contracted_update_func(prop.lc, prop.dest, funcname, function_disclaimer, args.L,
+                                                        screen=args.screen, spherical=args.spherical, engine=args.kernel_engine, **options)
+        header = f"{base_filename}.h"
+    elif args.contracted and backend == "gpu":
+        body = printing.generate_contracted_update_func_gpu(prop.lc, prop.dest, funcname, function_disclaimer, args.L,
+                                                            screen=args.screen, spherical=args.spherical, engine=args.kernel_engine, **options)
+        header = f"{base_filename}.h"
+    elif backend == "cpu":
+        body = printing.generate_update_func(prop.lc, prop.dest, funcname, function_disclaimer, args.L,
+                                             omp_driver=args.omp, screen=args.screen, spherical=args.spherical,
+                                             engine=args.kernel_engine, **options)
+        header = f"{base_filename}.h"
+    elif backend == "gpu": # templated
+        body = printing.generate_update_func_gpu(prop.lc, prop.dest, funcname, function_disclaimer, args.L,
+                                                 screen=args.screen, spherical=args.spherical, templated=args.templated,
+                                                 unroll_threshold=args.unroll_threshold, engine=args.kernel_engine, **options)
+        header = f"{base_filename}.h"
+    else:
+        options.pop("block_engines", None) # the simd kernels always call the integrals
+        options.pop("schedule") # and loop over them
+        body = printing.generate_update_func_simd(prop.lc, prop.dest, funcname, function_disclaimer, args.L,
+                                                  omp_simd=args.omp, **options)
+        header = f"{base_filename}_inline.h"
+    includes = [Include("cmath", False), Include("vector_types.h", False), Include(header)]
+    return str(generate_c_file([str(body)], disclaimer=function_disclaimer, includes=includes))
+
+# The integrals the update function of a property calls for a backend, from its options (see
+# printing.update_integrals), so the build can plan them before the function is generated
+def kernel_integrals(prop : printing.Property, backend : str, args) -> List[ABC]:
+    if backend == "simd" or (backend == "gpu" and args.templated): # call every integral of every block
+        return printing.update_integrals(prop.lc, args.L, args.shells)
+    block_engines = tuning.block_engines(args.strategies, prop.lc) if args.strategies else None
+    return printing.update_integrals(prop.lc, args.L, args.shells, args.kernel_engine, block_engines, args.spherical)
+
+# The update function of a property in the language of an emitted backend, with the integrals it calls
+def emitted_file(prop : printing.Property, backend : str, args) -> str:
+    funcname = f"{prop.name}Matrix"
+    precision = precisions[args.precision]
+    options = dict(screen=args.screen, spherical=args.spherical, shells=args.shells, engine=args.kernel_engine,
+                   schedule=args.schedule)
+    if args.strategies:
+        options["block_engines"] = tuning.block_engines(args.strategies, prop.lc)
+    return emitters.generate_source(emitters.emitters[backend_emitters[backend]](precision), prop.lc, prop.dest, funcname,
+                                    args.L, function_disclaimer_text, **options)
+
+# Build targets for the selected properties and backends, plus the integrals they call
+# (or every integral up to L with --integrals all)
+def generate_targets(args) -> List[build.Target]:
+    precision = precisions[args.precision]
+    kernels = []
+    emitted = []
+    referenced = [] # integrals the kernels call from the integral files
+    for name in args.properties:
+        prop = properties[name]
+        for backend in args.backends:
+            filename = "{}Matrix{}.{}".format(prop.name, "_simd" if backend == "simd" else "", extensions[backend])
+            if emitted_backend(backend, args):
+                emitted.append(build.function_target(filename, emitted_file, (prop, backend, args),
+                                                     kernel_integrals(prop, backend, args)))
+                continue
+            kernels.append(build.function_target(filename, kernel_file, (prop, backend, args, args.base_filename)))
+            referenced += [abc for abc in kernel_integrals(prop, backend, args) if abc not in referenced]
+    targets = kernels + emitted
+
+    if args.integrals == "none":
+        return targets
+    if args.integrals == "all":
+        abcs = list(gauss.generate_triples(args.L))
+    else:
+        abcs = referenced
+    if any([backend in ["cpu", "gpu"] and not emitted_backend(backend, args) for backend in args.backends]):
+        targets += build.integral_targets(args.base_filename, disclaimer_text, args.L, args.shards, precision, abcs,
+                                          not args.no_dedup)
+    if "simd" in args.backends:
+        inline_filename = f"{args.base_filename}_inline.h"
+        targets.append(build.function_target(inline_filename, printing.generate_inline_integral_header,
+                                             (inline_filename, disclaimer_text, args.L, precision, abcs, not args.no_dedup),
+                                             abcs))
+    return targets
+
+# Strategy of every update block (see tuning): the cost model's with --cost-model, overridden by the tuning file.
+# The cost model runs as a build of its own, whose report is returned (None without --cost-model): the kernels
+# and the integrals they call depend on its strategies.
+def block_strategies(args) -> Tuple[dict, build.BuildReport]:
+    strategies = {}
+    report = None
+    if args.cost_model:
+        targets = tuning.model_targets([properties[name].lc for name in args.properties], args.L,
+                                       args.shells, args.schedule, args.spherical)
+        report = build.build(targets, args.output_dir, args.jobs)
+        for chosen in report.results.values():
+            strategies.update(chosen)
+    if args.tuning is not None:
+        strategies.update(tuning.load_tuning(args.tuning))
+    return strategies, report
+
+def main(args):
+    integrals.registry.use_engine(args.engine)
+    cache = None if args.no_cache else integrals.cache_filename(args.cache_dir, args.engine)
+    if cache is not None:
+        integrals.registry.load(cache)
+    if args.ast is not None:
+        import serialize # NumPy is only needed for serialized integrals
+        serialize.load_into_registry(args.ast)
+    args.strategies, model_report = block_strategies(args)
+    report = build.build(generate_targets(args), args.output_dir, args.jobs)
+    if cache is not None:
+        integrals.registry.save(cache)
+    if args.verbose:
+        if model_report is not None:
+            print(model_report)
+        print(report)
+    for filename in report.files:
+        print(filename)
 
 if __name__ == "__main__":
     # argument parsing
     parser = argparse.ArgumentParser(description='Generate property integral code')
     parser.add_argument('L', metavar='L', type=int,
                         help='Maximum angular momentum quantum desired')
+    parser.add_argument('--min-l', type=int, default=0,
+                        help='Only generate update functions for shells with at least this angular momentum')
+    parser.add_argument('--shells', type=parse_shells, default=None,
+                        help='Only generate update functions for these shells, e.g. s,p or 0,1')
+    parser.add_argument('-p', '--properties', nargs='+', choices=list(properties), default=["dipole"],
+                        help='Properties to generate update functions for')
+    parser.add_argument('-b', '--backends', nargs='+', choices=backends, default=["cpu"],
+                        help='Update function backends: scalar CPU, CUDA, vectorizable CPU, OpenCL C or Fortran. '
+                             'The CUDA and OpenCL C files have a kernel over a list of shell pairs, and like the Fortran '
+                             'files they include the integrals they call (but the --templated and --contracted CUDA files)')
+    parser.add_argument('--precision', choices=list(precisions), default="double",
+                        help='Floating point precision of the generated code')
+    parser.add_argument('--spherical', action='store_true',
+                        help='Write the outputs in the spherical basis (all backends but simd)')
+    parser.add_argument('--screen', action='store_true',
+                        help='Skip primitive pairs whose contribution is below a threshold, from a bound on the integrals '
+                             'of the shell pair times factor, or the prefactor of the contracted kernels (all backends but simd)')
+    parser.add_argument('--omp', action='store_true',
+                        help='Add the OpenMP driver (cpu) or omp simd loops (simd)')
+    parser.add_argument('--kernel-engine', choices=integrals.engine_names, default=None,
+                        help='Build the integrals of a shell pair inside the update functions with this engine '
+                             'instead of calling the integral functions (all backends but simd)')
+    parser.add_argument('--tuning', default=None,
+                        help='Tuning file from tuning.py with the strategy of every update block (all backends but simd)')
+    parser.add_argument('--cost-model', action='store_true',
+                        help='Pick the strategy of every update block with the cost model of tuning.py')
+    parser.add_argument('--schedule', action='store_true',
+                        help='Order the statements of every update block for fewer live values, see scheduling.py '
+                             '(all backends but simd)')
+    parser.add_argument('--contracted', action='store_true',
+                        help='Write update functions for contracted shell pairs that loop over the primitives '
+                             '(cpu and gpu backends, the gpu kernels split the primitive pairs between the threads '
+                             'of a launch and add into the outputs with atomicAdd)')
+    parser.add_argument('--templated', action='store_true',
+                        help='Write the gpu update function as one template over the shell pairs instead of unrolled kernels')
+    parser.add_argument('--unroll-threshold', type=int, default=printing.default_unroll_threshold,
+                        help='With --templated, shell pairs with at most this many integrals are unrolled, larger ones loop')
+    parser.add_argument('--integrals', choices=["referenced", "all", "none"], default="referenced",
+                        help='Integral files to write: the ones the update functions call, all up to L, or none')
+    parser.add_argument('--engine', choices=integrals.engine_names, default="os",
+                        help='Derivation of the integral functions: Obara-Saika, the vertical recursion with horizontal '
+                             'transfer, or McMurchie-Davidson')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='Give every integral its own body, instead of calling the integral it copies')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Number of source files to split the integrals over')
+    parser.add_argument('--base-filename', default=base_filename,
+                        help='Base name of the integral files')
+    parser.add_argument('-o', '--output-dir', default=".",
+                        help='Directory to write the generated files to')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of worker processes deriving integrals (default: number of CPUs)')
+    parser.add_argument('--cache-dir', default=default_cache_dir,
+                        help='Where derived integrals are cached between runs')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Don't read or write the integral cache")
+    parser.add_argument('--ast', default=None,
+                        help='Serialized integrals (from serialize.py, with the same --engine) to emit instead of deriving them')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print the timing of every build step and the critical path')
     args = parser.parse_args()
-    MAX_L = args.L
+    if args.contracted and (args.templated or args.omp or "simd" in args.backends or
+                            any([backend in ["opencl", "fortran"] for backend in args.backends])):
+        parser.error("--contracted doesn't support --templated, --omp or the simd, opencl and fortran backends")
+    if args.ast is not None:
+        import serialize
+        try:
+            with serialize.ASTFile(args.ast) as ast:
+                if ast.engine is not None and ast.engine != args.engine:
+                    raise ValueError("{} holds integrals derived with engine {}, not --engine {}".format(args.ast, ast.engine, args.engine))
+        except (OSError, ValueError) as error:
+            parser.error("--ast: {}".format(error))
+    if args.shells is None:
+        args.shells = list(range(args.min_l, args.L+1))
+    else:
+        args.shells = [l for l in args.shells if args.min_l <= l <= args.L]
 
-    main(MAX_L)
+    main(args)
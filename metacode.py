@@ -63,7 +63,7 @@ class Variable(Value):
     
     def declare(self) -> str:
         if self.typename is None:
-            raise ValueErorr("Variable {} can't have type None".format(self.name))
+            raise ValueError("Variable {} can't have type None".format(self.name))
         return "{} {}".format(self.typename, self.name)
     def __str__(self):
         return str(self.name)
@@ -76,6 +76,34 @@ def Int(name):
 def Double(name):
     return Variable(name, "double")
 
+# Floating point types of generated code. Intermediates are computed in real and outputs are
+# accumulated in accumulate, so mixed precision computes in float and accumulates in double.
+@dataclass
+class Precision:
+    name : str
+    real : str
+    accumulate : str
+    vector : str # 3-vector type
+    literal_suffix : str = "" # 1.5f
+    math_suffix : str = "" # sqrtf
+    suffix : str = "" # appended to the names of functions computed in this precision
+
+    # floating point literals get the suffix, integer ones don't need it
+    def literal(self, s : str) -> str:
+        is_float = any([ch in s for ch in ".eE"])
+        if is_float and self.literal_suffix and not s.endswith(self.literal_suffix):
+            return s + self.literal_suffix
+        return s
+    def math(self, name : str) -> str:
+        return name + self.math_suffix
+double_precision = Precision("double", "double", "double", "double3")
+single_precision = Precision("float", "float", "float", "float3", "f", "f", "_f")
+mixed_precision = Precision("mixed", "float", "double", "float3", "f", "f", "_f")
+precisions = {p.name : p for p in [double_precision, single_precision, mixed_precision]}
+
+def Real(name, precision : Precision=double_precision):
+    return Variable(name, precision.real)
+
 # Easy operator
 @dataclass
 class Parens(Value):
@@ -83,8 +111,15 @@ class Parens(Value):
     def __str__(self):
         return f"({self.val})"
 
+@dataclass
+class Cast(Value):
+    typename : str
+    val : Value
+    def __str__(self):
+        return f"({self.typename})({self.val})"
+
 @dataclass(init=False)
-class Array(Value):
+class Array(Variable):
     dim : int
     def __init__(self, name : str, typename : str, dim : int=1):
         if typename is None:
@@ -94,10 +129,9 @@ class Array(Value):
     def __str__(self):
         return self.name
     def declare(self) -> str:
-        declaration = super(Array, self).declare()
-        return declaration + "*"*self.dim
+        return "{} {}{}".format(self.typename, "*"*self.dim, self.name)
     def __eq__(self, other):
-        return self.fields() == other.fields()
+        return (self.name, self.typename, self.dim) == (other.name, other.typename, other.dim)
 
 class Constant(Variable):
     def __init__(self, name : str):
@@ -133,6 +167,24 @@ def op_reduce(op, vals : List[Value]) -> OpTree:
     return op_reduce(op[1:], [new_val] + vals[2:])    
 def Product(vals : List[Value]) -> OpTree:
     return op_reduce(Op.MUL, vals)
+
+# math.h functions that have a float version with an f suffix
+math_functions = ["sqrt", "pow", "exp", "log", "fabs", "fmax", "sin", "cos"]
+
+# Copy of an expression rewritten for a precision: floating point literals get their suffix
+# and math functions their float names
+def with_precision(val, precision : Precision):
+    if isinstance(val, Constant):
+        return Constant(precision.literal(val.name))
+    elif isinstance(val, OpTree):
+        right = None if val.right is None else with_precision(val.right, precision)
+        return OpTree(val.op, with_precision(val.left, precision), right)
+    elif isinstance(val, Parens):
+        return Parens(with_precision(val.val, precision))
+    elif isinstance(val, Call):
+        name = precision.math(val.name) if val.name in math_functions else val.name
+        return Call(name, [with_precision(arg, precision) for arg in val.args])
+    return val
     
 ########## Conditions ############
     
@@ -218,8 +270,8 @@ class Element(Value):
         if len(self.indices) != self.array.dim:
             raise ValueError("Array {} has dim {} != {}".format(array.name, array.dim, len(self.indices)))
     def __str__(self):
-        s = array.name
-        for i in indices:
+        s = self.array.name
+        for i in self.indices:
             s += "[{}]".format(i)
         return s
     
@@ -228,13 +280,12 @@ class Assignment(Statement): # Can technically be a Value but whatever
     var : Variable
     rhs : Value
     declare : bool = True
-    # TODO: debug this
     def __str__(self):
         if self.declare:
             lhs = self.var.declare()
         else:
             lhs = self.var
-        return "{} = {}".format(self.var, self.rhs)
+        return "{} = {}".format(lhs, self.rhs)
 
 @dataclass
 class Update(Statement):
@@ -285,6 +336,9 @@ class Container(Statement):
 
 class For(Container):
     def __init__(self, initial_statement, condition, update_statement, body):
+        self.initial_statement = initial_statement
+        self.condition = condition
+        self.update_statement = update_statement
         argstring = "{}; {}; {}".format(initial_statement, condition, update_statement)
         super(For, self).__init__("for ", argstring, body)
 class While(Container):
@@ -292,13 +346,28 @@ class While(Container):
         super(While, self).__init__("while ", condition, body)
 class If(Container):
     def __init__(self, condition, body, has_else=False):
+        self.condition = condition
+        self.has_else = has_else
         name = ("else " if has_else else "") + "if "
         super(If, self).__init__(name, str(condition), body)
 def Else(body : Statements) -> Container:
     return Container("else ", None, body)
+class Switch(Container):
+    def __init__(self, value, body):
+        super(Switch, self).__init__("switch ", str(value), body)
+# case label: statement
+@dataclass
+class Case(Statement):
+    label : Value
+    statement : Statement
+    def __str__(self):
+        return "case {}: {}".format(self.label, self.statement)
 class Function(Container):
     def __init__(self, t : str, name : str, args : List[Var], body : Statements, declaration=False):
         self.declaration = declaration
+        self.typename = t
+        self.funcname = name
+        self.params = args
         argstring = ", ".join([a.declare() for a in args])
         name = "{} {}".format(t, name)
         super(Function, self).__init__(name, argstring, body, newline=True)
@@ -330,6 +399,53 @@ class Define(Macro):
         super(Define, self).__init__("define", args)
 Comment = str
 
+# Names of all the functions called anywhere in a tree of statements and values, in order of appearance
+def called_functions(node) -> List[str]:
+    names = []
+    if isinstance(node, Call):
+        names.append(node.name)
+    if isinstance(node, (list, tuple)):
+        children = node
+    elif isinstance(node, (Statement, Value, Statements)):
+        children = vars(node).values()
+    else:
+        children = []
+    for child in children:
+        names += [name for name in called_functions(child) if name not in names]
+    return names
+
+# Names of all the variables in a tree of values, in order of appearance
+def variable_names(node) -> List[str]:
+    if isinstance(node, Variable):
+        return [node.name]
+    if isinstance(node, (list, tuple)):
+        children = node
+    elif isinstance(node, (Statement, Value, Statements)):
+        children = vars(node).values()
+    else:
+        children = []
+    names = []
+    for child in children:
+        names += [name for name in variable_names(child) if name not in names]
+    return names
+
+# Number of floating point operations (arithmetic operators and compound updates) in a tree of statements
+# and values. Code written out as strings, like index arithmetic and loop control, isn't counted.
+arithmetic_operators = [Op.ADD, Op.SUB, Op.MUL, Op.DIV, Op.PLUSEQ, Op.MINUSEQ, Op.TIMESEQ, Op.DIVEQ, Op.NEGATE]
+def arithmetic_operations(node) -> int:
+    count = 0
+    if isinstance(node, (OpTree, Update)) and node.op in arithmetic_operators:
+        count += 1
+    if isinstance(node, (list, tuple)):
+        children = node
+    elif isinstance(node, (Statement, Value, Statements)):
+        children = vars(node).values()
+    else:
+        children = []
+    for child in children:
+        count += arithmetic_operations(child)
+    return count
+
 
 ############## Useful functions ###############
 
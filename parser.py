@@ -1,7 +1,8 @@
 from __future__ import annotations # So that classes can include their definition
 import sys
 from dataclasses import dataclass, field
-from typing import List, Sequence, Tuple, Callable, Any
+from functools import lru_cache
+from typing import Dict, List, Sequence, Tuple, Callable, Any
 
 from lexer import Token, tokenize, token_tags, TokenType, is_valid_tag
 import metacode as meta
@@ -100,12 +101,34 @@ def generate_rules(grammar):
             rhs.append(r)
         rules.append(Rule(rule_name, *rhs))
     return list(rulenames), rules
-all_rulenames, all_rules = generate_rules(grammar)
-rule_map = {name : [] for name in all_rulenames}
-for name in all_rulenames:
-    for rule in all_rules:
-        if rule.name == name:
-            rule_map[name].append(rule)
+
+@dataclass
+class GrammarTables:
+    rule_map : Dict[str, List[Rule]] # the rules of every rule name, in grammar order
+    first : Dict[str, set] # token tags a rule or token can start with
+    last : Dict[str, set] # token tags a rule or token can end with
+
+# Built once on first use rather than at import, since most runs never parse anything.
+@lru_cache(maxsize=None)
+def grammar_tables() -> GrammarTables:
+    rulenames, rules = generate_rules(grammar)
+    rule_map = {name : [] for name in rulenames}
+    for rule in rules:
+        rule_map[rule.name].append(rule)
+    first = {tag.lower() : set([tag]) for tag in token_tags}
+    last = {tag.lower() : set([tag]) for tag in token_tags}
+    first.update({name : set() for name in rulenames})
+    last.update({name : set() for name in rulenames})
+    changed = True
+    while changed:
+        changed = False
+        for rule in rules:
+            right = rule.left if is_unit(rule) else rule.right
+            new_first = first[rule.name] | first[rule.left]
+            new_last = last[rule.name] | last[right]
+            changed = changed or new_first != first[rule.name] or new_last != last[rule.name]
+            first[rule.name], last[rule.name] = new_first, new_last
+    return GrammarTables(rule_map, first, last)
 
 
 # IndexRule = Tuple[int, int, int]
@@ -138,7 +161,7 @@ def parse_cnf(tokens, start, end, label, print_each=False):
             yield ParseNode(label.upper(), start, end, [])
     else:
         # attempt to match all rules
-        for rule in rule_map[label]:
+        for rule in grammar_tables().rule_map[label]:
             # TODO: sort the rules.
             if is_unit(rule):
                 for child in parse_cnf(tokens, start, end, rule.left):
@@ -151,6 +174,48 @@ def parse_cnf(tokens, start, end, label, print_each=False):
                         for rchild in parse_cnf(tokens, p, end, rule.right):
                             yield ParseNode(label, start, end, [lchild, rchild])
 
+# The first parse that parse_cnf yields, or None if there is none.
+# parse_cnf backtracks through every split again and again, which is exponential in the length of
+# the expression. Here every (start, end, label) is parsed once and kept in memo (a CYK chart),
+# and the rules and splits are tried in the same order, so the tree is the same.
+# Spans that can't start or end with their tokens are skipped without recursing, which rules out
+# almost every split (e.g. the left half of a sum has to end with + or -).
+def first_parse(tokens, start, end, label, memo=None) -> ParseNode:
+    if memo is None:
+        memo = {}
+    key = (start, end, label)
+    if key in memo:
+        return memo[key]
+    tables = grammar_tables()
+    if tokens[start].tag not in tables.first[label] or tokens[end-1].tag not in tables.last[label]:
+        return None
+    memo[key] = None # a rule can't use itself on the same span
+    node = None
+    if is_valid_tag(label):
+        if end - start == 1 and label.upper() == tokens[start].tag:
+            node = ParseNode(label.upper(), start, end, [])
+    else:
+        for rule in tables.rule_map[label]:
+            if is_unit(rule):
+                child = first_parse(tokens, start, end, rule.left, memo)
+                if child is not None:
+                    node = ParseNode(label, start, end, [child])
+            elif end-start >= 2:
+                for p in range(start+1, end):
+                    if tokens[p-1].tag not in tables.last[rule.left] or tokens[p].tag not in tables.first[rule.right]:
+                        continue
+                    lchild = first_parse(tokens, start, p, rule.left, memo)
+                    if lchild is None:
+                        continue
+                    rchild = first_parse(tokens, p, end, rule.right, memo)
+                    if rchild is not None:
+                        node = ParseNode(label, start, end, [lchild, rchild])
+                        break
+            if node is not None:
+                break
+    memo[key] = node
+    return node
+
 # takes in f(stream, node, children)
 def traverse_tree_generator(f):
     def traverse_node(tokens, node : ParseNode):
@@ -236,7 +301,9 @@ generate_AST = traverse_tree_generator(generate_AST_func)
 
 def generate_value(s : str) -> meta.Value:
     tokens = tokenize(s)
-    tree = next(parse_cnf(tokens, 0, len(tokens), "start"))
+    tree = first_parse(tokens, 0, len(tokens), "start")
+    if tree is None:
+        fail(f"Couldn't parse {s}")
     return generate_AST(tokens, tree)
 
 
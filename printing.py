@@ -1,9 +1,13 @@
+import os
 import re
-from integrals import generate_integrals
+from integrals import generate_integrals, registry_for
 from parser import generate_value
 import gaussians as gauss
+import spherical
+import scheduling
 from gaussians import L, N, ABC # types
-from typing import Sequence
+from typing import Dict, Sequence, List, Tuple
+from dataclasses import dataclass
 
 from metacode import *
 import copy
@@ -18,6 +22,27 @@ GX_vars = [Var(GA, "double3") for GA in GX]
 Z_var = Var("Z", "double")
 integral_params = GX_vars + [Z_var]
 
+# Parameters of the integral functions in a given precision
+def integral_params_for(precision : Precision) -> List[Var]:
+    return [Var(G, precision.vector) for G in GX] + [Var("Z", precision.real)]
+
+# Call to the integral function of abc in a given precision (float versions have a _f suffix)
+def integral_call(abc : ABC, precision : Precision=double_precision, args : List[Value]=None) -> Call:
+    if args is None:
+        args = integral_params
+    return Call(gauss.abc_to_funcname(abc) + precision.suffix, args)
+
+# A value computed in the precision's real type, converted to be accumulated into the outputs
+def accumulated(val : Value, precision : Precision) -> Value:
+    if precision.real == precision.accumulate:
+        return val
+    return Cast(precision.accumulate, val)
+
+def dscale_assignment(precision : Precision, typename : str=None) -> Assignment:
+    if typename is None:
+        typename = precision.real
+    return Assignment(Var("dscale", typename), "{}({})/3".format(precision.math("sqrt"), precision.literal("3.")))
+
 ######### File Writing ###############
 
 # This cute function takes a block of text and creates a visually pleasing C-style
@@ -67,33 +92,134 @@ def generate_disclaimer(text):
     s += "{0}{1}{0}\n".format("*", " "*(N-2)) # Empty line for vertical spacing
     s += "*" * (N-1) + "/\n" # last line
     return s
-def write_integral_files(h_filename : str, c_filename : str, disclaimer_text : str, max_l : L) -> None:
-    c_body = []
+# The three body integrals called by generated code (in any precision), in order of appearance.
+# Takes metacode or printed code, like the strings returned by generate_update_func*.
+# Generating just these is much cheaper than every integral up to max_l.
+def referenced_integrals(code) -> List[ABC]:
+    names = re.findall(r"(\w+)\(", code) if isinstance(code, str) else called_functions(code)
+    suffixes = set([p.suffix for p in precisions.values() if p.suffix])
+    abcs = []
+    for name in names:
+        name = next((name[:-len(s)] for s in suffixes if name.endswith(s)), name)
+        if gauss.is_funcname(name) and gauss.funcname_to_abc(name) not in abcs:
+            abcs.append(gauss.funcname_to_abc(name))
+    return abcs
+
+# One C function per three body integral with total angular momentum at most max_l,
+# or only the integrals in abcs (e.g. from referenced_integrals), which are generated on demand.
+# engine picks the derivation of the integrals (see integrals.registry_for), None is the default one.
+def generate_integral_functions(max_l : L, t : str=None, precision : Precision=double_precision,
+                                abcs : Sequence[ABC]=None, engine : str=None) -> List[Function]:
+    if t is None:
+        t = precision.real
+    params = integral_params_for(precision)
+    functions = []
+    integrals = generate_integrals(max_l, engine) if abcs is None else [(abc, registry_for(engine)[abc]) for abc in abcs]
+    for abc, integral in integrals:
+        func_name = "_".join([gauss.n_to_str(nj) for nj in abc]) + precision.suffix
+        integral = with_precision(integral, precision)
+        functions.append(Function(t, func_name, params, Statements(Return(integral)), declaration=False))
+    return functions
+
+def header_guard(h_filename : str) -> str:
+    return "__{}__".format(os.path.basename(h_filename)).replace(".", "_").upper()
+
+# Header declaring the integral functions of abcs.
+# Only needs the names, so it can be written before (or without) deriving any integral.
+# The aliases (see integral_aliases) are inline functions that call the integral they copy,
+# which need the whole vector type rather than a forward declaration.
+def generate_integral_header(h_filename : str, disclaimer_text : str, abcs : Sequence[ABC],
+                             precision : Precision=double_precision, aliases : Dict=None) -> str:
+    if aliases is None:
+        aliases = {}
+    params = integral_params_for(precision)
     h_body = []
-    h_body.append(Declaration(Var("double3", "struct")))
-    for abc, integral in generate_integrals(max_l):
-        func_name = "_".join([gauss.n_to_str(nj) for nj in abc])
-        
-        c_func = Function("double", func_name, integral_params, Statements(Return(integral)), declaration=False)
-        c_body.append(c_func)
-        
-        h_func = copy.deepcopy(c_func)
-        h_func.declaration = True
+    includes = [Include("vector_types.h", False)] if aliases else []
+    if not aliases:
+        h_body.append(Declaration(Var(precision.vector, "struct")))
+    for abc in abcs:
+        if abc in aliases:
+            continue
+        h_func = Function(precision.real, gauss.abc_to_funcname(abc) + precision.suffix, params, Statements(), declaration=True)
         h_func.newline = False
         h_body.append(h_func)
-        
+    if aliases:
+        h_body.append(Empty())
+        h_body += [alias_function(abc, aliases[abc], precision) for abc in abcs if abc in aliases]
+    disclaimer = generate_disclaimer(disclaimer_text)
+    return str(generate_c_file(h_body, disclaimer=disclaimer, includes=includes, guard=header_guard(h_filename)))
+
+# Integrals in abcs that are copies of an earlier one up to a permutation of the centers and a sign,
+# e.g. (s|px|s)(GA, GB, GC) = (px|s|s)(GB, GA, GC). Only the first of every group needs a body.
+# @return {abc : (representative, args, sign)}, where abc(GA, GB, GC, Z) = sign * representative(*args, Z)
+def integral_aliases(abcs : Sequence[ABC], engine : str=None) -> Dict[ABC, Tuple[ABC, List[str], int]]:
+    aliases = {}
+    representatives = {}
+    for abc in abcs:
+        code, perm, sign = registry_for(engine).canonical(abc)
+        if code not in representatives:
+            representatives[code] = (abc, perm, sign)
+            continue
+        # both are the canonical code after renaming, so undo the renaming of abc and apply the other one
+        representative, representative_perm, representative_sign = representatives[code]
+        inverse = [perm.index(i) for i in range(3)]
+        args = [GX[inverse[representative_perm[i]]] for i in range(3)]
+        aliases[abc] = (representative, args, sign * representative_sign)
+    return aliases
+
+# static inline double S_Px_S(double3 GA, double3 GB, double3 GC, double Z) { return Px_S_S(GB, GA, GC, Z); }
+# A function rather than a #define, so that arguments like double3{x, y, z} aren't split at their commas.
+def alias_function(abc : ABC, alias : Tuple[ABC, List[str], int], precision : Precision=double_precision) -> Function:
+    representative, args, sign = alias
+    call = integral_call(representative, precision, [Var(G) for G in args] + [Var("Z")])
+    value = OpTree(Op.NEGATE, call) if sign < 0 else call
+    name = gauss.abc_to_funcname(abc) + precision.suffix
+    return Function(f"static inline {precision.real}", name, integral_params_for(precision), Statements(Return(value)),
+                    declaration=False)
+
+# Builds the header and source file of all three body integrals up to max_l in memory
+# With dedup, integrals that copy another one (see integral_aliases) are inline functions in the header
+# that call the one they copy, instead of having a body of their own.
+# @return (str, str) the contents of the .h and .cpp files
+def generate_integral_files(h_filename : str, disclaimer_text : str, max_l : L,
+                            precision : Precision=double_precision, abcs : Sequence[ABC]=None,
+                            dedup : bool=True, engine : str=None) -> Tuple[str, str]:
+    if abcs is None:
+        abcs = list(gauss.generate_triples(max_l))
+    aliases = integral_aliases(abcs, engine) if dedup else {}
+    c_body = generate_integral_functions(max_l, precision=precision, abcs=[abc for abc in abcs if abc not in aliases],
+                                         engine=engine)
+    h_file = generate_integral_header(h_filename, disclaimer_text, abcs, precision, aliases)
     disclaimer = generate_disclaimer(disclaimer_text)
+    includes = [Include(os.path.basename(h_filename)), Include("vector_types.h", False)]
+    c_file = generate_c_file(c_body, disclaimer=disclaimer, includes=includes)
+    return str(h_file), str(c_file)
+
+# Header-only version of the integrals, where every integral is a static inline definition.
+# The vectorized update kernels need this: the compiler can't vectorize a loop around calls
+# to functions in another translation unit.
+def generate_inline_integral_header(h_filename : str, disclaimer_text : str, max_l : L,
+                                    precision : Precision=double_precision, abcs : Sequence[ABC]=None,
+                                    dedup : bool=True, engine : str=None) -> str:
+    if abcs is None:
+        abcs = list(gauss.generate_triples(max_l))
+    aliases = integral_aliases(abcs, engine) if dedup else {}
+    body = generate_integral_functions(max_l, f"static inline {precision.real}", precision,
+                                       [abc for abc in abcs if abc not in aliases], engine)
+    body += [alias_function(abc, aliases[abc], precision) for abc in abcs if abc in aliases]
+    disclaimer = generate_disclaimer(disclaimer_text)
+    includes = [Include("vector_types.h", False)]
+    return str(generate_c_file(body, disclaimer=disclaimer, includes=includes, guard=header_guard(h_filename)))
+
+def write_integral_files(h_filename : str, c_filename : str, disclaimer_text : str, max_l : L,
+                         precision : Precision=double_precision, abcs : Sequence[ABC]=None,
+                         dedup : bool=True, engine : str=None) -> None:
+    h_string, c_string = generate_integral_files(h_filename, disclaimer_text, max_l, precision, abcs, dedup, engine)
     with open(h_filename, 'w') as file:
-        ifdef_name = "__{}__".format(h_filename).replace(".", "_").upper()
-        statements = generate_c_file(h_body, disclaimer=disclaimer, guard=ifdef_name)
-        filestring = str(statements)
-        file.write(filestring)
+        file.write(h_string)
     print("Finished writing {0}".format(h_filename))
     with open(c_filename, 'w') as file:
-        includes = [Include(h_filename), Include("vector_types.h", False)]
-        statements = generate_c_file(c_body, disclaimer=disclaimer, includes=includes)
-        filestring = str(statements)
-        file.write(filestring)
+        file.write(c_string)
     print("Finished writing {0}".format(c_filename))
 
 
@@ -109,12 +235,24 @@ def requires_dscale(n : L) -> bool:
     return sum(n) == 2 and max(n) == 2
 def num_dscales(abc : ABC) -> int:
     return len([n for n in abc if requires_dscale(n)])
+# Whether the block of the shell pair (II, JJ) multiplies by dscale, so that functions only declare it
+# when they use it. The spherical blocks only scale the operator components.
+def uses_dscale(lcs : Sequence[L], II : L, JJ : L, spherical : bool=False) -> bool:
+    return 2 in lcs or (not spherical and 2 in (II, JJ))
+
+# Cartesian suffix of an orbital, e.g. (1,0,1) -> "xz"
+def xyz_suffix(c : N) -> str:
+    return "".join([c[i]*"xyz"[i] for i in range(3)])
+
+# suffixes of all the output matrices of a multipole of order lc, in index order
+def component_names(lc : L) -> List[str]:
+    return [xyz_suffix(gauss.index_to_n(lc, mc)) for mc in range(NFS[lc])]
 
 # alternative formatting of variables
-def variable_name_separate(base, c : N, mi : L, mj : L) -> str:
-    elements = f"[I+{mi}][J+{mj}]"
-    xyz = "".join([c[i]*"xyz"[i] for i in range(3)])
-    return f"{base}{xyz}{elements}"
+# Element of the output matrix of component c, e.g. Dx[I+0][J+1]
+def variable_name_separate(base, c : N, mi : L, mj : L, precision : Precision=double_precision) -> Element:
+    matrix = Array(f"{base}{xyz_suffix(c)}", precision.accumulate, 2)
+    return Element(matrix, [Var(f"I+{mi}", "int"), Var(f"J+{mj}", "int")])
 def variable_name_double3(base, c : N, mi : L, mj : L) -> str:
     if sum(c) == 1:
         # D[I+0][J+0].x
@@ -123,10 +261,16 @@ def variable_name_double3(base, c : N, mi : L, mj : L) -> str:
     elif sum(c) == 2:
         raise ValueError(f"xyz = {xyz} not supported with array type DOUBLE3_ARRAYS")
 
-def generate_updates(lc : L, II : L, JJ : L, dest : str) -> Sequence[Statement]:
+# Integral in a block of updates: a function call, or with an engine (see engine_intermediates)
+# the intermediate that the engine defines at the start of the block
+def integral_value(abc : ABC, precision : Precision=double_precision, engine : str=None) -> Value:
+    return integral_call(abc, precision) if engine is None else Var(intermediate_name(abc))
+
+def generate_updates(lc : L, II : L, JJ : L, dest : str, precision : Precision=double_precision,
+                     engine : str=None, factor : bool=True) -> Sequence[Statement]:
     assert II <= JJ
     updates = []
-    factor = Var("factor", "double")
+    abcs = []
     for mi in range(NFS[II]):
         for mj in range(NFS[JJ]):
             a = gauss.index_to_n(II, mi)
@@ -134,41 +278,342 @@ def generate_updates(lc : L, II : L, JJ : L, dest : str) -> Sequence[Statement]:
             for mc in range(NFS[lc]):
                 c = gauss.index_to_n(lc, mc)
                 abc = (a,b,c)
-                funcname = gauss.abc_to_funcname(abc)
-                variable_name = variable_name_separate(dest, c, mi, mj)
-                rhs = Call(funcname, integral_params)
-                rhs = Product([factor] + ["dscale"]*num_dscales(abc) + [rhs])
-                statement = Update(variable_name, Op.PLUSEQ, rhs)
+                abcs.append(abc)
+                variable_name = variable_name_separate(dest, c, mi, mj, precision)
+                rhs = integral_value(abc, precision, engine)
+                rhs = [accumulated(Product(["dscale"]*num_dscales(abc) + [rhs]), precision)]
+                if factor:
+                    rhs = [Var("factor", precision.accumulate)] + rhs
+                statement = Update(variable_name, Op.PLUSEQ, Product(rhs))
                 updates.append(statement)
+    if engine is not None:
+        updates = engine_intermediates(abcs, engine, precision) + updates
     return updates 
 
-def generate_update_func(lc : L, dest : str, funcname : str, function_disclaimer : str, max_l : L):
+# Spherical version of generate_updates: the Cartesian to spherical transformation of both shells
+# (spherical.transformation_matrix) is folded into the coefficients at generation time, so every
+# spherical output element is written directly as a short linear combination of Cartesian integrals.
+# I and J index spherical functions. The operator components stay Cartesian.
+def generate_spherical_updates(lc : L, II : L, JJ : L, dest : str, factor : bool=True,
+                               precision : Precision=double_precision, engine : str=None) -> List[Statement]:
+    assert II <= JJ
+    # exact signed squares, so that the products of unit coefficients are exactly 1
+    TI = spherical.signed_squares(II)
+    TJ = spherical.signed_squares(JJ)
+    updates = []
+    abcs = []
+    for si in range(len(TI)):
+        for sj in range(len(TJ)):
+            for mc in range(NFS[lc]):
+                c = gauss.index_to_n(lc, mc)
+                terms = []
+                for mi in range(NFS[II]):
+                    for mj in range(NFS[JJ]):
+                        coefficient = spherical.product(TI[si][mi], TJ[sj][mj])
+                        if coefficient == 0.:
+                            continue
+                        abc = (gauss.index_to_n(II, mi), gauss.index_to_n(JJ, mj), c)
+                        abcs.append(abc)
+                        call = integral_value(abc, precision, engine)
+                        terms.append(call if coefficient == 1. else Product([Constant(precision.literal(repr(coefficient))), call]))
+                rhs = op_reduce(Op.ADD, terms)
+                rhs = ["dscale"]*int(requires_dscale(c)) + [Parens(rhs) if len(terms) > 1 else rhs]
+                rhs = [accumulated(Product(rhs), precision)]
+                if factor:
+                    rhs = [Var("factor")] + rhs
+                updates.append(Update(variable_name_separate(dest, c, si, sj, precision), Op.PLUSEQ, Product(rhs)))
+    if engine is not None:
+        updates = engine_intermediates(abcs, engine, precision) + updates
+    return updates
+
+# Cartesian integrals of generate_spherical_updates with a nonzero coefficient, in order of appearance
+def spherical_block_integrals(lc : L, II : L, JJ : L) -> List[ABC]:
+    TI = spherical.signed_squares(II)
+    TJ = spherical.signed_squares(JJ)
+    return [(gauss.index_to_n(II, mi), gauss.index_to_n(JJ, mj), gauss.index_to_n(lc, mc))
+            for si in range(len(TI)) for sj in range(len(TJ)) for mc in range(NFS[lc])
+            for mi in range(NFS[II]) for mj in range(NFS[JJ]) if TI[si][mi] * TJ[sj][mj] != 0]
+
+# Shell pairs II <= JJ <= max_l that the update functions handle.
+# shells limits them to pairs of the given angular momenta, for builds that only need part of a basis.
+def shell_pairs(max_l : L, shells : Sequence[L]=None) -> List[Tuple[L, L]]:
+    if shells is None:
+        shells = range(max_l+1)
+    return [(II, JJ) for II in range(max_l+1) for JJ in range(II, max_l+1) if II in shells and JJ in shells]
+
+# Engine of the block of the shell pair (II, JJ): the one in block_engines (e.g. from tuning), if it has one
+def block_engine(II : L, JJ : L, engine : str=None, block_engines : Dict[Tuple[L, L], str]=None) -> str:
+    if block_engines is not None and (II, JJ) in block_engines:
+        return block_engines[(II, JJ)]
+    return engine
+
+# The integral functions the block of the shell pair (II, JJ) calls, in order of appearance, worked out without
+# generating the block: all of its integrals when it calls them directly, the base integrals of the recursion
+# with an engine (none with md, whose intermediates start from 1)
+def block_integrals(lc : L, II : L, JJ : L, engine : str=None, spherical : bool=False) -> List[ABC]:
+    if spherical:
+        abcs = list(dict.fromkeys(spherical_block_integrals(lc, II, JJ)))
+    else:
+        abcs = [(gauss.index_to_n(II, mi), gauss.index_to_n(JJ, mj), gauss.index_to_n(lc, mc))
+                for mi in range(NFS[II]) for mj in range(NFS[JJ]) for mc in range(NFS[lc])]
+    if engine is None or engine == "md":
+        return abcs if engine is None else []
+    lowers = {"os" : lower_c, "hrr" : lower_hrr}
+    if engine not in lowers:
+        raise ValueError("Unknown integral engine '{}', expected one of os, hrr, md".format(engine))
+    return [abc for abc in recursion_plan(abcs, lowers[engine]) if lowers[engine](abc) is None]
+
+# The integral functions an update function of order lc calls (generate_update_func and its gpu, contracted and
+# emitted variants), like referenced_integrals of the function, so builds can plan the integrals before it exists
+def update_integrals(lc : L, max_l : L, shells : Sequence[L]=None, engine : str=None,
+                     block_engines : Dict[Tuple[L, L], str]=None, spherical : bool=False) -> List[ABC]:
+    abcs = []
+    for II, JJ in shell_pairs(max_l, shells):
+        abcs += block_integrals(lc, II, JJ, block_engine(II, JJ, engine, block_engines), spherical)
+    return list(dict.fromkeys(abcs))
+
+# update{funcname} of generate_update_func as metacode, which the emitters of other languages print too
+# schedule orders every block for fewer live values (see scheduling.py).
+def update_function(lc : L, dest : str, funcname : str, max_l : L, screen : bool=False, spherical : bool=False,
+                    precision : Precision=double_precision, shells : Sequence[L]=None, engine : str=None,
+                    block_engines : Dict[Tuple[L, L], str]=None, schedule : bool=False) -> Function:
     II_var = Var("II", "int")
     JJ_var = Var("JJ", "int")
     statements = []
-    statements.append(Assignment(Var("dscale", "double"), "sqrt(3.)/3"))
-    for II in range(max_l+1):
-        for JJ in range(II, max_l+1):
-            body = generate_updates(lc, II, JJ, dest)
-            body = Statements(body)
-            condition = And(Condition(II_var, Op.EQ, Var(II)), Condition(JJ_var, Op.EQ, Var(JJ)))
-            statements.append(If(condition, body, has_else=II+JJ>0))
+    if any([uses_dscale([lc], II, JJ, spherical) for II, JJ in shell_pairs(max_l, shells)]):
+        statements.append(dscale_assignment(precision))
+    for i, (II, JJ) in enumerate(shell_pairs(max_l, shells)):
+        pair_engine = block_engine(II, JJ, engine, block_engines)
+        if spherical:
+            body = generate_spherical_updates(lc, II, JJ, dest, precision=precision, engine=pair_engine)
+        else:
+            body = generate_updates(lc, II, JJ, dest, precision, pair_engine)
+        if screen:
+            body = screening_prologue(lc, II, JJ, spherical, precision) + body
+        body = Statements(body)
+        condition = And(Condition(II_var, Op.EQ, Var(II)), Condition(JJ_var, Op.EQ, Var(JJ)))
+        statements.append(If(condition, body, has_else=i>0))
     body = Statements(statements)
     
-    params = copy.deepcopy(integral_params)
-    params += [Var("factor", "double"), II_var, JJ_var, Var("I","int"), Var("J","int")]
-    params += [Var(f"{dest}{x}", "double **") for x in "xyz"]
+    params = integral_params_for(precision)
+    params += [Var("factor", precision.accumulate), II_var, JJ_var, Var("I","int"), Var("J","int")]
+    params += [Var(f"{dest}{x}", f"{precision.accumulate} **") for x in component_names(lc)]
+    if screen:
+        params.append(threshold_var(precision))
     function = Function("void", f"update{funcname}", params, body)
+    return scheduling.schedule_tree(function) if schedule else function
+
+# Kernel entry point update{funcname}Kernel of update{funcname} (see update_function), which the GPU emitters
+# print as a kernel. Thread s of the launch runs the primitives pair_start[s] to pair_start[s+1]-1 of
+# contracted shell pair s, which has angular momenta (pair_II[s], pair_JJ[s]) with pair_II[s] <= pair_JJ[s]
+# and starts at basis functions (pair_I[s], pair_J[s]). Primitive p is (GA[p], GB[p], GC[p], Z[p], factor[p]).
+# Every shell pair has to be listed once, so no two threads add into the same outputs.
+# global_id() is the index of the thread, which the emitters translate.
+def update_kernel(lc : L, dest : str, funcname : str, screen : bool=False,
+                  precision : Precision=double_precision) -> Function:
+    s = Int("s")
+    p = Int("p")
+    pair_arrays = ["pair_start", "pair_II", "pair_JJ", "pair_I", "pair_J"]
+    primitive_arrays = [(f"G{A}", precision.vector) for A in "ABC"]
+    primitive_arrays += [("Z", precision.real), ("factor", precision.accumulate)]
+    outputs = [Var(f"{dest}{x}", f"{precision.accumulate} **") for x in component_names(lc)]
+    params = [Int("npairs")] + [Var(name, "const int *") for name in pair_arrays]
+    params += [Var(name, f"const {typename} *") for name, typename in primitive_arrays] + outputs
+    args = [Element(Array(name, typename), p) for name, typename in primitive_arrays]
+    args += [Element(Array(name, "int"), s) for name in pair_arrays[1:]] + outputs
+    if screen:
+        params.append(threshold_var(precision))
+        args.append(threshold_var(precision))
+    pair_start = Array("pair_start", "int")
+    primitives = default_for(p, Element(pair_start, s), Element(pair_start, Operation(Op.ADD, s, Var(1))),
+                             Statements(Call(f"update{funcname}", args)))
+    body = [Assignment(s, Call("global_id")), If(Condition(s, Op.LT, Var("npairs")), Statements(primitives))]
+    return Function("void", f"update{funcname}Kernel", params, Statements(body))
+
+def generate_update_func(lc : L, dest : str, funcname : str, function_disclaimer : str, max_l : L,
+                         omp_driver : bool=False, screen : bool=False, spherical : bool=False,
+                         precision : Precision=double_precision, shells : Sequence[L]=None, engine : str=None,
+                         block_engines : Dict[Tuple[L, L], str]=None, schedule : bool=False):
+    function = update_function(lc, dest, funcname, max_l, screen, spherical, precision, shells, engine, block_engines,
+                               schedule)
+    if omp_driver:
+        functions = [function, generate_update_driver(lc, dest, funcname, max_l, screen, spherical, precision)]
+        if screen:
+            functions.insert(1, generate_pair_compaction(lc, funcname, max_l, spherical, precision))
+        return str(Statements(functions))
     return str(function)
 
+# Host driver for update{funcname} that runs over a list of primitive shell pairs with OpenMP.
+# Element p of the list is one primitive (GA, GB, GC, Z, factor) of the shell pair with angular
+# momenta (pair_II[p], pair_JJ[p]) starting at basis functions (pair_I[p], pair_J[p]), with
+# pair_II[p] <= pair_JJ[p]. Every thread computes a pair into its own shell block buffer on the stack
+# and adds the block into the outputs with atomics, so the memory doesn't grow with the threads.
+# With screen, the insignificant pairs are compacted away before the parallel loop (see
+# generate_pair_compaction). If there is no memory for the compacted list, all pairs are run,
+# which gives the same result since update{funcname} screens every pair itself.
+def generate_update_driver(lc : L, dest : str, funcname : str, max_l : L, screen : bool=False, spherical : bool=False,
+                           precision : Precision=double_precision) -> Statements:
+    ncomp = NFS[lc]
+    components = component_names(lc)
+    nfs = [2*l + 1 for l in range(max_l + 1)] if spherical else NFS[:max_l + 1]
+    nfmax = max(nfs)
+    block_size = ncomp*nfmax*nfmax
+    p = Int("p")
+    npairs = Int("npairs")
+    pair_params = [Var(f"pair_{x}", "const int *") for x in ["II", "JJ", "I", "J"]]
+    params = [npairs] + pair_params
+    params += [Var(G, f"const {precision.vector} *") for G in GX]
+    params += [Var("Z", f"const {precision.real} *"), Var("factor", f"const {precision.accumulate} *")]
+    params += [Var(f"{dest}{x}", f"{precision.accumulate} **") for x in components]
+    if screen:
+        params.append(threshold_var(precision))
+    real = precision.accumulate # type of the block buffers
+
+    statements = [Assignment(Var("nf[]", "const int"), "{{{}}}".format(", ".join([str(n) for n in nfs])))]
+    if screen:
+        statements.append(Assignment(Var("work", "int *"), "(int *)malloc(npairs*sizeof(int))"))
+        statements.append(Assignment(Int("nwork"), npairs))
+        compact_args = [npairs, Var("pair_II"), Var("pair_JJ")] + [Var(G) for G in GX]
+        compact_args += [Var("Z"), Var("factor"), threshold_var(precision), Var("work")]
+        compact = Assignment(Var("nwork"), Call(f"compact{funcname}Pairs", compact_args), declare=False)
+        statements.append(If(Condition(Var("work"), Op.NEQ, Var("nullptr")), Statements(compact)))
 
-def generate_updates_gpu(lc : L, II : L, JJ : L, dest : str) -> Statements:
+    # every pair is computed into block at I = J = 0, added into the outputs and zeroed again
+    parallel = [Assignment(Var(f"block[{block_size}]", real), "{}")]
+    parallel.append(Declaration(Var(f"rows[{ncomp*nfmax}]", f"{real} *")))
+    r = Int("r")
+    set_row = Assignment(Var("rows[r]"), f"block + r*{nfmax}", declare=False)
+    parallel.append(default_for(r, zero, Var(f"{ncomp*nfmax}"), Statements(set_row)))
+    args = [Var(f"{G}[p]") for G in GX] + [Var("Z[p]"), Var("factor[p]"), Var("pair_II[p]"), Var("pair_JJ[p]"), zero, zero]
+    args += [Var(f"rows + {mc*nfmax}") for mc in range(ncomp)]
+    if screen:
+        args.append(threshold_var(precision))
+    i = Int("i")
+    j = Int("j")
+    add = []
+    for mc, x in enumerate(components):
+        element = f"block[{mc*nfmax*nfmax} + i*{nfmax} + j]"
+        add.append(Macro("pragma", ["omp atomic"]))
+        add.append(Update(f"{dest}{x}[pair_I[p] + i][pair_J[p] + j]", Op.PLUSEQ, element))
+        add.append(Assignment(Var(element), zero, declare=False))
+    pair = [Call(f"update{funcname}", args)]
+    pair.append(default_for(i, zero, Var("nf[pair_II[p]]"), Statements(default_for(j, zero, Var("nf[pair_JJ[p]]"), Statements(add)))))
+    parallel.append(Macro("pragma", ["omp for schedule(dynamic)"]))
+    if screen:
+        w = Int("w")
+        pair.insert(0, Assignment(Var("p", "const int"), "work != nullptr ? work[w] : w"))
+        parallel.append(default_for(w, zero, Var("nwork"), Statements(pair)))
+    else:
+        parallel.append(default_for(p, zero, npairs, Statements(pair)))
+    statements.append(Macro("pragma", ["omp parallel"]))
+    statements.append(Container("", None, Statements(parallel)))
+    if screen:
+        statements.append(Call("free", [Var("work")]))
+    # the driver brings its own include for malloc, so that it works in any file
+    includes = [Include("cstdlib", False)]*int(screen)
+    return Statements(includes + [Function("void", f"update{funcname}_omp", params, Statements(statements))])
+
+
+######### SCREENING ########
+
+
+# Screening skips the primitive pairs whose contribution to a shell-pair block is below threshold in magnitude.
+# With (s|s|s) = 1, an integral is the mean of (x-A)^a (x-B)^b (x-C)^c over a normalized Gaussian about P
+# with variance Z in every direction. With x-A = (x-P) + GA, Minkowski's inequality bounds the integrals of
+# a block by max(1, g + sqrt(N Z))^N, where N = II + JJ + lc and g is the largest component of GA, GB and GC.
+# The spherical blocks also scale by the largest row sums of the transformations, and dscale is below 1.
+# The update functions test |factor| times the bound, since factor carries the prefactor of the pair
+# (its contraction coefficients, (pi/p)^(3/2) and exp(GA.GB/(2Z)) = exp(-ab/p |A-B|^2)). The contracted
+# kernels compute that prefactor as K themselves and test |factor K| times the bound for every primitive pair.
+def threshold_var(precision : Precision=double_precision) -> Var:
+    return Var("threshold", precision.real)
+
+# Largest sum of the magnitudes of a row of spherical.transformation_matrix(l)
+def spherical_norm(l : L) -> float:
+    return max([sum([abs(c) for c in row]) for row in spherical.transformation_matrix(l)])
+
+# Components of GA, GB and GC. The GPU kernels only compute them inside their loops, so there they come
+# from the centers.
+def center_differences(gpu : bool=False) -> List[str]:
+    if gpu:
+        return [f"G.{x}-{A}.{x}" for A in "ABC" for x in "xyz"]
+    return [f"G{A}.{x}" for A in "ABC" for x in "xyz"]
+
+# Computes the bound on the integrals of a block with N = II + JJ + lc into bound, times scale.
+# N and scale may be expressions, for the functions that bound pairs of any angular momenta.
+def integral_bound(N : Value, precision : Precision=double_precision, scale : Value=None,
+                   centers : List[str]=None, Z : str="Z") -> List[Statement]:
+    if centers is None:
+        centers = center_differences()
+    fabs, fmax = precision.math("fabs"), precision.math("fmax")
+    gmax = Call(fabs, [Var(centers[0])])
+    for center in centers[1:]:
+        gmax = Call(fmax, [gmax, Call(fabs, [Var(center)])])
+    base = Call(fmax, [Constant(precision.literal("1.")),
+                       Operation(Op.ADD, Var("gmax"), Call(precision.math("sqrt"), [Product([N, Var(Z)])]))])
+    bound = Call(precision.math("pow"), [base, N])
+    if scale is not None:
+        bound = Product([scale, bound])
+    return [Assignment(Real("gmax", precision), gmax), Assignment(Real("bound", precision), bound)]
+
+# |weight| * bound compared to the threshold, with op LT for the test that skips and GE for the one that keeps
+def bound_test(weight : Value, op : Operator, precision : Precision=double_precision) -> Condition:
+    # weight is factor or factor times K, so it is in the accumulation type
+    fabs = precision.math("fabs") if precision.accumulate == precision.real else "fabs"
+    return Condition(Product([Call(fabs, [weight]), Var("bound")]), op, threshold_var(precision))
+
+# Scale of the bound of the block (II, JJ): None for Cartesian blocks
+def block_scale(II : L, JJ : L, spherical : bool=False, precision : Precision=double_precision) -> Value:
+    if not spherical or max(II, JJ) < 2:
+        return None
+    return Constant(precision.literal(repr(spherical_norm(II) * spherical_norm(JJ))))
+
+# Returns from a block of the per-primitive update functions whose contribution is below the threshold
+def screening_prologue(lc : L, II : L, JJ : L, spherical : bool=False, precision : Precision=double_precision,
+                       gpu : bool=False) -> List[Statement]:
+    bound = integral_bound(Constant(II + JJ + lc), precision, block_scale(II, JJ, spherical, precision),
+                           center_differences(gpu))
+    return bound + [If(bound_test(Var("factor"), Op.LT, precision), Statements(Return()))]
+
+# Emits compact{funcname}Pairs, which writes the indices of the significant primitive pairs into work and
+# returns how many there are, with the bound of the update functions for the shell pair of each.
+# The update drivers and batched kernels can then iterate over only the pairs that contribute.
+def generate_pair_compaction(lc : L, funcname : str, max_l : L, spherical : bool=False,
+                             precision : Precision=double_precision) -> Function:
+    p = Int("p")
+    npairs = Int("npairs")
+    nwork = Int("nwork")
+    statements = [Assignment(nwork, zero)]
+    scale = None
+    if spherical and max_l >= 2:
+        norms = [precision.literal(repr(spherical_norm(l))) for l in range(max_l + 1)]
+        statements.append(Assignment(Var("norms[]", f"const {precision.real}"), "{{{}}}".format(", ".join(norms))))
+        scale = Var("norms[pair_II[p]]*norms[pair_JJ[p]]")
+    centers = [f"{G}[p].{x}" for G in GX for x in "xyz"]
+    body = integral_bound(Parens(Var(f"pair_II[p] + pair_JJ[p] + {lc}")), precision, scale, centers, "Z[p]")
+    body.append(If(bound_test(Var("factor[p]"), Op.GE, precision),
+                   Statements(Assignment(Var("work[nwork++]"), p, declare=False))))
+    statements.append(default_for(p, zero, npairs, Statements(body)))
+    statements.append(Return(nwork))
+    params = [npairs] + [Var(f"pair_{x}", "const int *") for x in ["II", "JJ"]]
+    params += [Var(G, f"const {precision.vector} *") for G in GX]
+    params += [Var("Z", f"const {precision.real} *"), Var("factor", f"const {precision.accumulate} *")]
+    params += [threshold_var(precision), Var("work", "int *")]
+    return Function("int", f"compact{funcname}Pairs", params, Statements(statements))
+
+
+# Blocks of at most this many integrals are unrolled in the templated GPU update functions
+default_unroll_threshold = 64
+
+# Calculate GA, GB, GC
+def gpu_center_differences(precision : Precision=double_precision) -> List[Statement]:
+    return [Assignment(Var(f"G{A}",precision.vector),f"{{G.x-{A}.x,G.y-{A}.y,G.z-{A}.z}}",True) for A in "ABC"]
+
+def generate_updates_gpu(lc : L, II : L, JJ : L, dest : str, precision : Precision=double_precision,
+                         engine : str=None) -> Statements:
     assert II <= JJ
-    I_var = Var("I", "int")
-    J_var = Var("J", "int")
     updates = []
-    # Calculate GA, GB, GC, Z
-    updates += [Assignment(Var(f"G{A}","double3"),f"{{G.x-{A}.x,G.y-{A}.y,G.z-{A}.z}}",True) for A in "ABC"]
+    abcs = []
 
     for mi in range(NFS[II]):
         for mj in range(NFS[JJ]):
@@ -177,14 +622,27 @@ def generate_updates_gpu(lc : L, II : L, JJ : L, dest : str) -> Statements:
             for mc in range(NFS[lc]):
                 c = gauss.index_to_n(lc, mc)
                 abc = (a,b,c)
-                funcname = gauss.abc_to_funcname(abc)
-                variable_name = variable_name_separate(dest, c, mi, mj)
-                rhs = Call(funcname, integral_params)
-                rhs = Product(["dscale"]*num_dscales(abc) + [rhs])
+                abcs.append(abc)
+                variable_name = variable_name_separate(dest, c, mi, mj, precision)
+                rhs = integral_value(abc, precision, engine)
+                rhs = accumulated(Product(["dscale"]*num_dscales(abc) + [rhs]), precision)
                 statement = Update(variable_name, Op.PLUSEQ, rhs)
                 updates.append(statement)
-    body = Statements(updates)
+    if engine is not None:
+        updates = engine_intermediates(abcs, engine, precision) + updates
+    return gpu_pair_loops(gpu_center_differences(precision) + updates)
+
+def generate_spherical_updates_gpu(lc : L, II : L, JJ : L, dest : str, precision : Precision=double_precision,
+                                   engine : str=None) -> Statements:
+    updates = gpu_center_differences(precision)
+    updates += generate_spherical_updates(lc, II, JJ, dest, factor=False, precision=precision, engine=engine)
+    return gpu_pair_loops(updates)
 
+# Wraps the updates of one shell pair in the loops over its basis functions
+def gpu_pair_loops(updates : List[Statement]) -> Statements:
+    I_var = Var("I", "int")
+    J_var = Var("J", "int")
+    body = Statements(updates)
     I_start = Var("I_start", "int")
     J_start = Var("J_start", "int")
     I_end = Operation(Op.ADD, I_start, Var("ni", "int"))
@@ -193,18 +651,600 @@ def generate_updates_gpu(lc : L, II : L, JJ : L, dest : str) -> Statements:
     body = default_for(J_var, J_start, J_end, body)
     return Statements(body)
 
-def generate_update_func_gpu(lc : L, dest : str, funcname : str, function_disclaimer : str, max_l : L):
+def generate_update_func_gpu(lc : L, dest : str, funcname : str, function_disclaimer : str, max_l : L,
+                             screen : bool=False, spherical : bool=False, precision : Precision=double_precision,
+                             shells : Sequence[L]=None, templated : bool=False,
+                             unroll_threshold : int=default_unroll_threshold, engine : str=None,
+                             block_engines : Dict[Tuple[L, L], str]=None, schedule : bool=False):
+    if templated: # loops over the integrals, there are no blocks to schedule
+        if spherical or engine is not None or block_engines:
+            raise ValueError("Templated GPU update functions are Cartesian only and call the integrals directly")
+        return generate_update_func_gpu_templated(lc, dest, funcname, max_l, screen, precision, shells, unroll_threshold)
     II_var = Var("II", "int")
     JJ_var = Var("JJ", "int")
     # params = copy.deepcopy(integral_params)
-    params = [Var("C", "double3")]
-    params += [Var("factor", "double")] 
-    params += [Var(f"{dest}{x}", "double **") for x in "xyz"]
+    params = [Var("C", precision.vector)]
+    params += [Var("factor", precision.accumulate)] 
+    params += [Var(f"{dest}{x}", f"{precision.accumulate} **") for x in component_names(lc)]
+    if screen:
+        params.append(threshold_var(precision))
     statements = [];
+    for II, JJ in shell_pairs(max_l, shells):
+        pair_engine = block_engine(II, JJ, engine, block_engines)
+        if spherical:
+            body = generate_spherical_updates_gpu(lc, II, JJ, dest, precision, pair_engine)
+        else:
+            body = generate_updates_gpu(lc, II, JJ, dest, precision, pair_engine)
+        if screen:
+            body = Statements(screening_prologue(lc, II, JJ, spherical, precision, gpu=True) + body.statements)
+        func = Function("__global__ void", f"update{funcname}<{II},{JJ}>", params, body) 
+        statements.append(func)
+    statements = Statements(statements)
+    return scheduling.schedule_tree(statements) if schedule else statements
+
+# Compact alternative to generate_update_func_gpu: a single template <int II, int JJ> kernel instead of a
+# fully unrolled body per shell pair, whose code grows as NFS[II]*NFS[JJ]*NFS[lc].
+# The kernel loops over the integrals of the block, looking up the components in __constant__ tables, and
+# calls the integrals through a switch on their orbitals. Blocks of at most unroll_threshold integrals
+# are unrolled by the compiler, which folds the table lookups and the switch back into direct calls.
+# Larger blocks stay loops. The threshold can be overridden with -DUPDATE<FUNCNAME>_UNROLL=n.
+def generate_update_func_gpu_templated(lc : L, dest : str, funcname : str, max_l : L, screen : bool=False,
+                                       precision : Precision=double_precision, shells : Sequence[L]=None,
+                                       unroll_threshold : int=default_unroll_threshold) -> Statements:
+    pairs = shell_pairs(max_l, shells)
+    orbitals = gauss.generate_orbitals(max(max_l, lc))
+    abcs = [(gauss.index_to_n(II, mi), gauss.index_to_n(JJ, mj), gauss.index_to_n(lc, mc))
+            for II, JJ in pairs for mi in range(NFS[II]) for mj in range(NFS[JJ]) for mc in range(NFS[lc])]
+    statements = gpu_component_tables(funcname, orbitals, max(max_l, lc), precision)
+    statements.append(generate_integral_switch_gpu(f"{funcname}Integral", abcs, orbitals, precision))
+
+    unroll = f"update{funcname}_UNROLL".upper()
+    statements += [Macro("ifndef", [unroll]), Define(unroll, unroll_threshold), Macro("endif"), Empty()]
+
+    params = [Var("C", precision.vector)]
+    params += [Var("factor", precision.accumulate)]
+    params += [Var(f"{dest}{x}", f"{precision.accumulate} **") for x in component_names(lc)]
+    if screen:
+        params.append(threshold_var(precision))
+    components, scales = [f"{funcname}_{table}" for table in ["components", "scales"]]
+    m = Int("m")
+    block = [Assignment(Var("mi", "const int"), f"m / (nfj*{NFS[lc]})")]
+    block.append(Assignment(Var("mj", "const int"), f"m / {NFS[lc]} % nfj"))
+    block.append(Assignment(Var("mc", "const int"), f"m % {NFS[lc]}"))
+    block.append(Assignment(Var("a", "const int"), f"{components}[II][mi]"))
+    block.append(Assignment(Var("b", "const int"), f"{components}[JJ][mj]"))
+    block.append(Assignment(Var("c", "const int"), f"{components}[{lc}][mc]"))
+    rhs = Call(f"{funcname}Integral", [Var("a"), Var("b"), Var("c")] + integral_params)
+    rhs = accumulated(Product([Var(f"{scales}[{x}]") for x in "abc"] + [rhs]), precision)
+    block.append(Update("outputs[mc][I+mi][J+mj]", Op.PLUSEQ, rhs))
+    updates = gpu_center_differences(precision)
+    # the unroll count has to be a constant expression, so the component counts come from II and JJ, not a table
+    updates.append(Assignment(Var("nfi", "constexpr int"), "(II+1)*(II+2)/2"))
+    updates.append(Assignment(Var("nfj", "constexpr int"), "(JJ+1)*(JJ+2)/2"))
+    updates.append(Assignment(Var("n", "constexpr int"), f"nfi*nfj*{NFS[lc]}"))
+    updates.append(Macro("pragma", [f"unroll (n <= {unroll} ? n : 1)"]))
+    updates.append(default_for(m, zero, Var("n"), Statements(block)))
+    body = [Assignment(Var(f"outputs[{NFS[lc]}]", f"{precision.accumulate} **"),
+                       "{{{}}}".format(", ".join([f"{dest}{x}" for x in component_names(lc)])))]
+    if screen:
+        body = integral_bound(Parens(Var(f"II+JJ+{lc}")), precision, centers=center_differences(gpu=True)) + \
+               [If(bound_test(Var("factor"), Op.LT, precision), Statements(Return()))] + body
+    body += gpu_pair_loops(updates).statements
+    statements.append(Function("template <int II, int JJ>\n__global__ void", f"update{funcname}", params, Statements(body)))
+
+    # explicit instantiations of the shell pairs
+    for II, JJ in pairs:
+        instance = Function("template __global__ void", f"update{funcname}<{II}, {JJ}>", params, Statements(), declaration=True)
+        instance.newline = False
+        statements.append(instance)
+    return Statements(statements)
+
+# Tables of the templated GPU update functions, in terms of the orbitals of gaussians.generate_orbitals:
+#     {funcname}_components[l][m]  orbital of component m of shell l, in the order of the update functions
+#     {funcname}_scales[orbital]   dscale for dxx, dyy and dzz, 1 otherwise
+# The kernels index them at run time in the blocks that aren't unrolled, so they live in __constant__ memory:
+# namespace scope constexpr arrays are host only.
+def gpu_component_tables(funcname : str, orbitals : List[N], max_l : L, precision : Precision=double_precision) -> List[Statement]:
+    rows = []
+    for l in range(max_l+1):
+        row = [orbitals.index(gauss.index_to_n(l, m)) for m in range(NFS[l])] + [0]*(NFS[max_l] - NFS[l])
+        rows.append("{{{}}}".format(", ".join([str(i) for i in row])))
+    dscale = repr(3**0.5/3)
+    scales = [precision.literal(dscale if requires_dscale(n) else "1.") for n in orbitals]
+    return [Assignment(Var(f"{funcname}_components[{max_l+1}][{NFS[max_l]}]", "__constant__ int"), "{{{}}}".format(", ".join(rows))),
+            Assignment(Var(f"{funcname}_scales[{len(orbitals)}]", f"__constant__ {precision.real}"), "{{{}}}".format(", ".join(scales))),
+            Empty()]
+
+# __device__ function returning the integral of orbitals (a, b, c) (indices into orbitals) for the triples in abcs.
+# With constant a, b and c, as in unrolled loops, the compiler reduces it to the call of that integral.
+def generate_integral_switch_gpu(name : str, abcs : Sequence[ABC], orbitals : List[N],
+                                 precision : Precision=double_precision) -> Function:
+    norb = len(orbitals)
+    cases = {}
+    for abc in abcs:
+        a, b, c = [orbitals.index(n) for n in abc]
+        cases[(a*norb + b)*norb + c] = integral_call(abc, precision)
+    body = [Case(key, Return(cases[key])) for key in sorted(cases)]
+    switch = Switch(f"(a*{norb} + b)*{norb} + c", Statements(body))
+    params = [Int("a"), Int("b"), Int("c")] + integral_params_for(precision)
+    return Function(f"__device__ inline {precision.real}", name, params, Statements([switch, Return(Constant(precision.literal("0.")))]))
+
+
+######### VECTORIZABLE CPU UPDATE FUNCTIONS ########
+
+
+# The CPU backend in generate_update_func is one scalar call per primitive with a branch on (II, JJ).
+# Here every (II, JJ) gets its own function that loops over a batch of n primitives (the pair/center
+# dimension). Inputs are structure-of-arrays and every output component is a contiguous
+# __restrict__ array of length n, laid out as dest[(mi*NFS[JJ] + mj)*n + k], so the loop over k has
+# unit-stride loads and stores and can be vectorized by GCC/Clang.
+# The integrals need to be visible to the compiler, see generate_inline_integral_header.
+
+def restrict_in(t : str) -> str:
+    return f"const {t} * __restrict__"
+def restrict_out(t : str) -> str:
+    return f"{t} * __restrict__"
+
+def simd_params(lc : L, dest : str, precision : Precision=double_precision) -> List[Var]:
+    params = [Int("n")]
+    params += [Var(f"{G}{x}", restrict_in(precision.real)) for G in GX for x in "xyz"]
+    params += [Var("Z", restrict_in(precision.real)), Var("factor", restrict_in(precision.accumulate))]
+    params += [Var(f"{dest}{x}", restrict_out(precision.accumulate)) for x in component_names(lc)]
+    return params
+
+def generate_updates_simd(lc : L, II : L, JJ : L, dest : str, omp_simd : bool=False,
+                          precision : Precision=double_precision) -> Statements:
+    assert II <= JJ
+    k = Int("k")
+    n = Var("n")
+    # The double3 arguments are built as temporaries in every call rather than as locals,
+    # because GCC won't vectorize an omp simd loop with aggregate locals.
+    body = [Assignment(Var("Zk", precision.real), "Z[k]")]
+    body.append(Assignment(Var("factork", precision.accumulate), "factor[k]"))
+    args = [Var("{1}{{{0}x[k], {0}y[k], {0}z[k]}}".format(G, precision.vector)) for G in GX] + [Var("Zk")]
+    for mi in range(NFS[II]):
+        for mj in range(NFS[JJ]):
+            a = gauss.index_to_n(II, mi)
+            b = gauss.index_to_n(JJ, mj)
+            for mc in range(NFS[lc]):
+                c = gauss.index_to_n(lc, mc)
+                abc = (a,b,c)
+                element = f"{dest}{xyz_suffix(c)}[{mi*NFS[JJ] + mj}*n + k]"
+                rhs = integral_call(abc, precision, args)
+                rhs = Product([Var("factork"), accumulated(Product(["dscale"]*num_dscales(abc) + [rhs]), precision)])
+                body.append(Update(element, Op.PLUSEQ, rhs))
+    statements = [dscale_assignment(precision, f"const {precision.real}")] if uses_dscale([lc], II, JJ) else []
+    if omp_simd:
+        statements.append(Macro("pragma", ["omp simd"]))
+    statements.append(default_for(k, zero, n, Statements(body)))
+    return Statements(statements)
+
+# Emits update{funcname}_simd_{II}_{JJ} for every II <= JJ <= max_l, plus a dispatch table and an
+# update{funcname}_simd(II, JJ, ...) entry point that looks up the specialized function. Like the If chain
+# of generate_update_func, the entry point does nothing for shell pairs it has no function for.
+def generate_update_func_simd(lc : L, dest : str, funcname : str, function_disclaimer : str, max_l : L,
+                              omp_simd : bool=False, precision : Precision=double_precision,
+                              shells : Sequence[L]=None) -> Statements:
+    params = simd_params(lc, dest, precision)
+    name = f"update{funcname}_simd"
+    statements = []
+    pairs = shell_pairs(max_l, shells)
+    for II, JJ in pairs:
+        body = generate_updates_simd(lc, II, JJ, dest, omp_simd, precision)
+        statements.append(Function("static void", f"{name}_{II}_{JJ}", params, body))
+
+    # dispatch table, only the generated pairs (II <= JJ) are filled in
+    param_types = ", ".join([p.typename for p in params])
+    statements.append(Declaration(Var(f"(*{name}_t)({param_types})", "typedef void")))
+    rows = []
     for II in range(max_l+1):
-        for JJ in range(II, max_l+1):
-            body = generate_updates_gpu(lc, II, JJ, dest)
-            func = Function("__global__ void", f"update{funcname}<{II},{JJ}>", params, body) 
-            statements.append(func)
+        row = [f"{name}_{II}_{JJ}" if (II, JJ) in pairs else "0" for JJ in range(max_l+1)]
+        rows.append("{{{}}}".format(", ".join(row)))
+    table = Var(f"{name}_table[{max_l+1}][{max_l+1}]", f"static const {name}_t")
+    statements.append(Assignment(table, "{{{}}}".format(", ".join(rows))))
+    statements.append(Empty())
+
+    II_var = Int("II")
+    JJ_var = Int("JJ")
+    args = [Var(p.name) for p in params]
+    condition = And(Condition(zero, Op.LE, II_var), Condition(II_var, Op.LE, JJ_var),
+                    Condition(JJ_var, Op.LE, Var(max_l)), Condition(Var(f"{name}_table[II][JJ]"), Op.NEQ, zero))
+    body = Statements(If(condition, Statements(Call(f"{name}_table[II][JJ]", args))))
+    statements.append(Function("void", name, [II_var, JJ_var] + params, body))
+    return Statements(statements)
+
+
+######### ARBITRARY ORDER MULTIPOLES ########
+
+
+# The update functions above call one integral function per (a|b|c), so every order needs its own
+# integral functions and each order is its own pass over the shell pairs.
+# Here the multipole integrals are built inside the kernel with the Obara-Saika recursion on c,
+#     (a|b|c+1_i) = GC_i (a|b|c) + Z [N_i(a) (a-1_i|b|c) + N_i(b) (a|b-1_i|c) + N_i(c) (a|b|c-1_i)]
+# starting from the overlap-type integrals (a|b|s). Only (a|b|s) functions are called, so any
+# order lc works, and when several orders are requested the lower ones are shared intermediates.
+
+# Returns None for base integrals, otherwise the (coefficient, ABC) terms of one step of a recursion.
+# A coefficient of None is 1.
+Terms = List[Tuple[Value, ABC]]
+
+def lower_c(abc : ABC) -> Terms:
+    a, b, c = abc
+    if c == (0,0,0):
+        return None
+    i = max(range(3), key=lambda i: c[i])
+    abc1 = gauss.succession(2, i, abc)
+    terms = [(Var(f"GC.{'xyz'[i]}"), abc1)]
+    for j in range(3):
+        n = abc1[j][i]
+        if n > 0:
+            coefficient = Var("Z") if n == 1 else Product([Constant(str(n)), Var("Z")])
+            terms.append((coefficient, gauss.succession(j, i, abc1)))
+    return terms
+
+# Two-stage alternative to lower_c (see symbolic.transfer_integral). The horizontal recursion moves the
+# angular momentum of C and then B onto A,
+#     (a|b|c+1_i) = (a+1_i|b|c) + (GC_i - GA_i) (a|b|c)
+# and the vertical recursion builds (a|s|s) from (s|s|s),
+#     (a+1_i|s|s) = GA_i (a|s|s) + Z N_i(a) (a-1_i|s|s)
+# so a block only calls S_S_S, and the intermediates are shared between all the integrals of the block.
+# Every step costs one or two multiply-adds, where lower_c calls a function for every (a|b|s).
+def lower_hrr(abc : ABC) -> Terms:
+    for j in [2, 1]:
+        n = abc[j]
+        if n != (0,0,0):
+            i = max(range(3), key=lambda i: n[i])
+            abc1 = gauss.succession(j, i, abc)
+            difference = Parens(Operation(Op.SUB, Var(f"{GX[j]}.{'xyz'[i]}"), Var(f"GA.{'xyz'[i]}")))
+            return [(None, gauss.promotion(0, i, abc1)), (difference, abc1)]
+    a = abc[0]
+    if a == (0,0,0):
+        return None
+    i = max(range(3), key=lambda i: a[i])
+    abc1 = gauss.succession(0, i, abc)
+    terms = [(Var(f"GA.{'xyz'[i]}"), abc1)]
+    n = abc1[0][i]
+    if n > 0:
+        coefficient = Var("Z") if n == 1 else Product([Constant(str(n)), Var("Z")])
+        terms.append((coefficient, gauss.succession(0, i, abc1)))
+    return terms
+
+# All integrals needed for targets under a recursion, ordered so that every integral comes after
+# the integrals it depends on.
+def recursion_plan(targets : Sequence[ABC], lower) -> List[ABC]:
+    order = []
+    seen = set()
+    def visit(abc):
+        if abc in seen:
+            return
+        seen.add(abc)
+        terms = lower(abc)
+        if terms is not None:
+            for _, dependency in terms:
+                visit(dependency)
+        order.append(abc)
+    for abc in targets:
+        visit(abc)
+    return order
+
+def intermediate_name(abc : ABC) -> str:
+    return "t_" + gauss.abc_to_funcname(abc)
+
+# Local variable definitions for all the integrals needed for targets. Base integrals are
+# function calls, the rest are sums over the recursion terms.
+def generate_intermediates(targets : Sequence[ABC], lower=lower_c, precision : Precision=double_precision) -> List[Statement]:
+    statements = []
+    for abc in recursion_plan(targets, lower):
+        terms = lower(abc)
+        if terms is None:
+            rhs = integral_call(abc, precision)
+        else:
+            rhs = op_reduce(Op.ADD, [Var(intermediate_name(dependency)) if coefficient is None
+                                     else Product([coefficient, Var(intermediate_name(dependency))])
+                                     for coefficient, dependency in terms])
+        statements.append(Assignment(Real(intermediate_name(abc), precision), rhs))
+    return statements
+
+# McMurchie-Davidson intermediates (see symbolic.hermite_integral): every integral is the product of a
+# Hermite expansion coefficient per axis, t_S_Px_Dxy = Ex_0_1_0_0 * Ey_0_0_1_0 * Ez_0_0_0_0, and the
+# coefficients E{i}_{a}_{b}_{c}_{t} only depend on the exponents along their axis, so a whole block of
+# integrals shares a few of them. lower_hermite is the recursion on the coefficients,
+#     E^{a b c+1}_t = Z E^{a b c}_{t-1} + GC_i E^{a b c}_t + (t+1) E^{a b c}_{t+1}
+# on nodes (i, (a, b, c), t), with E^{000}_0 = 1 as the base.
+Hermite = Tuple[int, Tuple[L, L, L], int]
+def lower_hermite(node : Hermite) -> List[Tuple[Value, Hermite]]:
+    i, n, t = node
+    if n == (0,0,0):
+        return None
+    j = max([j for j in range(3) if n[j] > 0]) # C first, then B, then A
+    m = tuple([nj - (k == j) for k, nj in enumerate(n)])
+    terms = []
+    if t > 0:
+        terms.append((Var("Z"), (i, m, t-1)))
+    if t <= sum(m):
+        terms.append((Var(f"{GX[j]}.{'xyz'[i]}"), (i, m, t)))
+    if t+1 <= sum(m):
+        terms.append((None if t == 0 else Constant(str(t+1)), (i, m, t+1)))
+    return terms
+
+def hermite_name(node : Hermite) -> str:
+    i, n, t = node
+    return "E{}_{}_{}_{}_{}".format("xyz"[i], *n, t)
+
+def generate_hermite_intermediates(targets : Sequence[ABC], precision : Precision=double_precision) -> List[Statement]:
+    factors = {abc : [(i, tuple([a[i] for a in abc]), 0) for i in range(3)] for abc in targets}
+    base = (0,0,0)
+    statements = []
+    for node in recursion_plan([node for abc in targets for node in factors[abc] if node[1] != base], lower_hermite):
+        terms = lower_hermite(node)
+        if terms is None:
+            continue
+        values = []
+        for coefficient, dependency in terms:
+            if dependency[1] == base: # E^{000}_0 = 1
+                values.append(Constant("1") if coefficient is None else coefficient)
+            else:
+                value = Var(hermite_name(dependency))
+                values.append(value if coefficient is None else Product([coefficient, value]))
+        statements.append(Assignment(Real(hermite_name(node), precision), op_reduce(Op.ADD, values)))
+    for abc in targets:
+        values = [Var(hermite_name(node)) for node in factors[abc] if node[1] != base]
+        statements.append(Assignment(Real(intermediate_name(abc), precision), Product(values) if values else Constant("1")))
+    return statements
+
+# Integral engines of the update functions, which define intermediate_name(abc) for every integral of a block:
+#     os   the Obara-Saika recursion on c from the (a|b|s) functions (lower_c)
+#     hrr  the horizontal transfer from S_S_S (lower_hrr)
+#     md   products of McMurchie-Davidson coefficients per axis (generate_hermite_intermediates)
+def engine_intermediates(targets : Sequence[ABC], engine : str, precision : Precision=double_precision) -> List[Statement]:
+    if engine is None:
+        raise ValueError("Intermediates need an engine (os, hrr or md), None stands for calls to the integral functions")
+    if engine == "md":
+        return generate_hermite_intermediates(list(dict.fromkeys(targets)), precision)
+    lowers = {"os" : lower_c, "hrr" : lower_hrr}
+    if engine not in lowers:
+        raise ValueError("Unknown integral engine '{}', expected one of os, hrr, md".format(engine))
+    return generate_intermediates(targets, lowers[engine], precision)
+
+# Multipole components of all requested orders are packed into one array of output matrices,
+# order after order, in index order within each order (e.g. orders [1, 2]: x, y, z, xy, xz, ...)
+def packed_offset(orders : Sequence[L], lc : L) -> int:
+    return sum([NFS[l] for l in orders[:orders.index(lc)]])
+
+# engine None is the engine of the registry (see integrals.registry_for), like in the rest of the generator
+def generate_multipole_updates(orders : Sequence[L], II : L, JJ : L, dest : str, factor : bool=True,
+                               precision : Precision=double_precision, engine : str=None) -> List[Statement]:
+    assert II <= JJ
+    engine = registry_for(engine).engine
+    outputs = []
+    for lc in orders:
+        for mi in range(NFS[II]):
+            for mj in range(NFS[JJ]):
+                a = gauss.index_to_n(II, mi)
+                b = gauss.index_to_n(JJ, mj)
+                for mc in range(NFS[lc]):
+                    c = gauss.index_to_n(lc, mc)
+                    outputs.append(((a,b,c), packed_offset(orders, lc) + mc, mi, mj))
+    statements = engine_intermediates([abc for abc, _, _, _ in outputs], engine, precision)
+    for abc, p, mi, mj in outputs:
+        rhs = [accumulated(Product(["dscale"]*num_dscales(abc) + [Var(intermediate_name(abc))]), precision)]
+        if factor:
+            rhs = [Var("factor")] + rhs
+        statements.append(Update(f"{dest}[{p}][I+{mi}][J+{mj}]", Op.PLUSEQ, Product(rhs)))
+    return statements
+
+# CPU update function for the multipoles of all orders in orders, in the style of generate_update_func.
+# The outputs are packed into dest (see packed_offset), e.g. for orders [1, 2, 3] dest has 3+6+10 matrices.
+# engine picks how the intermediates are built (see engine_intermediates). Sharing the intermediates between
+# the orders is what these kernels are for, so unlike in generate_update_func, where engine None calls the
+# integral functions, None is the engine of the registry (see integrals.registry_for).
+def generate_multipole_func(orders : Sequence[L], dest : str, funcname : str, function_disclaimer : str, max_l : L,
+                            precision : Precision=double_precision, shells : Sequence[L]=None, engine : str=None,
+                            schedule : bool=False):
+    orders = sorted(set(orders))
+    engine = registry_for(engine).engine
+    II_var = Var("II", "int")
+    JJ_var = Var("JJ", "int")
+    statements = []
+    if any([uses_dscale(orders, II, JJ) for II, JJ in shell_pairs(max_l, shells)]):
+        statements.append(dscale_assignment(precision))
+    for i, (II, JJ) in enumerate(shell_pairs(max_l, shells)):
+        body = Statements(generate_multipole_updates(orders, II, JJ, dest, precision=precision, engine=engine))
+        condition = And(Condition(II_var, Op.EQ, Var(II)), Condition(JJ_var, Op.EQ, Var(JJ)))
+        statements.append(If(condition, body, has_else=i>0))
+    body = Statements(statements)
+
+    params = integral_params_for(precision)
+    params += [Var("factor", precision.accumulate), II_var, JJ_var, Var("I","int"), Var("J","int")]
+    params += [Var(dest, f"{precision.accumulate} ***")]
+    function = Function("void", f"update{funcname}", params, body)
+    return str(scheduling.schedule_tree(function) if schedule else function)
+
+
+######### FUSED MULTI-PROPERTY KERNELS ########
+
+
+# A property integral written by the fused kernels: the multipole of order lc, into the matrices
+# {dest}{xyz} (e.g. Dx, Dy, Dz for the dipole, just S for the overlap)
+@dataclass
+class Property:
+    name : str
+    lc : L
+    dest : str
+overlap = Property("Overlap", 0, "S")
+dipole = Property("Dipole", 1, "D")
+quadrupole = Property("Quadrupole", 2, "Q")
+octupole = Property("Octupole", 3, "O")
+
+# One kernel body for the shell pair (II, JJ) that writes every property in properties.
+# GA, GB, GC are computed once and all integrals come from one set of shared intermediates,
+# built with the same recursion as generate_multipole_updates (engine None is the engine of the registry).
+def generate_fused_updates_gpu(properties : Sequence[Property], II : L, JJ : L,
+                               precision : Precision=double_precision, engine : str=None) -> Statements:
+    assert II <= JJ
+    engine = registry_for(engine).engine
+    updates = gpu_center_differences(precision)
+    outputs = []
+    for prop in properties:
+        for mi in range(NFS[II]):
+            for mj in range(NFS[JJ]):
+                a = gauss.index_to_n(II, mi)
+                b = gauss.index_to_n(JJ, mj)
+                for mc in range(NFS[prop.lc]):
+                    c = gauss.index_to_n(prop.lc, mc)
+                    outputs.append(((a,b,c), variable_name_separate(prop.dest, c, mi, mj, precision)))
+    updates += engine_intermediates([abc for abc, _ in outputs], engine, precision)
+    for abc, variable_name in outputs:
+        rhs = accumulated(Product(["dscale"]*num_dscales(abc) + [Var(intermediate_name(abc))]), precision)
+        updates.append(Update(variable_name, Op.PLUSEQ, rhs))
+    return gpu_pair_loops(updates)
+
+# Like generate_update_func_gpu, but one kernel per (II, JJ) computes all the properties at once.
+# Like generate_multipole_func, it always builds the integrals with an engine, that of the registry for None.
+def generate_fused_update_func_gpu(properties : Sequence[Property], funcname : str, function_disclaimer : str,
+                                   max_l : L, screen : bool=False, precision : Precision=double_precision,
+                                   shells : Sequence[L]=None, engine : str=None, schedule : bool=False) -> Statements:
+    engine = registry_for(engine).engine
+    dests = [prop.dest for prop in properties]
+    if len(set(dests)) != len(dests):
+        raise ValueError("Properties {} don't have distinct outputs".format(", ".join([prop.name for prop in properties])))
+    params = [Var("C", precision.vector)]
+    params += [Var("factor", precision.accumulate)]
+    for prop in properties:
+        params += [Var(f"{prop.dest}{x}", f"{precision.accumulate} **") for x in component_names(prop.lc)]
+    if screen:
+        params.append(threshold_var(precision))
+    statements = []
+    for II, JJ in shell_pairs(max_l, shells):
+        body = generate_fused_updates_gpu(properties, II, JJ, precision, engine)
+        if screen: # the bound of the highest order bounds the others too
+            lc = max([prop.lc for prop in properties])
+            body = Statements(screening_prologue(lc, II, JJ, precision=precision, gpu=True) + body.statements)
+        func = Function("__global__ void", f"update{funcname}<{II},{JJ}>", params, body)
+        statements.append(func)
     statements = Statements(statements)
+    return scheduling.schedule_tree(statements) if schedule else statements
+
+
+######### CONTRACTED SHELL PAIRS ########
+
+
+# The update functions above handle one primitive pair: the caller works out GA, GB, GC and Z of the
+# product Gaussian and passes the prefactor of the pair in factor, so a contracted shell pair takes a
+# call (or launch) per pair of primitives, each of which adds into the output matrices.
+# The contracted update functions take the shells instead, as centers A and B with primitives
+#     alpha[i], ca[i] (i < na) and beta[j], cb[j] (j < nb)
+# where the contraction coefficients include the normalization of the primitives. For every pair of
+# primitives they build the product Gaussian,
+#     p = alpha + beta,  Z = 1/(2p),  P = (alpha A + beta B)/p,  GA = P - A,  GB = P - B,  GC = P - C
+#     K = ca cb (pi/p)^(3/2) exp(-alpha beta/p |A - B|^2)
+# where K is the overlap (s|s), which scales the integrals from (s|s|s) = 1. The block of the shell pair
+# is summed over the primitives in local accumulators, and the outputs are written once, times factor.
+
+def contracted_params(precision : Precision=double_precision) -> List[Var]:
+    params = [Var(X, precision.vector) for X in "ABC"]
+    for exponent, coefficient, n in [("alpha", "ca", "na"), ("beta", "cb", "nb")]:
+        params += [Var(exponent, f"const {precision.real} *"), Var(coefficient, f"const {precision.real} *"), Int(n)]
+    return params
+
+# A - B and |A - B|^2, which don't depend on the primitives
+def contracted_prologue(precision : Precision=double_precision) -> List[Statement]:
+    return [Assignment(Var("AB", precision.vector), "{A.x-B.x,A.y-B.y,A.z-B.z}"),
+            Assignment(Real("AB2", precision), "AB.x*AB.x + AB.y*AB.y + AB.z*AB.z")]
+
+# Z, GA, GB, GC and the prefactor K of the primitive pair (i, j), in the names the integrals and
+# the engine intermediates use
+def primitive_pair(precision : Precision=double_precision) -> List[Statement]:
+    real = precision.real
+    pi = precision.literal("3.141592653589793")
+    sqrt, exp = precision.math("sqrt"), precision.math("exp")
+    return [Assignment(Var("p", f"const {real}"), "alpha[i] + beta[j]"),
+            Assignment(Var("Z", f"const {real}"), "{}/(2*p)".format(precision.literal("1."))),
+            Assignment(Var("GA", precision.vector), "{-beta[j]*AB.x/p,-beta[j]*AB.y/p,-beta[j]*AB.z/p}"),
+            Assignment(Var("GB", precision.vector), "{alpha[i]*AB.x/p,alpha[i]*AB.y/p,alpha[i]*AB.z/p}"),
+            Assignment(Var("GC", precision.vector), "{{{}}}".format(",".join(
+                [f"(alpha[i]*A.{x} + beta[j]*B.{x})/p - C.{x}" for x in "xyz"]))),
+            Assignment(Var("pi_p", f"const {real}"), f"{pi}/p"),
+            Assignment(Var("K", f"const {real}"), f"ca[i]*cb[j]*pi_p*{sqrt}(pi_p)*{exp}(-alpha[i]*beta[j]/p*AB2)")]
+
+# The block of the shell pair (II, JJ) of generate_updates (or generate_spherical_updates), summed over
+# the primitive pairs: every output element gets an accumulator, which is written once after the loops.
+# With threads (the GPU kernels), the primitive pairs ij = i*nb + j are spread over the threads of the launch
+# with a grid-stride loop, and every thread adds its partial sums into the outputs with atomicAdd.
+# With screen, the primitive pairs whose contribution is below the threshold are skipped (see integral_bound).
+def generate_contracted_updates(lc : L, II : L, JJ : L, dest : str, spherical : bool=False,
+                                precision : Precision=double_precision, engine : str=None,
+                                threads : bool=False, screen : bool=False) -> List[Statement]:
+    if spherical:
+        block = generate_spherical_updates(lc, II, JJ, dest, factor=False, precision=precision, engine=engine)
+    else:
+        block = generate_updates(lc, II, JJ, dest, precision, engine, factor=False)
+    outputs = [statement for statement in block if isinstance(statement, Update)]
+    accumulators = [Var(f"acc{k}", precision.accumulate) for k in range(len(outputs))]
+    statements = [Assignment(acc, Constant("0")) for acc in accumulators]
+    primitive = [statement for statement in block if not isinstance(statement, Update)]
+    primitive += [Update(acc.name, Op.PLUSEQ, Product([Var("K"), update.val])) for acc, update in zip(accumulators, outputs)]
+    if screen: # the primitive pairs below the threshold are skipped
+        bound = integral_bound(Constant(II + JJ + lc), precision, block_scale(II, JJ, spherical, precision))
+        significant = bound_test(Product([Var("factor"), Var("K")]), Op.GE, precision)
+        primitive = bound + [If(significant, Statements(primitive))]
+    primitive = primitive_pair(precision) + primitive
+    if threads:
+        ij = Int("ij")
+        pair = [Assignment(Var("i", "const int"), "ij / nb"), Assignment(Var("j", "const int"), "ij % nb")]
+        stride = Update(ij, Op.PLUSEQ, Var("blockDim.x*gridDim.x"))
+        statements.append(For(Assignment(ij, "blockIdx.x*blockDim.x + threadIdx.x"), Condition(ij, Op.LT, Var("na*nb")),
+                              stride, Statements(pair + primitive)))
+        statements += [Call("atomicAdd", [Var(f"&{update.var}"), Product([Var("factor"), Var(acc.name)])])
+                       for acc, update in zip(accumulators, outputs)]
+        return statements
+    loop = default_for(Int("j"), zero, Var("nb"), Statements(primitive))
+    statements.append(default_for(Int("i"), zero, Var("na"), Statements(loop)))
+    statements += [Update(update.var, Op.PLUSEQ, Product([Var("factor"), Var(acc.name)])) for acc, update in zip(accumulators, outputs)]
     return statements
+
+# Contracted counterpart of generate_update_func: update{funcname}_contracted adds factor times the
+# integrals of the contracted shell pair (II, JJ) into the outputs at basis functions (I, J).
+def generate_contracted_update_func(lc : L, dest : str, funcname : str, function_disclaimer : str, max_l : L,
+                                    screen : bool=False, spherical : bool=False, precision : Precision=double_precision,
+                                    shells : Sequence[L]=None, engine : str=None,
+                                    block_engines : Dict[Tuple[L, L], str]=None, schedule : bool=False) -> str:
+    II_var = Var("II", "int")
+    JJ_var = Var("JJ", "int")
+    statements = contracted_prologue(precision)
+    if any([uses_dscale([lc], II, JJ, spherical) for II, JJ in shell_pairs(max_l, shells)]):
+        statements = [dscale_assignment(precision)] + statements
+    for i, (II, JJ) in enumerate(shell_pairs(max_l, shells)):
+        pair_engine = block_engine(II, JJ, engine, block_engines)
+        body = Statements(generate_contracted_updates(lc, II, JJ, dest, spherical, precision, pair_engine, screen=screen))
+        condition = And(Condition(II_var, Op.EQ, Var(II)), Condition(JJ_var, Op.EQ, Var(JJ)))
+        statements.append(If(condition, body, has_else=i>0))
+
+    params = contracted_params(precision)
+    params += [Var("factor", precision.accumulate), II_var, JJ_var, Var("I","int"), Var("J","int")]
+    params += [Var(f"{dest}{x}", f"{precision.accumulate} **") for x in component_names(lc)]
+    if screen:
+        params.append(threshold_var(precision))
+    function = Function("void", f"update{funcname}_contracted", params, Statements(statements))
+    return str(scheduling.schedule_tree(function) if schedule else function)
+
+# Contracted counterpart of generate_update_func_gpu, one kernel per shell pair. Every thread sums its share of
+# the primitive pairs in registers and adds it into the outputs once, so any launch configuration works.
+# The outputs are added to with atomicAdd, which needs compute capability 6.0 or higher in double precision.
+def generate_contracted_update_func_gpu(lc : L, dest : str, funcname : str, function_disclaimer : str, max_l : L,
+                                        screen : bool=False, spherical : bool=False, precision : Precision=double_precision,
+                                        shells : Sequence[L]=None, engine : str=None,
+                                        block_engines : Dict[Tuple[L, L], str]=None, schedule : bool=False) -> Statements:
+    params = contracted_params(precision)
+    params += [Var("factor", precision.accumulate), Var("I","int"), Var("J","int")]
+    params += [Var(f"{dest}{x}", f"{precision.accumulate} **") for x in component_names(lc)]
+    if screen:
+        params.append(threshold_var(precision))
+    statements = []
+    for II, JJ in shell_pairs(max_l, shells):
+        body = [dscale_assignment(precision)]*int(uses_dscale([lc], II, JJ, spherical)) + contracted_prologue(precision)
+        body += generate_contracted_updates(lc, II, JJ, dest, spherical, precision,
+                                            block_engine(II, JJ, engine, block_engines), threads=True, screen=screen)
+        statements.append(Function("__global__ void", f"update{funcname}_contracted<{II},{JJ}>", params, Statements(body)))
+    statements = Statements(statements)
+    return scheduling.schedule_tree(statements) if schedule else statements
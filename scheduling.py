@@ -0,0 +1,227 @@
+# Ordering of the straight-line code of the update blocks for fewer live values.
+# The blocks define every intermediate first and then issue the updates in (mi, mj, mc) order, so the
+# intermediates an update reads stay live from the start of the block until that update, and a high L block
+# holds far more values than there are registers. Assignments and updates only depend on each other through
+# the names they define and read, so runs of them can be reordered: the scheduler issues the updates in order
+# and computes every intermediate just before the first update that needs it, and updates whose inputs are
+# all ready go first, so values retire soon after they are made. Ready updates are issued by output matrix and
+# element, which groups writes to adjacent elements.
+# Liveness is estimated on the temporaries the code defines (see peak_live): these are what the compiler has
+# to keep in registers or spill.
+
+import re
+import heapq
+import argparse
+from typing import List, Sequence, Set, Tuple
+
+import gaussians as gauss
+import integrals
+from gaussians import L # types
+from metacode import *
+
+######### Dependences ###########
+
+# Names read by a tree of values, including the identifiers in code written out as strings (like "dscale")
+def read_names(node) -> List[str]:
+    if isinstance(node, str):
+        return re.findall(r"[A-Za-z_]\w*", node)
+    if isinstance(node, Variable):
+        return [node.name] if isinstance(node.name, str) else []
+    if isinstance(node, (list, tuple)):
+        children = node
+    elif isinstance(node, (Statement, Value)):
+        children = vars(node).values()
+    else:
+        children = []
+    names = []
+    for child in children:
+        names += [name for name in read_names(child) if name not in names]
+    return names
+
+# Statements the scheduler can move: the rest (loops, branches, comments) keep their place and split the runs
+def is_straight_line(statement) -> bool:
+    return isinstance(statement, (Assignment, Update))
+
+# Names a statement defines and reads. An update reads and writes its output element, named by its code.
+def defined_and_read(statement) -> Tuple[List[str], List[str]]:
+    if isinstance(statement, Assignment):
+        return [statement.var.name], read_names(statement.rhs)
+    location = str(statement.var)
+    return [location], [location] + read_names(statement.val)
+
+# For every statement, the earlier statements it has to stay after: the last definition of every name it reads
+# or defines, and the reads of every name it defines since that name was last defined
+def dependences(statements : Sequence[Statement]) -> List[Set[int]]:
+    deps = []
+    last_definition = {}
+    reads_since = {}
+    for i, statement in enumerate(statements):
+        defined, read = defined_and_read(statement)
+        statement_deps = set()
+        for name in read:
+            if name in last_definition:
+                statement_deps.add(last_definition[name])
+                reads_since[name].append(i)
+        for name in defined:
+            if name in last_definition:
+                statement_deps.add(last_definition[name])
+                statement_deps.update(reads_since[name])
+            last_definition[name] = i
+            reads_since[name] = []
+        statement_deps.discard(i)
+        deps.append(statement_deps)
+    return deps
+
+
+######### Liveness ###########
+
+# Most temporaries of straight-line statements that are live at once. A temporary is live from its
+# definition to its last read. Names the statements don't define (parameters, outputs) aren't counted.
+def peak_live(statements : Sequence[Statement]) -> int:
+    ranges = []
+    current = {}
+    for i, statement in enumerate(statements):
+        if not is_straight_line(statement):
+            continue
+        defined, read = defined_and_read(statement)
+        for name in read:
+            if name in current:
+                current[name][1] = i
+        if isinstance(statement, Assignment):
+            if statement.var.name in current:
+                ranges.append(current[statement.var.name])
+            current[statement.var.name] = [i, i]
+    ranges += current.values()
+    changes = {}
+    for start, end in ranges:
+        if end > start:
+            changes[start] = changes.get(start, 0) + 1
+            changes[end] = changes.get(end, 0) - 1
+    peak = live = 0
+    for i in sorted(changes):
+        live += changes[i]
+        peak = max(peak, live)
+    return peak
+
+
+######### Scheduling ###########
+
+# Matrix an update writes, e.g. "Dx" for Dx[I+0][J+1] or "M[3]" for M[3][I+0][J+1]
+def output_group(statement : Statement) -> str:
+    if not isinstance(statement, Update):
+        return ""
+    if isinstance(statement.var, Element):
+        return statement.var.array.name
+    return re.sub(r"(\[[^\]]*[IJ][^\]]*\])+$", "", str(statement.var))
+
+def schedule_run(statements : Sequence[Statement]) -> List[Statement]:
+    n = len(statements)
+    deps = dependences(statements)
+    consumers = [[] for _ in range(n)]
+    for i, statement_deps in enumerate(deps):
+        for d in statement_deps:
+            consumers[d].append(i)
+    sinks = [i for i in range(n) if not consumers[i]]
+    rank = {i : r for r, i in enumerate(sorted(sinks, key=lambda i: (output_group(statements[i]), i)))}
+    missing = [len(statement_deps) for statement_deps in deps]
+    ready = [(rank[i], i) for i in sinks if missing[i] == 0]
+    heapq.heapify(ready)
+    issued = [False]*n
+    order = []
+
+    def issue(i):
+        issued[i] = True
+        order.append(i)
+        for c in consumers[i]:
+            missing[c] -= 1
+            if missing[c] == 0 and c in rank:
+                heapq.heappush(ready, (rank[c], c))
+
+    # issues i after everything it depends on that isn't issued yet, depth first
+    def issue_with_inputs(i):
+        stack = [i]
+        while stack:
+            pending = [d for d in sorted(deps[stack[-1]]) if not issued[d]]
+            if pending:
+                stack.append(pending[0])
+            else:
+                j = stack.pop()
+                if not issued[j]:
+                    issue(j)
+
+    next_sink = 0
+    while len(order) < n:
+        if ready:
+            _, i = heapq.heappop(ready)
+            if not issued[i]:
+                issue(i)
+            continue
+        while issued[sinks[next_sink]]:
+            next_sink += 1
+        issue_with_inputs(sinks[next_sink])
+    return [statements[i] for i in order]
+
+# Statements with every run of assignments and updates reordered for fewer live values
+def schedule(statements : Sequence[Statement]) -> List[Statement]:
+    scheduled = []
+    run = []
+    for statement in list(statements) + [None]:
+        if statement is not None and is_straight_line(statement):
+            run.append(statement)
+            continue
+        scheduled += schedule_run(run) if run else []
+        run = []
+        if statement is not None:
+            scheduled.append(statement)
+    return scheduled
+
+# Schedules the bodies of a tree of statements (functions, loops, branches) in place and returns it
+def schedule_tree(node):
+    if isinstance(node, Statements):
+        node.statements = schedule(node.statements)
+        for statement in node.statements:
+            schedule_tree(statement)
+    elif isinstance(node, Container):
+        schedule_tree(node.body)
+    elif isinstance(node, list):
+        for statement in node:
+            schedule_tree(statement)
+    return node
+
+
+######### Report ###########
+
+# Statements, temporaries and peak live temporaries of every block of an update function, as emitted
+# and as scheduled
+def block_report(lc : L, max_l : L, engine : str=None, gpu : bool=False) -> List[dict]:
+    import printing # imported here so that printing can import this module
+    report = []
+    for II, JJ in printing.shell_pairs(max_l):
+        if gpu:
+            body = printing.generate_updates_gpu(lc, II, JJ, "M", engine=engine)
+            block = body.statements[0].body.body.statements # inside the loops over J and I
+        else:
+            block = printing.generate_updates(lc, II, JJ, "M", engine=engine)
+        report.append({"block" : "".join([gauss.orbital_names[l] for l in [II, JJ, lc]]),
+                       "statements" : len(block),
+                       "temporaries" : len([s for s in block if isinstance(s, Assignment)]),
+                       "peak_live" : peak_live(block),
+                       "scheduled_peak_live" : peak_live(schedule(block))})
+    return report
+
+def format_report(report : List[dict]) -> str:
+    lines = ["{:<6} {:>10} {:>11} {:>9} {:>9}".format("block", "statements", "temporaries", "peak live", "scheduled")]
+    for r in report:
+        lines.append("{:<6} {:>10} {:>11} {:>9} {:>9}".format(r["block"], r["statements"], r["temporaries"],
+                                                              r["peak_live"], r["scheduled_peak_live"]))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Report the peak live values of the update blocks before and after scheduling')
+    parser.add_argument('L', type=int, help='Maximum angular momentum of the shell pairs')
+    parser.add_argument('--lc', type=int, default=1, help='Multipole order of the update blocks')
+    parser.add_argument('--engine', choices=integrals.engine_names, default=None,
+                        help='Engine that builds the integrals inside the blocks (default: calls to the integrals)')
+    parser.add_argument('--gpu', action='store_true', help='Blocks of the gpu kernels instead of the cpu update function')
+    args = parser.parse_args()
+    print(format_report(block_report(args.lc, args.L, args.engine, args.gpu)))
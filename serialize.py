@@ -0,0 +1,297 @@
+# Binary format for the metacode expressions of the integrals.
+# Downstream tools (validators, other backends, language bindings) can read the derived integrals from a file
+# instead of running SymPy or parsing C again. Identical subexpressions are stored once, so an integral is a
+# DAG over a flat table of nodes, and all names and numbers live in a string table. Every section is a plain
+# little-endian array, so a file is read with mmap and NumPy views, without copying or parsing.
+#
+# Layout (every section starts at a multiple of 8 bytes):
+#     header   magic, version, the sizes of the sections and the engine the integrals were derived with
+#              (header_dtype)
+#     nodes    node_dtype: kind, operator, and a, b, c whose meaning depends on the kind
+#                  VARIABLE   a name, b typename (or -1)
+#                  CONSTANT   a text
+#                  OPERATION  op index into operators, a left node, b right node (or -1 for unary operators)
+#                  PARENS     a inner node
+#                  CAST       a typename, b inner node
+#                  CALL       a name, b first argument in args, c number of arguments
+#              children always come before their parents
+#     args     int32 node indices of the call arguments
+#     roots    root_dtype: name (e.g. S_Px_Dxy), node, code (the C source of the integral) and canonical,
+#              permutation and sign (its canonical form for deduplication, see symbolic.canonical_form), or -1
+#     offsets  uint32 start of every string in the string bytes, plus the end
+#     strings  UTF-8 bytes
+
+import os
+import mmap
+import argparse
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+import gaussians as gauss
+from gaussians import L, ABC # types
+from metacode import *
+import integrals
+from integrals import IntegralRegistry, registry_for
+
+magic = b"PY1EAST\0"
+version = 2
+
+VARIABLE, CONSTANT, OPERATION, PARENS, CAST, CALL = range(6)
+# operators by index, part of the format: only append to this list
+operators = [Op.ADD, Op.SUB, Op.MUL, Op.DIV, Op.NEGATE, Op.LT, Op.LE, Op.GT, Op.GE, Op.EQ, Op.NEQ, Op.AND, Op.OR, Op.NOT]
+
+header_dtype = np.dtype([("magic", "S8"), ("version", "<u4"), ("nodes", "<u4"), ("args", "<u4"), ("roots", "<u4"),
+                         ("strings", "<u4"), ("string_bytes", "<u4"), ("engine", "S8")])
+node_dtype = np.dtype([("kind", "u1"), ("op", "u1"), ("pad", "<u2"), ("a", "<i4"), ("b", "<i4"), ("c", "<i4")])
+root_dtype = np.dtype([("name", "<i4"), ("node", "<i4"), ("code", "<i4"),
+                       ("canonical", "<i4"), ("permutation", "i1", (3,)), ("sign", "i1")])
+
+def aligned(size : int) -> int:
+    return (size + 7) // 8 * 8
+
+######### Writing ###########
+
+# Flattens values into the tables, sharing identical subexpressions and strings
+class TableWriter:
+    def __init__(self):
+        self.nodes : List[tuple] = []
+        self.args : List[int] = []
+        self.strings : List[str] = []
+        self.node_index : Dict[tuple, int] = {}
+        self.string_index : Dict[str, int] = {}
+
+    def string(self, s : str) -> int:
+        if s is None:
+            return -1
+        if s not in self.string_index:
+            self.string_index[s] = len(self.strings)
+            self.strings.append(s)
+        return self.string_index[s]
+
+    def node(self, kind : int, op : int=0, a : int=-1, b : int=-1, c : int=-1, args : tuple=()) -> int:
+        key = (kind, op, a, b, c, args)
+        if key not in self.node_index:
+            self.node_index[key] = len(self.nodes)
+            self.nodes.append((kind, op, 0, a, b, c))
+        return self.node_index[key]
+
+    def add(self, value : Value) -> int:
+        if isinstance(value, Constant):
+            return self.node(CONSTANT, a=self.string(str(value.name)))
+        if isinstance(value, Variable):
+            return self.node(VARIABLE, a=self.string(str(value.name)), b=self.string(value.typename))
+        if isinstance(value, OpTree):
+            if value.op not in operators:
+                raise ValueError("Operator {} can't be serialized".format(value.op))
+            right = -1 if value.right is None else self.add(value.right)
+            return self.node(OPERATION, operators.index(value.op), self.add(value.left), right)
+        if isinstance(value, Parens):
+            return self.node(PARENS, a=self.add(value.val))
+        if isinstance(value, Cast):
+            return self.node(CAST, a=self.string(value.typename), b=self.add(value.val))
+        if isinstance(value, Call):
+            args = tuple([self.add(arg) for arg in value.args])
+            key = (CALL, 0, self.string(value.name), -1, len(args), args)
+            if key not in self.node_index:
+                self.node_index[key] = len(self.nodes)
+                self.nodes.append((CALL, 0, 0, key[2], len(self.args), len(args)))
+                self.args += list(args)
+            return self.node_index[key]
+        if isinstance(value, str): # the update functions sometimes hold plain C
+            return self.node(VARIABLE, a=self.string(value))
+        raise ValueError("Values of type {} can't be serialized".format(type(value).__name__))
+
+# Writes the values ({name : Value}) to filename, optionally with their C sources ({name : code}), canonical
+# forms ({name : (canonical, permutation, sign)}) and the engine they were derived with
+def write_values(filename : str, values : Dict[str, Value], codes : Dict[str, str]=None,
+                 canonicals : Dict[str, Tuple[str, Tuple[int, int, int], int]]=None, engine : str=None) -> None:
+    writer = TableWriter()
+    roots = []
+    for name, value in values.items():
+        code = None if codes is None else codes.get(name)
+        canonical, permutation, sign = (None, (-1, -1, -1), 0) if canonicals is None or name not in canonicals else canonicals[name]
+        roots.append((writer.string(name), writer.add(value), writer.string(code), writer.string(canonical), permutation, sign))
+    encoded = [s.encode() for s in writer.strings]
+    offsets = np.zeros(len(encoded) + 1, dtype="<u4")
+    offsets[1:] = np.cumsum([len(s) for s in encoded])
+    header = np.array([(magic, version, len(writer.nodes), len(writer.args), len(roots), len(encoded), int(offsets[-1]),
+                        (engine or "").encode())], dtype=header_dtype)
+    sections = [header.tobytes(), np.array(writer.nodes, dtype=node_dtype).tobytes(),
+                np.array(writer.args, dtype="<i4").tobytes(), np.array(roots, dtype=root_dtype).tobytes(),
+                offsets.tobytes(), b"".join(encoded)]
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    temp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    with open(temp_filename, 'wb') as file:
+        for section in sections:
+            file.write(section)
+            file.write(b"\0" * (aligned(len(section)) - len(section)))
+    os.replace(temp_filename, filename)
+
+# Writes the integrals in abcs from the registry of engine (see integrals.registry_for), with the canonical
+# forms it already has
+def write_integrals(filename : str, abcs : Sequence[ABC], engine : str=None) -> None:
+    registry = registry_for(engine)
+    names = [gauss.abc_to_funcname(abc) for abc in abcs]
+    write_values(filename, {name : registry[abc] for name, abc in zip(names, abcs)},
+                 {name : registry.code(abc) for name, abc in zip(names, abcs)},
+                 {name : registry.canonicals[abc] for name, abc in zip(names, abcs) if abc in registry.canonicals},
+                 registry.engine)
+
+
+######### Reading ###########
+
+# A serialized file, mapped into memory. nodes, args and roots are NumPy views of the file, and values are
+# rebuilt from them on demand. engine is the engine the integrals were derived with, None if unknown.
+# The views stay valid after close as long as they are referenced: the file is then unmapped once they're gone.
+class ASTFile:
+    def __init__(self, filename : str):
+        self.filename = filename
+        with open(filename, 'rb') as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = np.frombuffer(self.mmap, dtype=header_dtype, count=1)[0]
+        if header["magic"] != magic.rstrip(b"\0"):
+            raise ValueError("{} is not a serialized integral file".format(filename))
+        if header["version"] != version:
+            raise ValueError("{} has format version {}, expected {}".format(filename, header["version"], version))
+        self.engine = header["engine"].decode() or None
+        offset = aligned(header_dtype.itemsize)
+        def section(dtype, count):
+            nonlocal offset
+            array = np.frombuffer(self.mmap, dtype=dtype, count=count, offset=offset)
+            offset += aligned(array.nbytes)
+            return array
+        self.nodes = section(node_dtype, int(header["nodes"]))
+        self.args = section("<i4", int(header["args"]))
+        self.roots = section(root_dtype, int(header["roots"]))
+        self.offsets = section("<u4", int(header["strings"]) + 1)
+        self.string_bytes = section("u1", int(header["string_bytes"]))
+        self.names = [self.string(i) for i in self.roots["name"]]
+        self.root_index = {name : i for i, name in enumerate(self.names)}
+        self.values : Dict[int, Value] = {}
+
+    def string(self, i : int) -> str:
+        if i < 0:
+            return None
+        return self.string_bytes[self.offsets[i]:self.offsets[i+1]].tobytes().decode()
+
+    def __contains__(self, name : str) -> bool:
+        return name in self.root_index
+    def __len__(self) -> int:
+        return len(self.names)
+
+    # metacode value of node i, sharing the values of shared nodes
+    def node_value(self, i : int) -> Value:
+        if i in self.values:
+            return self.values[i]
+        kind, op, _, a, b, c = self.nodes[i].tolist()
+        if kind == VARIABLE:
+            value = Var(self.string(a), self.string(b))
+        elif kind == CONSTANT:
+            value = Constant(self.string(a))
+        elif kind == OPERATION:
+            value = OpTree(operators[op], self.node_value(a), None if b < 0 else self.node_value(b))
+        elif kind == PARENS:
+            value = Parens(self.node_value(a))
+        elif kind == CAST:
+            value = Cast(self.string(a), self.node_value(b))
+        elif kind == CALL:
+            value = Call(self.string(a), [self.node_value(int(arg)) for arg in self.args[b:b+c]])
+        else:
+            raise ValueError("Unknown node kind {} in {}".format(kind, self.filename))
+        self.values[i] = value
+        return value
+
+    def __getitem__(self, name : str) -> Value:
+        return self.node_value(int(self.roots[self.root_index[name]]["node"]))
+
+    def code(self, name : str) -> str:
+        return self.string(int(self.roots[self.root_index[name]]["code"]))
+
+    # (canonical, permutation, sign) of the integral name, or None if it wasn't stored
+    def canonical(self, name : str) -> Tuple[str, Tuple[int, int, int], int]:
+        root = self.roots[self.root_index[name]]
+        if root["canonical"] < 0:
+            return None
+        return (self.string(int(root["canonical"])), tuple(root["permutation"].tolist()), int(root["sign"]))
+
+    # Evaluates the integral name with NumPy straight from the node table, on GA, GB, GC ((n, 3) arrays)
+    # and Z ((n,) array), without building metacode values
+    def evaluate(self, name : str, GA : np.ndarray, GB : np.ndarray, GC : np.ndarray, Z : np.ndarray) -> np.ndarray:
+        inputs = {"Z" : Z}
+        inputs.update({f"{G}.{x}" : vectors[:, i] for G, vectors in zip(["GA", "GB", "GC"], [GA, GB, GC])
+                       for i, x in enumerate("xyz")})
+        results = {}
+        def visit(i):
+            if i in results:
+                return results[i]
+            kind, op, _, a, b, c = self.nodes[i].tolist()
+            if kind == VARIABLE:
+                result = inputs[self.string(a)]
+            elif kind == CONSTANT:
+                result = float(self.string(a))
+            elif kind == OPERATION and b < 0:
+                result = -visit(a)
+            elif kind == OPERATION:
+                left, right = visit(a), visit(b)
+                result = {"+" : np.add, "-" : np.subtract, "*" : np.multiply, "/" : np.divide}[operators[op].symbol](left, right)
+            elif kind in [PARENS, CAST]:
+                result = visit(a if kind == PARENS else b)
+            elif kind == CALL:
+                result = getattr(np, {"pow" : "power", "fabs" : "abs"}.get(self.string(a), self.string(a)))(
+                    *[visit(int(arg)) for arg in self.args[b:b+c]])
+            results[i] = result
+            return result
+        return np.broadcast_to(visit(int(self.roots[self.root_index[name]]["node"])), Z.shape)
+
+    def close(self) -> None:
+        self.values = {}
+        self.nodes = self.args = self.roots = self.offsets = self.string_bytes = None
+        try:
+            self.mmap.close()
+        except BufferError: # the caller still holds views, the mapping is released with the last of them
+            pass
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+
+# Seeds registry (default: the integrals.registry) with the integrals of a serialized file, so they are
+# printed without deriving or parsing them again. The file has to be derived with the engine of the registry.
+def load_into_registry(filename : str, registry : IntegralRegistry=None) -> int:
+    if registry is None:
+        registry = registry_for(None)
+    with ASTFile(filename) as ast:
+        if ast.engine is not None and ast.engine != registry.engine:
+            raise ValueError("{} holds integrals derived with engine {}, not {}".format(filename, ast.engine, registry.engine))
+        for name in ast.names:
+            abc = registry.key(name)
+            registry.values[abc] = ast[name]
+            code = ast.code(name)
+            if code is not None:
+                registry.codes[abc] = code
+            canonical = ast.canonical(name)
+            if canonical is not None:
+                registry.canonicals[abc] = canonical
+        return len(ast)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serialize the integral expressions up to L')
+    parser.add_argument('L', type=int, help='Maximum angular momentum quantum desired')
+    parser.add_argument('-o', '--output', required=True, help='File to write')
+    parser.add_argument('--engine', choices=integrals.engine_names, default="os", help='Derivation of the integrals')
+    parser.add_argument('--cache-dir', default=os.path.join(os.path.expanduser("~"), ".cache", "py1e"),
+                        help='Where derived integrals are cached between runs (shared with main.py)')
+    args = parser.parse_args()
+
+    integrals.registry.use_engine(args.engine)
+    cache = integrals.cache_filename(args.cache_dir, args.engine)
+    integrals.registry.load(cache)
+    abcs = list(gauss.generate_triples(args.L))
+    for abc in abcs:
+        integrals.registry.canonical(abc)
+    write_integrals(args.output, abcs, args.engine)
+    integrals.registry.save(cache)
+    with ASTFile(args.output) as ast:
+        print("{} integrals, {} nodes, {} strings, {} bytes".format(len(ast), len(ast.nodes), len(ast.offsets) - 1,
+                                                                   os.path.getsize(args.output)))
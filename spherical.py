@@ -0,0 +1,94 @@
+# Cartesian to real spherical harmonic transformation of Gaussian shells.
+# Uses the expansion of the real solid harmonics in Cartesian monomials from
+# T. Helgaker, P. Jorgensen, J. Olsen, Molecular Electronic-Structure Theory, Eq. 6.4.47-6.4.50.
+# Everything is computed at generation time, so the emitted kernels only see numeric coefficients.
+
+from math import comb, copysign, sqrt
+from fractions import Fraction
+from typing import Dict, List
+
+import gaussians as gauss
+from gaussians import L, N # types
+
+# number of spherical functions at every angular momentum
+def num_spherical(l : L) -> int:
+    return 2*l + 1
+
+def double_factorial(n : int) -> int:
+    result = 1
+    while n > 1:
+        result *= n
+        n -= 2
+    return result
+
+# <x^n1 exp(-r^2)|x^n2 exp(-r^2)> up to a constant that only depends on the total angular momentum
+def monomial_overlap(n1 : N, n2 : N) -> int:
+    result = 1
+    for i in range(3):
+        k = n1[i] + n2[i]
+        if k % 2 == 1:
+            return 0
+        result *= double_factorial(k - 1)
+    return result
+
+# Squared norm, exact for rational coefficients
+def squared_norm(poly : Dict[N, Fraction]) -> Fraction:
+    return sum([c1 * c2 * monomial_overlap(n1, n2) for n1, c1 in poly.items() for n2, c2 in poly.items()])
+
+def polynomial_norm(poly : Dict[N, float]) -> float:
+    return sqrt(squared_norm(poly))
+
+# Monomial expansion {N : coefficient} of the real solid harmonic S_lm, m = -l..l, with the rational
+# coefficients of the book (not normalized)
+def rational_solid_harmonic(l : L, m : int) -> Dict[N, Fraction]:
+    am = abs(m)
+    poly = {}
+    for t in range((l - am)//2 + 1):
+        for u in range(t + 1):
+            # v = w + vm in the book, with vm = 1/2 for m < 0
+            for w in range((am - (m < 0))//2 + 1):
+                two_v = 2*w + (m < 0)
+                coefficient = Fraction((-1)**(t + w), 4**t) * comb(l, t) * comb(l - t, am + t) * comb(t, u) * comb(am, two_v)
+                n = (2*t + am - 2*u - two_v, 2*u + two_v, l - 2*t - am)
+                poly[n] = poly.get(n, 0) + coefficient
+    return {n : c for n, c in poly.items() if c != 0}
+
+# S_lm scaled to have the same norm as x^l
+def solid_harmonic(l : L, m : int) -> Dict[N, float]:
+    poly = rational_solid_harmonic(l, m)
+    scale = sqrt(squared_norm({(l, 0, 0) : Fraction(1)}) / squared_norm(poly))
+    return {n : float(c) * scale for n, c in poly.items()}
+
+# The coefficients of the transformation are square roots of rationals. They are carried exactly as their
+# squares with their sign, q = sign(c) c^2, and only rounded once when they are emitted, so unit
+# coefficients come out as exactly 1 and zeros as exactly 0.
+def from_signed_square(q : Fraction) -> float:
+    return copysign(sqrt(abs(q)), q)
+
+# Product of two coefficients given as signed squares, e.g. TI[si][mi] * TJ[sj][mj] of a shell pair
+def product(q1 : Fraction, q2 : Fraction) -> float:
+    return from_signed_square(q1 * q2)
+
+# signed_squares(l)[ms][mc] is T[ms][mc] of transformation_matrix as a signed square
+def signed_squares(l : L) -> List[List[Fraction]]:
+    ncart = (l+1)*(l+2)//2
+    if l <= 1:
+        return [[Fraction(int(i == j)) for j in range(ncart)] for i in range(ncart)]
+    components = [gauss.index_to_n(l, mc) for mc in range(ncart)]
+    reference = min([monomial_overlap(n, n) for n in components])
+    ratio2 = Fraction(reference, monomial_overlap((l, 0, 0), (l, 0, 0)))
+    norm2 = squared_norm({(l, 0, 0) : Fraction(1)})
+    matrix = []
+    for m in range(-l, l+1):
+        poly = rational_solid_harmonic(l, m)
+        scale2 = norm2 / squared_norm(poly) * ratio2
+        matrix.append([Fraction(int(c > 0) - int(c < 0)) * c * c * scale2 for c in [poly.get(n, Fraction(0)) for n in components]])
+    return matrix
+
+# Transformation matrix T[ms][mc] from the Cartesian functions of a shell (in gaussians.index_to_n order)
+# to its spherical functions (m = -l..l).
+# The Cartesian integrals are taken to share the normalization of the most compact components (dxy, fxyz, ...),
+# which is what the Cartesian kernels assume of factor before dscale fixes up dxx, dyy and dzz.
+# s and p shells are left as they are.
+def transformation_matrix(l : L) -> List[List[float]]:
+    return [[from_signed_square(q) for q in row] for row in signed_squares(l)]
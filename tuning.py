@@ -0,0 +1,207 @@
+# Emission strategy of every block of the update functions.
+# The block of a shell pair (II, JJ) of multipole order lc can be emitted as calls to the integral functions
+# ("direct") or built inside the kernel by one of the engines of printing.engine_intermediates. Which one is
+# fastest depends on the angular momenta: calls are cheap for a handful of small integrals, the shared
+# recursions win once a block has many integrals with common intermediates.
+# The static cost model estimates every candidate from the generated code. The autotuner times them instead,
+# through bench, and records the winners in a tuning file that main.py reads back (--tuning).
+
+import os
+import json
+import argparse
+from dataclasses import dataclass
+from typing import Dict, List, Sequence, Tuple
+
+import gaussians as gauss
+from gaussians import L # types
+import integrals
+import printing
+import build
+from metacode import Statements, Assignment, arithmetic_operations
+from scheduling import peak_live, schedule as schedule_block
+
+strategies = ["direct"] + integrals.engine_names # direct calls the integral functions
+
+# Weights of the cost model, in units of one floating point operation
+call_cost = 20 # call and argument passing of an integral function
+register_budget = 16 # floating point registers (x86-64 without AVX-512)
+spill_cost = 2 # store and reload of a value that doesn't fit in the registers
+
+Block = Tuple[L, L, L] # (lc, II, JJ)
+
+def strategy_engine(strategy : str) -> str:
+    return None if strategy == "direct" else strategy
+
+
+######### Cost model ###########
+
+@dataclass
+class BlockCost:
+    flops : int # in the block and the bodies of the integrals it calls
+    calls : int # calls of integral functions
+    temporaries : int # intermediates defined in the block
+    registers : int # most temporaries live at once
+    code_size : int # characters of C of the block
+
+    # Estimated cost in floating point operations
+    @property
+    def cost(self) -> float:
+        return self.flops + call_cost*self.calls + spill_cost*max(0, self.registers - register_budget)
+
+# schedule costs the block as ordered by scheduling.schedule, like main.py --schedule emits it, and spherical
+# the block of spherical outputs (printing.generate_spherical_updates). The contracted update functions run
+# the same blocks for every primitive pair.
+def block_cost(lc : L, II : L, JJ : L, strategy : str, schedule : bool=False, spherical : bool=False) -> BlockCost:
+    if spherical:
+        block = printing.generate_spherical_updates(lc, II, JJ, "M", engine=strategy_engine(strategy))
+    else:
+        block = printing.generate_updates(lc, II, JJ, "M", engine=strategy_engine(strategy))
+    if schedule:
+        block = schedule_block(block)
+    called = printing.referenced_integrals(Statements(block))
+    flops = arithmetic_operations(block) + sum([arithmetic_operations(integrals.registry[abc]) for abc in called])
+    temporaries = len([statement for statement in block if isinstance(statement, Assignment)])
+    return BlockCost(flops, len(called), temporaries, peak_live(block), len(str(Statements(block))))
+
+def block_costs(lc : L, II : L, JJ : L, schedule : bool=False, spherical : bool=False) -> Dict[str, BlockCost]:
+    return {strategy : block_cost(lc, II, JJ, strategy, schedule, spherical) for strategy in strategies}
+
+def cheapest(costs : Dict[str, BlockCost]) -> str:
+    return min(strategies, key=lambda strategy: costs[strategy].cost)
+
+# Cheapest strategy of every block under the cost model
+def model_strategies(orders : Sequence[L], max_l : L, shells : Sequence[L]=None,
+                     schedule : bool=False, spherical : bool=False) -> Dict[Block, str]:
+    chosen = {}
+    for lc in orders:
+        for II, JJ in printing.shell_pairs(max_l, shells):
+            chosen[(lc, II, JJ)] = cheapest(block_costs(lc, II, JJ, schedule, spherical))
+    return chosen
+
+# model_strategies as build targets, one per order, whose results (see build.BuildReport.results) are the
+# strategies of their blocks. The integrals whose operations the model counts are derived on the workers of the
+# build, and the orders are costed concurrently.
+def model_targets(orders : Sequence[L], max_l : L, shells : Sequence[L]=None, schedule : bool=False,
+                  spherical : bool=False) -> List[build.Target]:
+    targets = []
+    for lc in orders:
+        pairs = printing.shell_pairs(max_l, shells)
+        abcs = [abc for II, JJ in pairs for strategy in strategies
+                for abc in printing.block_integrals(lc, II, JJ, strategy_engine(strategy), spherical)]
+        targets.append(build.Target(f"cost model {gauss.orbital_names[lc]}", model_costs, list(dict.fromkeys(abcs)),
+                                    args=(lc, pairs, schedule, spherical), write=False))
+    return targets
+
+# The strategies of the blocks of one order, for model_targets
+def model_costs(lc : L, pairs : Sequence[Tuple[L, L]], schedule : bool=False, spherical : bool=False) -> Dict[Block, str]:
+    return {(lc, II, JJ) : cheapest(block_costs(lc, II, JJ, schedule, spherical)) for II, JJ in pairs}
+
+
+######### Autotuning ###########
+
+# Times every strategy on every block with bench and picks the fastest.
+# @return ({block : strategy}, {block : {strategy : ns per call}})
+def autotune(orders : Sequence[L], max_l : L, compiler : str=None, flags : List[str]=None,
+             samples : int=None, repeats : int=None) -> Tuple[Dict[Block, str], Dict[Block, Dict[str, float]]]:
+    # imported here so that reading tuning files (main.py) doesn't load NumPy and SymPy
+    import jit
+    import bench
+    options = {}
+    if samples is not None:
+        options["samples"] = samples
+    if repeats is not None:
+        options["repeats"] = repeats
+    timings = {}
+    for lc in orders:
+        l = max(max_l, lc) # the jit only compiles integrals with every orbital up to max_l
+        for strategy in strategies:
+            compiled = jit.JITIntegrals(l, [(lc, "M", "Tune")], compiler, flags, kernel_engine=strategy_engine(strategy))
+            results = bench.bench_updates(compiled, "Tune", l, engine=strategy_engine(strategy), **options)
+            for (II, JJ), result in zip(printing.shell_pairs(l), results):
+                if II <= max_l and JJ <= max_l:
+                    timings.setdefault((lc, II, JJ), {})[strategy] = result["ns_per_call"]
+    chosen = {block : min(times, key=times.get) for block, times in timings.items()}
+    return chosen, timings
+
+
+######### Tuning files ###########
+
+# The tuning file is JSON with the configuration it was measured with and one entry per block,
+#     {"config" : {...}, "blocks" : [{"lc" : 1, "II" : 0, "JJ" : 1, "strategy" : "md", "ns_per_call" : {...}}, ...]}
+def save_tuning(filename : str, chosen : Dict[Block, str], timings : Dict[Block, Dict[str, float]]=None,
+                config : dict=None) -> None:
+    blocks = []
+    for (lc, II, JJ), strategy in sorted(chosen.items()):
+        entry = {"lc" : lc, "II" : II, "JJ" : JJ, "strategy" : strategy}
+        if timings is not None:
+            entry["ns_per_call"] = timings[(lc, II, JJ)]
+        blocks.append(entry)
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    with open(filename, 'w') as file:
+        json.dump({"config" : config or {}, "blocks" : blocks}, file, indent=2)
+
+def load_tuning(filename : str) -> Dict[Block, str]:
+    with open(filename) as file:
+        blocks = json.load(file)["blocks"]
+    chosen = {}
+    for entry in blocks:
+        if entry["strategy"] not in strategies:
+            raise ValueError("Unknown strategy '{}' in {}, expected one of {}".format(entry["strategy"], filename, strategies))
+        chosen[(entry["lc"], entry["II"], entry["JJ"])] = entry["strategy"]
+    return chosen
+
+# Engines of the blocks of one update function of order lc, for printing.generate_update_func(block_engines=...)
+def block_engines(chosen : Dict[Block, str], lc : L) -> Dict[Tuple[L, L], str]:
+    return {(II, JJ) : strategy_engine(strategy) for (l, II, JJ), strategy in chosen.items() if l == lc}
+
+def format_costs(orders : Sequence[L], max_l : L, shells : Sequence[L]=None, schedule : bool=False,
+                 spherical : bool=False) -> str:
+    lines = ["{:<6} {:<8} {:>7} {:>6} {:>6} {:>10} {:>10} {:>9} {:>9}".format(
+        "block", "strategy", "flops", "calls", "temps", "registers", "code size", "cost", "")]
+    for lc in orders:
+        for II, JJ in printing.shell_pairs(max_l, shells):
+            costs = block_costs(lc, II, JJ, schedule, spherical)
+            best = cheapest(costs)
+            name = "".join([gauss.orbital_names[l] for l in [II, JJ, lc]])
+            for strategy, c in costs.items():
+                lines.append("{:<6} {:<8} {:>7} {:>6} {:>6} {:>10} {:>10} {:>9.0f} {:>9}".format(
+                    name, strategy, c.flops, c.calls, c.temporaries, c.registers, c.code_size, c.cost,
+                    "*" if strategy == best else ""))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pick the emission strategy of every update block')
+    parser.add_argument('L', type=int, help='Maximum angular momentum of the shell pairs')
+    parser.add_argument('--lc', type=int, nargs='+', default=[1], help='Multipole orders of the update functions')
+    parser.add_argument('--autotune', action='store_true',
+                        help='Time the strategies with locally compiled code instead of using the cost model')
+    parser.add_argument('--compiler', default=None, help='C++ compiler for --autotune (default: $CXX or g++)')
+    parser.add_argument('--flags', default=None, help='Compiler flags for --autotune (default: -O2)')
+    parser.add_argument('--samples', type=int, default=None, help='Calls per timed batch with --autotune')
+    parser.add_argument('--schedule', action='store_true',
+                        help='Cost the blocks as ordered by scheduling.py, for main.py --schedule')
+    parser.add_argument('--spherical', action='store_true',
+                        help='Cost the blocks of spherical outputs, for main.py --spherical')
+    parser.add_argument('-o', '--output', default=None, help='Write the chosen strategies to this tuning file')
+    args = parser.parse_args()
+    if args.autotune and args.spherical:
+        parser.error("--autotune times the Cartesian blocks, --spherical only works with the cost model")
+
+    import jit
+    cache = integrals.cache_filename(jit.default_cache_dir)
+    integrals.registry.load(cache)
+    flags = None if args.flags is None else args.flags.split()
+    config = {"L" : args.L, "lc" : args.lc}
+    if args.autotune:
+        chosen, timings = autotune(args.lc, args.L, args.compiler, flags, args.samples)
+        config.update({"method" : "autotune", "compiler" : args.compiler or jit.default_compiler,
+                       "flags" : flags or jit.default_flags})
+        for block, times in sorted(timings.items()):
+            print(block, chosen[block], ", ".join(["{} {:.1f} ns".format(s, t) for s, t in times.items()]))
+    else:
+        print(format_costs(args.lc, args.L, schedule=args.schedule, spherical=args.spherical))
+        chosen, timings = model_strategies(args.lc, args.L, schedule=args.schedule, spherical=args.spherical), None
+        config.update({"method" : "model", "schedule" : args.schedule, "spherical" : args.spherical})
+    integrals.registry.save(cache)
+    if args.output is not None:
+        save_tuning(args.output, chosen, timings, config)
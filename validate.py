@@ -0,0 +1,114 @@
+# Numerical validation of the generated integral code.
+# The symbolic integrals from integrals.three_body_integral are evaluated with NumPy (through sympy.lambdify)
+# and compared against the emitted C++, compiled and loaded through jit.
+# This closes the loop between the recursion, the printer, the parser and metacode.
+
+import argparse
+from typing import List, Sequence, Tuple
+
+import numpy as np
+import sympy as sym
+
+import gaussians as gauss
+from gaussians import L, ABC # types
+import integrals
+import printing
+import jit
+
+######### NumPy evaluation ###########
+
+# Turns the symbolic integral for abc into a vectorized NumPy function of (GA, GB, GC, Z),
+# where GA, GB and GC are (n, 3) arrays and Z is an (n,) array.
+def numpy_integral(abc : ABC):
+    expr = sym.sympify(integrals.three_body_integral(abc))
+    symbols = list(integrals.GA) + list(integrals.GB) + list(integrals.GC) + [integrals.Z]
+    func = sym.lambdify(symbols, expr, "numpy")
+    def evaluate(GA, GB, GC, Z):
+        result = func(*GA.T, *GB.T, *GC.T, Z)
+        # constant integrals (like (s|s|s)) come back as scalars
+        return np.broadcast_to(np.asarray(result, dtype=np.float64), Z.shape)
+    return evaluate
+
+# Random integral arguments: centers are O(1) apart and Z = 1/(2*zeta) stays positive
+def random_arguments(num_samples : int, seed : int=0):
+    rng = np.random.default_rng(seed)
+    GA, GB, GC = [rng.uniform(-2., 2., (num_samples, 3)) for _ in range(3)]
+    Z = rng.uniform(0.05, 1., num_samples)
+    return GA, GB, GC, Z
+
+
+######### Validation ###########
+
+# Compiles the integral code for max_l, derived with engine (see integrals.print_integral), and checks
+# every generated function against the NumPy evaluation of the Obara-Saika recursion.
+# @return list((ABC, float)) the integrals that disagree and their maximum relative error
+def validate_integrals(max_l : L, num_samples : int=1000000, rtol : float=1e-10, seed : int=0,
+                       compiler : str=None, cache_dir : str=None, engine : str="os") -> List[Tuple[ABC, float]]:
+    integrals.registry.use_engine(engine)
+    abcs = list(gauss.generate_triples(max_l))
+    GA, GB, GC, Z = random_arguments(num_samples, seed)
+    compiled = jit.JITIntegrals(max_l, compiler=compiler, cache_dir=cache_dir)
+    failures = []
+    for abc in abcs:
+        expected = numpy_integral(abc)(GA, GB, GC, Z)
+        actual = compiled.eval_integrals([abc], GA, GB, GC, Z)[0]
+        scale = np.maximum(np.abs(expected), 1.)
+        error = float(np.max(np.abs(actual - expected) / scale))
+        if error > rtol:
+            failures.append((abc, error))
+    return failures
+
+# Checks the update functions of multipole order lc built with every kernel engine (see
+# printing.engine_intermediates) against the ones that call the integral functions, over random
+# primitives of every shell pair up to max_l.
+# @return list((str, float)) the engines that disagree and their maximum relative error
+def validate_kernel_engines(max_l : L, lc : L=1, num_samples : int=1000, rtol : float=1e-10, seed : int=0,
+                            compiler : str=None, cache_dir : str=None) -> List[Tuple[str, float]]:
+    max_l = max(max_l, lc) # the jit only compiles integrals with every orbital up to max_l
+    GA, GB, GC, Z = random_arguments(num_samples, seed)
+    factor = np.random.default_rng(seed + 1).uniform(-1., 1., num_samples)
+    zeros = np.zeros(num_samples, dtype=np.intc)
+    nbf = printing.NFS[max_l]
+    def matrices(kernel_engine):
+        compiled = jit.JITIntegrals(max_l, [(lc, "M", "Multipole")], compiler=compiler, cache_dir=cache_dir,
+                                    kernel_engine=kernel_engine)
+        results = []
+        for II, JJ in printing.shell_pairs(max_l):
+            out = np.zeros((printing.NFS[lc], nbf, nbf))
+            compiled.update("Multipole", II, JJ, zeros, zeros, GA, GB, GC, Z, factor, out)
+            results.append(out)
+        return np.array(results)
+    expected = matrices(None)
+    scale = np.maximum(np.abs(expected), 1.)
+    failures = []
+    for engine in integrals.engine_names:
+        error = float(np.max(np.abs(matrices(engine) - expected) / scale))
+        if error > rtol:
+            failures.append((engine, error))
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Validate generated integral code numerically')
+    parser.add_argument('L', metavar='L', type=int,
+                        help='Maximum angular momentum quantum desired')
+    parser.add_argument('-n', '--samples', type=int, default=1000000,
+                        help='Number of random (GA, GB, GC, Z) samples')
+    parser.add_argument('--rtol', type=float, default=1e-10,
+                        help='Largest allowed relative error')
+    parser.add_argument('--engine', choices=integrals.engine_names, default="os",
+                        help='Derivation of the integral code that is checked')
+    parser.add_argument('--kernels', type=int, default=None, metavar='LC',
+                        help='Check the update functions of multipole order LC with every kernel engine instead')
+    args = parser.parse_args()
+
+    if args.kernels is not None:
+        failures = validate_kernel_engines(args.L, args.kernels, min(args.samples, 10000), args.rtol)
+        for engine, error in failures:
+            print("FAILED kernel engine {}: relative error {}".format(engine, error))
+        print("{} kernel engines failed validation".format(len(failures)))
+        exit(1 if failures else 0)
+    failures = validate_integrals(args.L, args.samples, args.rtol, engine=args.engine)
+    for abc, error in failures:
+        print("FAILED {}: relative error {}".format(gauss.abc_to_funcname(abc), error))
+    print("{} integrals failed validation".format(len(failures)))
+    exit(1 if failures else 0)